@@ -6,8 +6,6 @@ import json
 from datetime import timezone
 import time
 import random
-import csv
-import io
 import logging
 from datetime import datetime, timedelta
 from collections import deque
@@ -16,13 +14,24 @@ from functools import wraps
 import psycopg2
 from psycopg2 import sql
 from psycopg2.extras import RealDictCursor
-from psycopg2.pool import SimpleConnectionPool
+from db_pool import ConnectionPool, db_config_from_env, make_psycopg_green
+from csv_export import stream_csv
+from live_feed import LiveFeed
+from emit_scheduler import EmitScheduler
+from cold_archive import merge_history
+from rolling_window import PM_CHANNELS
+from ingest_pipeline import default_status
+from ingest_leader import LeaderLock, notify_control
+from ingest_bus import LocalBus, PostgresBus, decode_update
+from ingest_service import IngestStack
+from history_query import current_cursor, make_cursor, parse_cursor, fetch_pm_since, fetch_extended_since
+from query_planner import (plan_history, plan_export, fetch_pm, fetch_extended, export_has_data, export_sql,
+                           tier_hits)
 from flask import Flask, Response, render_template, jsonify, request, make_response, redirect, url_for, session
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_caching import Cache
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
 import requests
 from time import sleep
@@ -86,36 +95,21 @@ login_manager.login_view = 'login'
 logging.basicConfig(level=logging.INFO)
 logging = logging.getLogger(__name__)
 
+# monkey_patch() does not reach psycopg2's C code: without this every query blocks the
+# hub that runs the MQTT loop, the ingest workers and Socket.IO
+make_psycopg_green()
+
 # Database configuration
 # Railway provides DATABASE_URL, but we'll also support individual variables for compatibility
-DATABASE_URL = os.getenv('DATABASE_URL')
-
-if DATABASE_URL:
-    # Parse Railway DATABASE_URL
-    import urllib.parse
-    parsed = urllib.parse.urlparse(DATABASE_URL)
-    DB_CONFIG = {
-        "host": parsed.hostname,
-        "database": parsed.path.lstrip('/'),
-        "user": parsed.username,
-        "password": parsed.password,
-        "port": parsed.port or 5432
-    }
-else:
-    # Fallback to individual environment variables
-    DB_CONFIG = {
-        "host": os.getenv('DB_HOST'),
-        "database": os.getenv('DB_NAME'),
-        "user": os.getenv('DB_USER'),
-        "password": os.getenv('DB_PASSWORD'),
-        "port": int(os.getenv('DB_PORT', 5432))
-    }
+DB_CONFIG = db_config_from_env()
 
-# Initialize database connection pool
+# Initialize database connection pool (safe across MQTT threads and request greenlets)
 try:
-    DB_POOL = SimpleConnectionPool(
+    DB_POOL = ConnectionPool(
         minconn=1,
-        maxconn=20,
+        maxconn=int(os.getenv('DB_POOL_MAX', 20)),
+        checkout_timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        statement_timeout_ms=int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 30000)),
         **DB_CONFIG
     )
     logging.info("Database connection pool initialized")
@@ -126,17 +120,7 @@ except Exception as e:
 # Data storage
 latest_data = {
     "sensor": {},
-    "status": {
-        "mode": "auto",
-        "relay_state": "OFF",
-        "thresholds": {
-            "pm1": 50.0,
-            "pm2.5": 75.0,
-            "pm4": 100.0,
-            "pm10": 150.0,
-            "tsp": 200.0
-        }
-    }
+    "status": default_status()
 }
 
 # User class for Flask-Login
@@ -162,14 +146,17 @@ def put_db_connection(conn):
     except Exception as e:
         logging.error(f"Error returning connection to pool: {e}")
 
+def db_connection():
+    """Context manager for a pooled connection; returned to the pool on every exit path"""
+    return DB_POOL.connection()
+
 @login_manager.user_loader
 def load_user(user_id):
-    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT id, username, email, is_admin FROM dust_users WHERE id = %s", (user_id,))
-        user_data = cur.fetchone()
+        with db_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("SELECT id, username, email, is_admin FROM dust_users WHERE id = %s", (user_id,))
+            user_data = cur.fetchone()
         if user_data:
             return User(
                 id=user_data['id'],
@@ -179,9 +166,6 @@ def load_user(user_id):
             )
     except Exception as e:
         logging.error(f"Error loading user: {e}")
-    finally:
-        if conn:
-            put_db_connection(conn)
     return None
 
 # Database initialization
@@ -253,6 +237,9 @@ def initialize_database():
             conn.commit()
             logging.info("dust_data_sources table created successfully")
 
+        # Rollup tiers, latest readings, reading key columns and partitions, as the ingest service does
+        INGEST_STACK.ensure_schema()
+
     except Exception as e:
         logging.error(f"Database initialization failed: {e}")
         raise
@@ -265,557 +252,134 @@ def initialize_database():
 
 
             
-    # MQTT clients are now initialized in initialize_mqtt_clients() above
+    # MQTT clients are started by start_ingest() once this process holds the ingest lock
     pass
 
     
 
-# MQTT Client Management
+# MQTT Client Management: connected clients by data source, maintained by MQTT_ENGINE
 mqtt_clients = {}
+MQTT_TOPICS = ['sensor/data', 'dustrak/status']
 
-def process_extended_device_data(payload, device_id, timestamp, data_source_id):
-    """Process and store extended telemetry data for new device type"""
-    logging.info(f"[EXTENDED] Processing data for device: {device_id}")
-    logging.info(f"[EXTENDED] Data source: {data_source_id}")
-    logging.info(f"[EXTENDED] Payload keys: {list(payload.keys())}")
-    
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Get or validate device
-        cur.execute("""
-            SELECT id FROM dust_devices
-            WHERE deviceid = %s AND data_source_id = %s
-        """, (device_id, data_source_id))
-        row = cur.fetchone()
-        
-        if not row:
-            logging.warning(f"[EXTENDED] Unauthorized device: {device_id} for source: {data_source_id}")
-            # Let's also check what devices exist
-            cur.execute("SELECT deviceid, data_source_id FROM dust_devices")
-            existing_devices = cur.fetchall()
-            logging.info(f"[EXTENDED] Existing devices: {existing_devices}")
-            return
-
-        device_id_db = row[0]
-        logging.info(f"[EXTENDED] Found device in DB with ID: {device_id_db}")
-
-        # Check if this is the new compact format
-        if "e" in payload and "pm" in payload and "g" in payload:
-            logging.info(f"[EXTENDED] Processing new compact format")
-            process_compact_format_data(payload, device_id_db, timestamp, data_source_id, cur)
-        else:
-            logging.info(f"[EXTENDED] Processing legacy extended format")
-            # Legacy format processing
-            temperature = payload.get("Temperature_C")
-            humidity = payload.get("Humidity_%")
-            pressure = payload.get("Pressure_hPa")
-            voc = payload.get("VOC_ppb")
-            no2 = payload.get("NO2_ppb")
-            
-            pm_data = payload.get("PM_data", {})
-            logging.info(f"[EXTENDED] PM_data: {pm_data}")
-            pm1 = pm_data.get("PM1")
-            pm2_5 = pm_data.get("PM2_5")
-            pm4 = pm_data.get("PM4")
-            pm10 = pm_data.get("PM10")
-            tsp_um = pm_data.get("TSP_um")
-
-            gps_data = payload.get("GPS", {})
-            logging.info(f"[EXTENDED] GPS_data: {gps_data}")
-            gps_lat = gps_data.get("Latitude")
-            gps_lon = gps_data.get("Longitude")
-            gps_alt = gps_data.get("Altitude_m")
-            gps_speed = gps_data.get("Speed_kmh")
-            
-            cloud_cover = payload.get("Cloud_cover_%")
-
-            # Handle timestamp
-            ts_str = payload.get("timestamp_utc")
-            if ts_str:
-                try:
-                    timestamp = datetime.fromisoformat(ts_str.replace('Z', '+00:00'))
-                except Exception as e:
-                    logging.warning(f"[EXTENDED] Invalid timestamp format: {ts_str} - using server timestamp: {e}")
-
-            insert_extended_data(cur, device_id_db, timestamp, temperature, humidity, pressure,
-                           voc, no2, pm1, pm2_5, pm4, pm10, tsp_um,
-                           gps_lat, gps_lon, gps_alt, gps_speed, cloud_cover)
-        
-        conn.commit()
-        logging.info(f"[EXTENDED] Successfully inserted extended data for device {device_id_db}")
-
-        # Emit immediately to frontend for both streams
-        emit_extended_websocket_update(device_id_db)
-        emit_websocket_update(device_id_db)
-
-    except Exception as e:
-        logging.error(f"[EXTENDED] Error processing extended device data: {e}")
-        if conn:
-            conn.rollback()
-        raise  # Re-raise to see full traceback
-    finally:
-        if conn:
-            put_db_connection(conn)
-
-def process_compact_format_data(payload, device_id_db, timestamp, data_source_id, cur):
-    """Process the new compact data format"""
-    logging.info(f"[COMPACT] Processing compact format data for device: {device_id_db}")
-
-    # Extract the arrays
-    environmental_data = payload.get("e", [])
-    pm_data = payload.get("pm", [])
-    gps_data = payload.get("g", {})
-
-    logging.info(f"[COMPACT] Environmental data length: {len(environmental_data)}")
-    logging.info(f"[COMPACT] PM data length: {len(pm_data)}")
-    logging.info(f"[COMPACT] GPS data: {gps_data}")
-
-    # Map environmental data according to the new MQTT script structure (8+ elements)
-    # Index 0: Temperature (°C) - REAL SENSOR DATA
-    # Index 1: Humidity (%) - REAL SENSOR DATA
-    # Index 2: Pressure (hPa) - REAL SENSOR DATA
-    # Index 3: UV Index - REAL SENSOR DATA
-    # Index 4: Lux (lux) - REAL SENSOR DATA
-    # Index 5: VOC (ppb) - REAL SENSOR DATA ⭐️ NEW
-    # Index 6: NO2 (ppb) - REAL SENSOR DATA ⭐️ NEW
-    # Index 7: Noise (dB) - REAL SENSOR DATA ⭐️ NEW
+def serialize_latest_part(part):
+    """JSON-friendly copy of a LATEST_STORE part (timestamp as ISO string)"""
+    if not part:
+        return None
+    data = dict(part)
+    if isinstance(data.get("timestamp"), datetime):
+        data["timestamp"] = data["timestamp"].isoformat()
+    return data
 
-    temperature = environmental_data[0] if len(environmental_data) > 0 and environmental_data[0] is not None else None
-    humidity = environmental_data[1] if len(environmental_data) > 1 and environmental_data[1] is not None else None
-    pressure = environmental_data[2] if len(environmental_data) > 2 and environmental_data[2] is not None else None
-    uv_index = environmental_data[3] if len(environmental_data) > 3 and environmental_data[3] is not None else None
-    lux = environmental_data[4] if len(environmental_data) > 4 and environmental_data[4] is not None else None
 
-    # Based on actual MQTT data received, map the values correctly
-    # From the actual data: [22.67, 33.87, 1012.49, 0.0, 0.44, 32044, 0.605, 66.23]
-    # Index 5: 32044 (this looks like a large ADC reading, convert to ppb)
-    # Index 6: 0.605 (this looks like ppm, convert to ppb)
-    # Index 7: 66.23 (this looks like dB already)
+def latest_reading_ms(entry):
+    """Epoch milliseconds of the newest sensor or extended reading in a LATEST_STORE entry"""
+    stamps = [part["timestamp"] for part in (entry.get("sensor"), entry.get("extended"))
+              if part and part.get("timestamp")]
+    return int(max(stamps).timestamp() * 1000) if stamps else 0
 
-    # Extract raw values with debug logging
-    voc_raw = environmental_data[5] if len(environmental_data) > 5 and environmental_data[5] is not None else None
-    no2_raw = environmental_data[6] if len(environmental_data) > 6 and environmental_data[6] is not None else None
-    noise_db = environmental_data[7] if len(environmental_data) > 7 and environmental_data[7] is not None else None
 
-    logging.info(f"[COMPACT] Raw values - VOC: {voc_raw}, NO2: {no2_raw}, Noise: {noise_db}")
+def writes_in_process():
+    """True while this worker's own batch writer commits the readings (it holds the lock, no shards)"""
+    return bool(INGEST_LEADER and INGEST_LEADER.is_leader) and SHARDED_INGEST is None
 
-    # Convert raw values to proper units
-    # VOC: raw ADC value (32044) -> convert to reasonable ppb range
-    voc = voc_raw / 1000 if voc_raw is not None and voc_raw != 0 else None  # 32044 -> 32.044 ppb
 
-    # NO2: ppm value (0.605) -> convert to ppb
-    no2 = no2_raw * 1000 if no2_raw is not None and no2_raw != 0 else None  # 0.605 ppm -> 605 ppb
-
-    # Noise: already in dB
-    # noise_db is already in correct units
-
-    logging.info(f"[COMPACT] Converted values - VOC: {voc}, NO2: {no2}, Noise: {noise_db}")
-
-    # Battery still at the end if available
-    battery_percent = environmental_data[18] if len(environmental_data) > 18 and environmental_data[18] is not None else None
-
-    cloud_cover = None  # Not implemented yet
-    
-    # PM data mapping: [PM1, PM2.5, PM4, PM10, TSP]
-    pm1 = pm_data[0] if len(pm_data) > 0 else None
-    pm2_5 = pm_data[1] if len(pm_data) > 1 else None
-    pm4 = pm_data[2] if len(pm_data) > 2 else None
-    pm10 = pm_data[3] if len(pm_data) > 3 else None
-    tsp_um = pm_data[4] if len(pm_data) > 4 else None
-    
-    # GPS data
-    gps_lat = gps_data.get("lat")
-    gps_lon = gps_data.get("lon")
-    gps_alt = None  # Not provided in this format
-    gps_speed = None  # Not provided in this format
-    
-    # Handle timestamp
-    timestamp_str = payload.get("t")
-    if timestamp_str:
+def handle_ingest_updates(updates):
+    """Fold ingest bus updates into this worker's caches and schedule emits for its rooms"""
+    for update in updates:
         try:
-            # Handle ISO format with Z
-            if timestamp_str.endswith('Z'):
-                timestamp_str = timestamp_str[:-1] + '+00:00'
-            timestamp = datetime.fromisoformat(timestamp_str)
+            device_id, parts, points = decode_update(update)
+            LATEST_STORE.apply(device_id, **parts)
+            if points:
+                LIVE_FEED.apply({device_id: points})
+                if not writes_in_process():
+                    # Flushes by another process never reach this worker's threshold engine stage
+                    for timestamp, values in points:
+                        THRESHOLD_ENGINE.add_reading(device_id, timestamp, values)
+            if "extended" in parts:
+                emit_extended_websocket_update(device_id)
+            emit_websocket_update(device_id)
         except Exception as e:
-            logging.warning(f"[COMPACT] Invalid timestamp format: {timestamp_str} - using server timestamp: {e}")
-            timestamp = datetime.now(timezone.utc)
-    
-    logging.info(f"[COMPACT] Mapped values:")
-    logging.info(f"[COMPACT]   Temperature: {temperature}°C")
-    logging.info(f"[COMPACT]   Humidity: {humidity}%")
-    logging.info(f"[COMPACT]   Pressure: {pressure}hPa")
-    logging.info(f"[COMPACT]   Lux: {lux} lux")
-    logging.info(f"[COMPACT]   UV Index: {uv_index}")
-    logging.info(f"[COMPACT]   Battery: {battery_percent}%")
-    logging.info(f"[COMPACT]   VOC: {voc}ppb")
-    logging.info(f"[COMPACT]   NO2: {no2}ppb")
-    logging.info(f"[COMPACT]   Cloud Cover: {cloud_cover}%")
-    logging.info(f"[COMPACT]   PM1: {pm1}")
-    logging.info(f"[COMPACT]   PM2.5: {pm2_5}")
-    logging.info(f"[COMPACT]   PM4: {pm4}")
-    logging.info(f"[COMPACT]   PM10: {pm10}")
-    logging.info(f"[COMPACT]   TSP: {tsp_um}")
-    logging.info(f"[COMPACT]   GPS: lat={gps_lat}, lon={gps_lon}")
-    
-    # Insert into database
-    insert_extended_data(cur, device_id_db, timestamp, temperature, humidity, pressure,
-                     voc, no2, noise_db, pm1, pm2_5, pm4, pm10, tsp_um,
-                     gps_lat, gps_lon, gps_alt, gps_speed, cloud_cover,
-                     lux, uv_index, battery_percent)
-    
-    # Also insert/update the standard sensor table so existing charts/UI update
-    try:
-        cur.execute(
-            """
-            INSERT INTO dust_sensor_data
-            (timestamp, device_id, data_source_id, pm1, pm2_5, pm4, pm10, tsp)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """,
-            (
-                timestamp,
-                device_id_db,
-                data_source_id,
-                float(pm1) * 1 if pm1 is not None else None,
-                float(pm2_5) * 1 if pm2_5 is not None else None,
-                float(pm4) * 1 if pm4 is not None else None,
-                float(pm10) * 1 if pm10 is not None else None,
-                float(tsp_um) * 1 if tsp_um is not None else None,
-            ),
-        )
-        logging.info(f"[COMPACT] Successfully inserted mirrored sensor data")
-    except Exception as e:
-        logging.warning(f"[COMPACT] Failed to write mirrored sensor row: {e}")
-
-def insert_extended_data(cur, device_id_db, timestamp, temperature, humidity, pressure,
-                     voc, no2, noise_db, pm1, pm2_5, pm4, pm10, tsp_um,
-                     gps_lat, gps_lon, gps_alt, gps_speed, cloud_cover,
-                     lux=None, uv_index=None, battery_percent=None):
-    """Helper function to insert extended data into database"""
-    cur.execute("""
-        INSERT INTO dust_extended_data (
-            device_id, timestamp,
-            temperature_c, humidity_percent, pressure_hpa,
-            voc_ppb, no2_ppb, noise_db,
-            pm1, pm2_5, pm4, pm10, tsp_um,
-            gps_lat, gps_lon, gps_alt_m, gps_speed_kmh,
-            cloud_cover_percent, lux, uv_index, battery_percent
-        ) VALUES (
-            %s, %s,
-            %s, %s, %s,
-            %s, %s, %s,
-            %s, %s, %s, %s, %s,
-            %s, %s, %s, %s,
-            %s, %s, %s, %s
-        )
-    """, (
-        device_id_db, timestamp,
-        temperature, humidity, pressure,
-        voc, no2, noise_db,
-        pm1, pm2_5, pm4, pm10, tsp_um,
-        gps_lat, gps_lon, gps_alt, gps_speed,
-        cloud_cover, lux, uv_index, battery_percent
-    ))
-    logging.info(f"[EXTENDED] Successfully inserted extended data")
-
-
-def on_mqtt_connect(client, userdata, flags, rc, properties=None):
-    logging.info(f"[MQTT] Connection result code: {rc}")
-    if rc == 0:
-        logging.info(f"[MQTT] Connection result code: {rc}")
-        logging.info("Connected to MQTT broker")
-        for topic in userdata['topics']:
-            client.subscribe(topic)
-            logging.info(f"Subscribed to {topic}")
-            
-    else:
-        logging.error(f"Failed to connect to MQTT broker with result code {rc}")
-
-def on_mqtt_message(client, userdata, msg):
-    try:
-        payload = json.loads(msg.payload.decode())
-        device_id = payload.get("deviceid") or payload.get("i")  # Support both formats
+            logging.error(f"[INGEST] Failed to apply ingest update {update.get('d')}: {e}")
 
-        if not device_id:
-            logging.warning("MQTT message missing deviceid or i")
-            return
 
-        timestamp = datetime.now(timezone.utc)
-        data_source_id = userdata['data_source_id']
+# Rolling 15-minute PM windows for devices with websocket viewers (snapshot on join, then deltas)
+LIVE_FEED = LiveFeed(get_db_connection, put_db_connection)
 
-        logging.info(f"[MQTT] msg topic={msg.topic}, payload={msg.payload[:200]}")
+# Coalesces websocket emits per room, at most EMIT_MAX_HZ payloads per room and event
+EMIT_SCHEDULER = EmitScheduler(socketio, max_rate_hz=float(os.getenv('EMIT_MAX_HZ', 2)))
 
-        # Process message based on topic
-        if msg.topic.endswith("data"):
-            logging.info(f"[MQTT] Processing message for device: {device_id}")
-            logging.info(f"[MQTT] Payload keys: {list(payload.keys())}")
-            logging.info(f"[MQTT] Payload sample: {str(payload)[:500]}")
-
-            # Check for compact format (new format with e, pm, g arrays)
-            is_compact_format = "e" in payload and "pm" in payload and "g" in payload
-            # Check for legacy extended format
-            has_pm_data = "PM_data" in payload
-            has_extended_keys = any(k in payload for k in ["Temperature_C", "Humidity_%", "GPS"])
-
-            logging.info(f"[MQTT] Compact format present: {is_compact_format}")
-            logging.info(f"[MQTT] Legacy PM_data present: {has_pm_data}")
-            logging.info(f"[MQTT] Legacy extended keys present: {has_extended_keys}")
-
-            if is_compact_format or (has_pm_data and has_extended_keys):
-                logging.info("[MQTT] Routing to process_extended_device_data")
-                process_extended_device_data(payload, device_id, timestamp, data_source_id)
-            else:
-                logging.info("[MQTT] Routing to process_sensor_data")
-                process_sensor_data(payload, device_id, timestamp, data_source_id)
-        elif msg.topic.endswith("status"):
-            process_status_data(payload, device_id)
-            
-    except json.JSONDecodeError:
-        logging.error(f"Invalid JSON payload: {msg.payload}")
+# Ingest -> websocket fan-out: every flush, wherever it runs, notifies every web worker.
+# INGEST_BUS=local skips NOTIFY; only valid when this single web worker ingests in-process (no shards)
+if os.getenv('INGEST_BUS', 'postgres').lower() == 'local':
+    INGEST_BUS = LocalBus()
+else:
+    INGEST_BUS = PostgresBus(DB_CONFIG, on_resync=lambda: LATEST_STORE.load())
+INGEST_BUS.subscribe(handle_ingest_updates)
+
+# Writer, stages, decoding pipeline, collectors and maintenance jobs, built exactly as the ingest
+# service and the shards build them; only started here once this worker holds the ingest lock
+INGEST_STACK = IngestStack(get_db_connection, put_db_connection, INGEST_BUS,
+                           status=latest_data["status"], clients=mqtt_clients)
+
+# The parts the web routes read: caches, job state and metrics
+DEVICE_REGISTRY = INGEST_STACK.registry
+THRESHOLD_ENGINE = INGEST_STACK.threshold_engine
+LATEST_STORE = INGEST_STACK.latest
+ROLLUPS = INGEST_STACK.rollups
+LEGACY_REPAIR = INGEST_STACK.legacy_repair
+MIRROR_CLEANUP = INGEST_STACK.mirror_cleanup
+PARTITION_MANAGER = INGEST_STACK.partitions
+ARCHIVE = INGEST_STACK.archive
+RETENTION = INGEST_STACK.retention
+INGEST_WRITER = INGEST_STACK.writer
+INGEST = INGEST_STACK.pipeline
+SHARDED_INGEST = INGEST_STACK.shards
+MQTT_ENGINE = INGEST_STACK.engine
+
+
+def notify_ingest(message):
+    """Hand a control message to the active ingester, in this process or another one"""
+    try:
+        with db_connection() as conn:
+            notify_control(conn.cursor(), message)
+            conn.commit()
     except Exception as e:
-        logging.error(f"Error processing MQTT message: {e}")
-
-def start_mqtt_client(data_source_id, broker_url, topics, username=None, password=None):
-    """Start MQTT client with Railway-compatible threading"""
-    import threading
-
-    def mqtt_worker():
-        def on_connect(client, userdata, flags, rc, properties=None):
-            logging.info(f"[MQTT-{data_source_id}] Connected to broker: {broker_url}, rc={rc}")
-            if rc == 0:
-                for topic in topics:
-                    client.subscribe(topic, qos=1)
-                    logging.info(f"[MQTT-{data_source_id}] Subscribed to topic: {topic}")
-            else:
-                logging.error(f"[MQTT-{data_source_id}] Connection failed with rc={rc}")
+        logging.error(f"[INGEST] Could not notify the ingester: {e}")
 
-        def on_message(client, userdata, msg):
-            try:
-                # Get full payload first
-                raw_payload = msg.payload.decode('utf-8')
-                logging.info(f"[MQTT-{data_source_id}] Topic: {msg.topic}")
-                logging.info(f"[MQTT-{data_source_id}] Payload size: {len(raw_payload)} bytes")
-                logging.info(f"[MQTT-{data_source_id}] Full payload: {raw_payload}")
-
-                payload = json.loads(raw_payload)
-                device_id = payload.get("deviceid") or payload.get("i")
-
-                if not device_id:
-                    logging.warning(f"[MQTT-{data_source_id}] Message missing deviceid or i")
-                    return
-
-                logging.info(f"[MQTT-{data_source_id}] Parsed payload keys: {list(payload.keys())}")
-
-                timestamp = datetime.now(timezone.utc)
-                data_source_id_local = userdata['data_source_id']
-
-                if msg.topic.endswith("data"):
-                    # Check for compact format
-                    is_compact_format = "e" in payload and "pm" in payload and "g" in payload
-                    has_pm_data = "PM_data" in payload
-                    has_extended_keys = any(k in payload for k in ["Temperature_C", "Humidity_%", "GPS"])
-
-                    logging.info(f"[MQTT-{data_source_id}] Compact format: {is_compact_format}")
-
-                    if is_compact_format or (has_pm_data and has_extended_keys):
-                        logging.info(f"[MQTT-{data_source_id}] Processing extended data")
-                        process_extended_device_data(payload, device_id, timestamp, data_source_id_local)
-                    else:
-                        logging.info(f"[MQTT-{data_source_id}] Processing sensor data")
-                        process_sensor_data(payload, device_id, timestamp, data_source_id_local)
-                elif msg.topic.endswith("status"):
-                    process_status_data(payload, device_id)
-
-            except json.JSONDecodeError as e:
-                logging.error(f"[MQTT-{data_source_id}] JSON decode error: {e}")
-                logging.error(f"[MQTT-{data_source_id}] Raw payload: {msg.payload}")
-            except Exception as e:
-                logging.error(f"[MQTT-{data_source_id}] Error processing message: {e}")
-
-        def on_disconnect(client, userdata, rc):
-            logging.warning(f"[MQTT-{data_source_id}] Disconnected with code: {rc}")
-            if rc != 0:
-                logging.info(f"[MQTT-{data_source_id}] Unexpected disconnection, will retry...")
-
-        while True:
-            try:
-                logging.info(f"[MQTT-{data_source_id}] Creating MQTT client...")
-
-                client = mqtt.Client(
-                    mqtt.CallbackAPIVersion.VERSION2,
-                    userdata={"data_source_id": data_source_id, "topics": topics}
-                )
-
-                # Configure authentication
-                if username and password:
-                    client.username_pw_set(username, password)
-                    logging.info(f"[MQTT-{data_source_id}] Auth configured for user: {username}")
-
-                # Configure TLS for Railway compatibility
-                import ssl
-                context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
-                client.tls_set_context(context)
-
-                # Set callbacks
-                client.on_connect = on_connect
-                client.on_message = on_message
-                client.on_disconnect = on_disconnect
-
-                # Set message buffer sizes
-                client.max_inflight_messages_set(10)
-                client.max_queued_messages_set(100)
-
-                logging.info(f"[MQTT-{data_source_id}] Connecting to {broker_url}:8883...")
-                client.connect(broker_url, 8883, 60)
-
-                # Store client reference
-                mqtt_clients[data_source_id] = client
-                logging.info(f"[MQTT-{data_source_id}] Client stored, starting loop...")
-
-                # Start the MQTT loop (blocking)
-                client.loop_forever()
-
-            except Exception as e:
-                logging.error(f"[MQTT-{data_source_id}] Connection error: {e}")
-                logging.info(f"[MQTT-{data_source_id}] Retrying in 15 seconds...")
-                time.sleep(15)
-
-    # Start the MQTT worker in a daemon thread
-    thread = threading.Thread(target=mqtt_worker, daemon=True, name=f"MQTT-{data_source_id}")
-    thread.start()
-    logging.info(f"[MQTT-{data_source_id}] Started MQTT thread")
-
-# Updated MQTT initialization function using Railway-compatible approach
-def initialize_mqtt_clients():
-    import threading
 
-    logging.info("[MQTT-INIT] 🚀 Starting MQTT client initialization...")
+def invalidate_devices():
+    DEVICE_REGISTRY.invalidate()
+    notify_ingest({"type": "devices"})
 
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT ds.id, ds.broker_url, ds.username, ds.password
-            FROM dust_data_sources ds
-            WHERE ds.source_type = 'mqtt'
-        """)
-        mqtt_sources = cur.fetchall()
 
-        logging.info(f"[MQTT-INIT] 📊 Found {len(mqtt_sources)} MQTT data sources")
+def start_ingest():
+    """Runs once this process holds the ingest lock: writer, singleton jobs and collectors"""
+    logging.info("[STARTUP] 📡 Starting the ingest stack...")
+    INGEST_STACK.start()
 
-        for source in mqtt_sources:
-            data_source_id, broker_url, username, password = source
-            logging.info(f"[MQTT-INIT] 🔄 Processing data source {data_source_id}: {broker_url}")
 
-            # Check if client already exists
-            if data_source_id in mqtt_clients:
-                logging.warning(f"[MQTT-INIT] ⚠️ MQTT client for data source {data_source_id} already exists")
-                continue
+def stop_ingest():
+    """The ingest lock session broke: stop at once so a standby can take over, then restart"""
+    logging.error("[INGEST] 💥 Lost the ingest lock; restarting this worker as a standby")
+    INGEST_STACK.stop()
+    os._exit(3)
 
-            try:
-                # Use standard threading instead of eventlet for Railway compatibility
-                thread = threading.Thread(
-                    target=start_mqtt_client,
-                    args=(data_source_id, broker_url, ['sensor/data', 'dustrak/status'], username, password),
-                    daemon=True,
-                    name=f"MQTT-{data_source_id}"
-                )
-                thread.start()
-                logging.info(f"[MQTT-INIT] ✅ Started MQTT client thread for data source {data_source_id}")
 
-                # Give thread time to start and check if it's alive
-                time.sleep(0.5)
-                if thread.is_alive():
-                    logging.info(f"[MQTT-INIT] 🟢 Thread {thread.name} is running")
-                else:
-                    logging.error(f"[MQTT-INIT] 🔴 Thread {thread.name} died immediately")
+# INGEST_IN_WEB=false leaves ingest to the ingest service (ingest_service.py) so gunicorn can run
+# several workers; otherwise web workers campaign for the ingest lock and exactly one ingests
+INGEST_IN_WEB = os.getenv('INGEST_IN_WEB', 'true').lower() == 'true'
+INGEST_LEADER = LeaderLock(DB_CONFIG, on_elected=start_ingest, on_demoted=stop_ingest,
+                           on_control=INGEST_STACK.control) if INGEST_IN_WEB else None
 
-            except Exception as thread_error:
-                logging.error(f"[MQTT-INIT] ❌ Failed to start MQTT thread for data source {data_source_id}: {thread_error}")
-
-    except Exception as e:
-        logging.error(f"[MQTT-INIT] 💥 MQTT initialization failed: {e}")
-    finally:
-        if conn:
-            put_db_connection(conn)
-
-    logging.info("[MQTT-INIT] ✨ MQTT client initialization completed")
 
 # Add to initialization
 def initialize_app():
     initialize_database()
-    initialize_mqtt_clients()  # Initialize all MQTT clients
+    start_ingest()  # Start the writer, jobs and MQTT clients
     
     logging.info("All services initialized")
 
 
-def process_sensor_data(payload, device_id, timestamp, data_source_id):
-    """Process and store sensor data only for the specified device and data source"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Get or create device associated with this data source
-        cur.execute("""
-            SELECT id, user_id, has_relay 
-            FROM dust_devices 
-            WHERE deviceid = %s AND data_source_id = %s
-        """, (device_id, data_source_id))
-        device = cur.fetchone()
-
-        if not device:
-            # Create device with admin user as owner
-            logging.warning(f"Unauthorized device creation attempted: {device_id}")
-            return
-        device_id_db = device[0]
-        user_id = device[1]
-        has_relay = device[2]
-
-        # Insert sensor data
-        pm_data = payload.get("PM_data", {})
-        db_record = {
-            "timestamp": timestamp,
-            "device_id": device_id_db,
-            "data_source_id": data_source_id,
-            "pm1": float(pm_data.get("PM1", 0)) * 1000,
-            "pm2_5": float(pm_data.get("PM2_5", 0)) * 1000,
-            "pm4": float(pm_data.get("PM4", 0)) * 1000,
-            "pm10": float(pm_data.get("PM10", 0)) * 1000,
-            "tsp": float(pm_data.get("TSP_um", 0)) * 1000
-        }
-
-        cur.execute("""
-            INSERT INTO dust_sensor_data
-            (timestamp, device_id, data_source_id, pm1, pm2_5, pm4, pm10, tsp)
-            VALUES (%(timestamp)s, %(device_id)s, %(data_source_id)s, %(pm1)s, %(pm2_5)s, %(pm4)s, %(pm10)s, %(tsp)s)
-        """, db_record)
-        conn.commit()
-
-        # Only process thresholds if device has relay
-        if has_relay:
-            process_thresholds(device_id_db, user_id)
-
-        # Emit WebSocket update
-        emit_websocket_update(device_id_db)
-
-        # Also emit extended data if this was an extended device
-        if hasattr(data, 'get') and ('e' in data or 'extended' in data or 'Temperature_C' in data):
-            emit_extended_websocket_update(device_id_db)
-
-    except Exception as e:
-        logging.error(f"Error processing sensor data: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            put_db_connection(conn)
-
 @app.route('/')
 def landing_page():
     return render_template('index.html')
@@ -835,297 +399,97 @@ def products():
 
 
 
-def process_status_data(payload, device_id):
-    """Process status data from MQTT"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, user_id, has_relay FROM dust_devices WHERE deviceid = %s", (device_id,))
-
-        device = cur.fetchone()
-
-        if device and not device[0]:
-            return
-
-        latest_data["status"].update(payload)
-
-        if "thresholds" in payload:
-            cur.execute("""
-                INSERT INTO dust_thresholds (device_id, pm1, pm2_5, pm4, pm10, tsp, averaging_window)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (
-                device[0],
-                payload["thresholds"].get("pm1", latest_data["status"]["thresholds"]["pm1"]),
-                payload["thresholds"].get("pm2.5", latest_data["status"]["thresholds"]["pm2.5"]),
-                payload["thresholds"].get("pm4", latest_data["status"]["thresholds"]["pm4"]),
-                payload["thresholds"].get("pm10", latest_data["status"]["thresholds"]["pm10"]),
-                payload["thresholds"].get("tsp", latest_data["status"]["thresholds"]["tsp"]),
-                payload.get("averaging_window", 15)
-            ))
-
-            conn.commit()
-    except Exception as e:
-        logging.error(f"Error saving thresholds: {e}")
-    finally:
-        if conn:
-            put_db_connection(conn)
-                
-
-def process_thresholds(device_id, user_id):
-    """Check thresholds and control relay if needed"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Get averages over the configured window
-        cur.execute("""
-            WITH window_settings AS (
-                SELECT averaging_window
-                FROM dust_thresholds
-                WHERE device_id = %s
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ),
-            recent_data AS (
-                SELECT pm1, pm2_5, pm4, pm10, tsp
-                FROM dust_sensor_data
-                WHERE device_id = %s
-                AND timestamp >= NOW() - INTERVAL '1 minute' * COALESCE((SELECT averaging_window FROM window_settings), 15)
-                ORDER BY timestamp DESC
-            )
-            SELECT
-                AVG(pm1) as avg_pm1,
-                AVG(pm2_5) as avg_pm2_5,
-                AVG(pm4) as avg_pm4,
-                AVG(pm10) as avg_pm10,
-                AVG(tsp) as avg_tsp
-            FROM recent_data
-        """, (device_id, device_id))
-
-        averages = cur.fetchone()
-
-        # Get latest thresholds
-        cur.execute("""
-            SELECT pm1, pm2_5, pm4, pm10, tsp, averaging_window
-            FROM dust_thresholds
-            WHERE device_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """, (device_id,))
-
-        threshold_row = cur.fetchone()
-        thresholds = {
-            "pm1": threshold_row[0] if threshold_row else latest_data["status"]["thresholds"]["pm1"],
-            "pm2.5": threshold_row[1] if threshold_row else latest_data["status"]["thresholds"]["pm2.5"],
-            "pm4": threshold_row[2] if threshold_row else latest_data["status"]["thresholds"]["pm4"],
-            "pm10": threshold_row[3] if threshold_row else latest_data["status"]["thresholds"]["pm10"],
-            "tsp": threshold_row[4] if threshold_row else latest_data["status"]["thresholds"]["tsp"],
-            "averaging_window": threshold_row[5] if threshold_row else 15
-        }
-
-        # Check if any threshold is exceeded
-        trigger_relay = False
-        if averages and any([
-            averages[0] and averages[0] > thresholds["pm1"],
-            averages[1] and averages[1] > thresholds["pm2.5"],
-            averages[2] and averages[2] > thresholds["pm4"],
-            averages[3] and averages[3] > thresholds["pm10"],
-            averages[4] and averages[4] > thresholds["tsp"]
-        ]):
-            trigger_relay = True
-            create_alert(device_id, "threshold_exceeded", "One or more thresholds exceeded", thresholds, averages)
-
-        # Publish control message
-        control_message = {
-            "command": "all_on" if trigger_relay else "all_off",
-            "source": "server",
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "deviceid": device_id
+def websocket_status(device):
+    """Status block for websocket payloads, from the cached thresholds (no SQL)"""
+    t = THRESHOLD_ENGINE.thresholds(device.id) if device else None
+    defaults = latest_data["status"]["thresholds"]
+    return {
+        'system': 'operational',
+        'mode': 'auto',
+        'relay_state': latest_data["status"].get("relay_state", "OFF") if device and device.has_relay else "N/A",
+        'thresholds': {
+            "pm1": t['pm1'] if t else defaults["pm1"],
+            "pm2.5": t['pm2.5'] if t else defaults["pm2.5"],
+            "pm4": t['pm4'] if t else defaults["pm4"],
+            "pm10": t['pm10'] if t else defaults["pm10"],
+            "tsp": t['tsp'] if t else defaults["tsp"],
+            "averaging_window": t['averaging_window'] if t else 15
         }
-        if device_id in mqtt_clients and mqtt_clients[device_id].is_connected():
-            mqtt_clients[device_id].publish("dustrak/control", json.dumps(control_message), qos=1)
-
-    except Exception as e:
-        logging.error(f"Error processing thresholds: {e}")
-    finally:
-        if conn:
-            put_db_connection(conn)
-
-
-
-def emit_websocket_update(device_id):
-    """Emit WebSocket update for a specific device"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
-        # Get latest sensor reading
-        cur.execute("""
-            SELECT timestamp, pm1, pm2_5, pm4, pm10, tsp
-            FROM dust_sensor_data
-            WHERE device_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """, (device_id,))
-        latest_sensor = cur.fetchone()
+    }
 
-        def safe_avg(values):
-            return sum(values) / len(values) if values else 0
 
+def build_websocket_payload(device, feed, delta):
+    """Shared shape of the join snapshot and the per-flush delta"""
+    latest = LATEST_STORE.get(device.id) or {}
+    latest_sensor = latest.get("sensor")
+    payload = {
+        'device_id': device.id,
+        'delta': delta,
+        'sensor': {
+            **latest_sensor,
+            'timestamp': latest_sensor['timestamp'].isoformat(),
+            **feed["averages"]
+        } if latest_sensor else {},
+        'history': feed["history"],
+        'status': websocket_status(device)
+    }
+    extended_data = serialize_latest_part(latest.get("extended"))
+    if extended_data:
+        extended_data["device_id"] = device.id
+        payload['extended'] = extended_data
+    return payload
 
 
-        cur.execute("SELECT has_relay FROM dust_devices WHERE id = %s", (device_id,))
-        row = cur.fetchone()
-        has_relay = row['has_relay'] if row else False
+def device_room(device):
+    return f"user_{device.user_id}_device_{device.id}"
 
 
-        # Get chart data (last 15 minutes)
-        cur.execute("""
-            SELECT timestamp, pm1, pm2_5, pm4, pm10, tsp
-            FROM dust_sensor_data
-            WHERE device_id = %s
-            AND timestamp >= NOW() - INTERVAL '15 minutes'
-            ORDER BY timestamp ASC
-        """, (device_id,))
-        chart_data = cur.fetchall()
-
-        avg_pm1 = safe_avg([float(r['pm1']) for r in chart_data if r['pm1'] is not None])
-        avg_pm2_5 = safe_avg([float(r['pm2_5']) for r in chart_data if r['pm2_5'] is not None])
-        avg_pm4 = safe_avg([float(r['pm4']) for r in chart_data if r['pm4'] is not None])
-        avg_pm10 = safe_avg([float(r['pm10']) for r in chart_data if r['pm10'] is not None])
-        avg_tsp = safe_avg([float(r['tsp']) for r in chart_data if r['tsp'] is not None])
-
-
-        # Get latest thresholds
-        cur.execute("""
-            SELECT pm1, pm2_5, pm4, pm10, tsp, averaging_window
-            FROM dust_thresholds
-            WHERE device_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """, (device_id,))
-        threshold_row = cur.fetchone()
-
-        # Get extended data if available
-        extended_data = None
-        try:
-            cur.execute("""
-                SELECT *
-                FROM dust_extended_data
-                WHERE device_id = %s
-                ORDER BY timestamp DESC
-                LIMIT 1
-            """, (device_id,))
-            extended_row = cur.fetchone()
-            if extended_row:
-                extended_data = dict(extended_row)
-                # Convert datetime to ISO string
-                if isinstance(extended_data.get("timestamp"), datetime):
-                    extended_data["timestamp"] = extended_data["timestamp"].isoformat()
-        except Exception as e:
-            logging.warning(f"Could not fetch extended data for device {device_id}: {e}")
-
-        # Prepare data for WebSocket
-        cur.execute("SELECT user_id FROM dust_devices WHERE id = %s", (device_id,))
-        user_row = cur.fetchone()
-        if user_row:
-            user_id = user_row['user_id']
-
-            websocket_data = {
-                'device_id': device_id,
-                'sensor': {
-                    **latest_sensor,
-                    'timestamp': latest_sensor['timestamp'].isoformat(),
-                    'avg_pm1': avg_pm1,
-                    'avg_pm2_5': avg_pm2_5,
-                    'avg_pm4': avg_pm4,
-                    'avg_pm10': avg_pm10,
-                    'avg_tsp': avg_tsp
-                } if latest_sensor else {},
-                'history': {
-                    "timestamps": [row['timestamp'].isoformat() for row in chart_data],
-                    "pm1": [float(row['pm1']) if row['pm1'] else 0 for row in chart_data],
-                    "pm2_5": [float(row['pm2_5']) if row['pm2_5'] else 0 for row in chart_data],
-                    "pm4": [float(row['pm4']) if row['pm4'] else 0 for row in chart_data],
-                    "pm10": [float(row['pm10']) if row['pm10'] else 0 for row in chart_data],
-                    "tsp": [float(row['tsp']) if row['tsp'] else 0 for row in chart_data],
-                },
-                'status': {
-                    'system': 'operational',
-                    'mode': 'auto',
-                    'relay_state': latest_data["status"].get("relay_state", "OFF") if has_relay else "N/A",   # <-- THIS LINE
-                    'thresholds': {
-                        "pm1": threshold_row['pm1'] if threshold_row else latest_data["status"]["thresholds"]["pm1"],
-                        "pm2.5": threshold_row['pm2_5'] if threshold_row else latest_data["status"]["thresholds"]["pm2.5"],
-                        "pm4": threshold_row['pm4'] if threshold_row else latest_data["status"]["thresholds"]["pm4"],
-                        "pm10": threshold_row['pm10'] if threshold_row else latest_data["status"]["thresholds"]["pm10"],
-                        "tsp": threshold_row['tsp'] if threshold_row else latest_data["status"]["thresholds"]["tsp"],
-                        "averaging_window": threshold_row['averaging_window'] if threshold_row else 15
-                    }
-                }
-            }
+def build_delta_payload(device_id):
+    """Delta for one emit tick: every PM point flushed since the previous tick"""
+    feed = LIVE_FEED.take(device_id)
+    device = DEVICE_REGISTRY.get(device_id)
+    if feed is None or not device or not feed["history"]["timestamps"]:
+        # Untracked device or an extended-only flush: no new PM points to send
+        return None
+    return build_websocket_payload(device, feed, delta=True)
 
-            # Include extended data if available
-            if extended_data:
-                websocket_data['extended'] = extended_data
-                logging.info(f"Including extended data in WebSocket update for device {device_id}: temp={extended_data.get('temperature_c')}, humidity={extended_data.get('humidity_percent')}, lux={extended_data.get('lux')}")
-            else:
-                logging.info(f"No extended data found for device {device_id}")
 
-            socketio.emit('new_data', websocket_data, room=f"user_{user_id}_device_{device_id}")
+def emit_websocket_update(device_id):
+    """Schedule a delta (new points plus fresh rolling averages) for the device's room
 
+    Clients get the full recent history once, as the ``snapshot`` sent by
+    ``handle_join``.  The payload is built on the scheduler's next tick, so a
+    burst of flushes collapses into one emit carrying all of their points.
+    """
+    try:
+        device = DEVICE_REGISTRY.get(device_id)
+        if not device or not LIVE_FEED.tracked(device.id):
+            return
+        if not EMIT_SCHEDULER.schedule(device_room(device), 'new_data', lambda: build_delta_payload(device.id)):
+            # Everyone left: stop buffering points until the next join takes a fresh snapshot
+            LIVE_FEED.forget(device.id)
     except Exception as e:
         logging.error(f"Error emitting WebSocket update: {e}")
-    finally:
-        if conn:
-            put_db_connection(conn)
 
 
-def emit_extended_websocket_update(device_id):
-    """Send latest extended device data to frontend via WebSocket"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+def build_extended_payload(device_id):
+    latest = LATEST_STORE.get(device_id)
+    if not latest or not latest.get("extended"):
+        return None
+    serialized_data = serialize_latest_part(latest["extended"])
+    serialized_data["device_id"] = device_id
+    return serialized_data
 
-        cur.execute("""
-            SELECT *
-            FROM dust_extended_data
-            WHERE device_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """, (device_id,))
-        latest_ext = cur.fetchone()
-
-        if not latest_ext:
-            return
 
-        # Send data
-        cur.execute("SELECT user_id FROM dust_devices WHERE id = %s", (device_id,))
-        user_row = cur.fetchone()
-        if not user_row:
+def emit_extended_websocket_update(device_id):
+    """Schedule the latest extended device data for the device's room (latest wins)"""
+    try:
+        device = DEVICE_REGISTRY.get(device_id)
+        if not device:
             return
-
-        user_id = user_row['user_id']
-
-        # Convert datetime objects to ISO strings for JSON serialization
-        def serialize_extended_row(row):
-            data = dict(row)
-            if isinstance(data.get("timestamp"), datetime):
-                data["timestamp"] = data["timestamp"].isoformat()
-            return data
-
-        serialized_data = serialize_extended_row(latest_ext)
-        socketio.emit('new_extended_data', serialized_data, room=f"user_{user_id}_device_{device_id}")
-
+        EMIT_SCHEDULER.schedule(device_room(device), 'new_extended_data', lambda: build_extended_payload(device.id))
     except Exception as e:
         logging.error(f"Error emitting extended WebSocket: {e}")
-    finally:
-        if conn:
-            put_db_connection(conn)
 
 
 
@@ -1191,7 +555,7 @@ def add_data_source():
                 data_source_id = cur.fetchone()[0]
                 conn.commit()
 
-                # MQTT clients are now initialized in initialize_mqtt_clients() above
+                notify_ingest({"type": "sources"})
 
             else:  # API source
                 api_device_id = data.get('api_device_id')
@@ -1234,11 +598,10 @@ def delete_data_source(source_id):
         # Then delete the source
         cur.execute("DELETE FROM dust_data_sources WHERE id = %s", (source_id,))
         conn.commit()
+        invalidate_devices()
 
-        # Stop MQTT client if running
-        if source_id in mqtt_clients:
-            mqtt_clients[source_id].disconnect()
-            del mqtt_clients[source_id]
+        # The active ingester drops the source's MQTT client
+        notify_ingest({"type": "sources"})
 
         return jsonify({"status": "success"})
     except Exception as e:
@@ -1266,60 +629,26 @@ def change_password():
         if new_password != confirm_password:
             return render_template('change_password.html', error="New passwords do not match.")
 
-        conn = get_db_connection()
         try:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute("SELECT password_hash FROM dust_users WHERE id = %s", (current_user.id,))
-            user = cur.fetchone()
-            if not user or not check_password_hash(user['password_hash'], current_password):
-                return render_template('change_password.html', error="Incorrect current password.")
-
-            new_hash = generate_password_hash(new_password)
-            cur.execute("UPDATE dust_users SET password_hash = %s WHERE id = %s", (new_hash, current_user.id))
-            conn.commit()
+            with db_connection() as conn:
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+                cur.execute("SELECT password_hash FROM dust_users WHERE id = %s", (current_user.id,))
+                user = cur.fetchone()
+                if not user or not check_password_hash(user['password_hash'], current_password):
+                    return render_template('change_password.html', error="Incorrect current password.")
+
+                new_hash = generate_password_hash(new_password)
+                cur.execute("UPDATE dust_users SET password_hash = %s WHERE id = %s", (new_hash, current_user.id))
+                conn.commit()
             return render_template('change_password.html', success="Password changed successfully.")
         except Exception as e:
             logging.error(f"Error changing password: {e}")
             return render_template('change_password.html', error="Something went wrong. Try again.")
-        finally:
-            put_db_connection(conn)
     return render_template('change_password.html')
 
 
 
 
-def create_alert(device_id, alert_type, message, thresholds=None, readings=None):
-    """Create an alert in the database"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        threshold_value = None
-        measured_value = None
-
-        if alert_type == "threshold_exceeded" and thresholds and readings:
-            for i, param in enumerate(["pm1", "pm2.5", "pm4", "pm10", "tsp"]):
-                if readings[i] and readings[i] > thresholds[param]:
-                    threshold_value = thresholds[param]
-                    measured_value = readings[i]
-                    break
-
-        cur.execute("""
-            INSERT INTO dust_device_alerts
-            (device_id, alert_type, message, threshold_value, measured_value)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (device_id, alert_type, message, threshold_value, measured_value))
-        conn.commit()
-
-    except Exception as e:
-        logging.error(f"Error creating alert: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            put_db_connection(conn)
-
 def add_data_source(source_type: str, source_config: dict):
     """Add a new data source to the database."""
     conn = None
@@ -1341,7 +670,7 @@ def add_data_source(source_type: str, source_config: dict):
 
         # Start MQTT client if source type is MQTT
         if source_type == 'mqtt':
-            eventlet.spawn(start_mqtt_client, data_source_id, source_config['broker_url'], ['sensor/data', 'dustrak/status'], source_config.get('username'), source_config.get('password'))
+            notify_ingest({"type": "sources"})
 
         return data_source_id
     except Exception as e:
@@ -1488,12 +817,27 @@ def admin_panel():
         return redirect(url_for('dashboard'))
     return render_template('admin.html')
 
+@app.route('/api/admin/db_pool')
+@login_required
+def db_pool_metrics():
+    """Connection pool, ingest writer and emit scheduler metrics for sizing DB_POOL_MAX"""
+    if not current_user.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+    return jsonify({"pool": DB_POOL.metrics(), "ingest_writer": INGEST_WRITER.metrics(),
+                    "emit_scheduler": EMIT_SCHEDULER.stats, "partitions": PARTITION_MANAGER.stats,
+                    "rollups": ROLLUPS.stats, "query_tiers": tier_hits(),
+                    "retention": RETENTION.stats, "archive": ARCHIVE.stats,
+                    "mirror_cleanup": MIRROR_CLEANUP.stats,
+                    "mqtt": MQTT_ENGINE.metrics(),
+                    "dedup": INGEST.recent_keys.metrics(),
+                    "ingest_shards": SHARDED_INGEST.metrics() if SHARDED_INGEST else None,
+                    "ingest_leader": INGEST_LEADER.stats if INGEST_LEADER else None,
+                    "ingest_bus": INGEST_BUS.stats})
+
 @app.route('/api/admin/devices', methods=['GET'])
 @login_required
 def get_devices():
-    conn = None
-    try:
-        conn = get_db_connection()
+    with db_connection() as conn:
         cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute("""
             SELECT d.id, d.deviceid, d.name, d.user_id, d.data_source_id, d.has_relay, d.created_at,
@@ -1503,10 +847,7 @@ def get_devices():
             ORDER BY d.id DESC
         """)
         devices = cur.fetchall()
-        return jsonify({'devices': devices})
-    finally:
-        if conn:
-            put_db_connection(conn)
+    return jsonify({'devices': devices})
 
 @app.route('/api/admin/devices', methods=['POST'])
 @login_required
@@ -1521,8 +862,7 @@ def add_device():
     if not all([deviceid, name, user_id, data_source_id]):
         return jsonify({'status': 'error', 'message': 'Missing required fields'}), 400
 
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         cur = conn.cursor()
         # Ensure data_source exists
         cur.execute("SELECT id FROM dust_data_sources WHERE id = %s", (data_source_id,))
@@ -1535,9 +875,8 @@ def add_device():
             VALUES (%s, %s, %s, %s, %s)
         """, (deviceid, name, user_id, has_relay, data_source_id))
         conn.commit()
-        return jsonify({'status': 'success'})
-    finally:
-        put_db_connection(conn)
+    invalidate_devices()
+    return jsonify({'status': 'success'})
 
 
 
@@ -1557,8 +896,7 @@ def update_device(device_id):
     if not all([deviceid, name, user_id, data_source_id]):
         return jsonify({"status": "error", "message": "Missing required fields"}), 400
 
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         cur = conn.cursor()
         # Do not allow changing data_source_id after creation!
         cur.execute("SELECT data_source_id FROM dust_devices WHERE id = %s", (device_id,))
@@ -1575,9 +913,8 @@ def update_device(device_id):
             WHERE id = %s
         """, (deviceid, name, user_id, has_relay, location, description, device_id))
         conn.commit()
-        return jsonify({'status': 'success'})
-    finally:
-        put_db_connection(conn)
+    invalidate_devices()
+    return jsonify({'status': 'success'})
 
 @app.route('/api/admin/devices/<int:device_id>', methods=['DELETE'])
 @login_required
@@ -1593,6 +930,10 @@ def delete_device(device_id):
         cur.execute("DELETE FROM dust_device_alerts WHERE device_id = %s", (device_id,))
         cur.execute("DELETE FROM dust_devices WHERE id = %s", (device_id,))
         conn.commit()
+        invalidate_devices()
+        THRESHOLD_ENGINE.forget(device_id)
+        LATEST_STORE.forget(device_id)
+        LIVE_FEED.forget(device_id)
 
         return jsonify({"status": "success"})
     except Exception as e:
@@ -1607,13 +948,39 @@ def delete_device(device_id):
 @app.route('/api/data')
 @login_required
 def get_data():
-    """Get sensor data and history for a specific device"""
+    """Get sensor data and history for a specific device
+
+    History is downsampled server-side: ``max_points`` (default 2000, 0 for
+    raw) or an explicit ``bucket`` width in seconds bounds the number of points.
+    ``query_planner`` serves it from raw rows or a rollup tier and reports the
+    choice in ``history.resolution``.
+
+    Every response carries a ``cursor``.  Pollers send it back as ``since`` to
+    get only the rows added after it (``incremental: true``), or just
+    ``unchanged: true`` when the device has not reported since.  ``since`` may
+    also be an ISO timestamp.
+    """
     hours = float(request.args.get('hours', 24))
     device_id = request.args.get('deviceid')
 
     if not device_id:
         return jsonify({"error": "Device ID required"}), 400
 
+    max_points = request.args.get('max_points', type=int)
+    bucket = request.args.get('bucket', type=int)
+
+    since = None
+    if request.args.get('since'):
+        try:
+            since = parse_cursor(request.args['since'])
+        except ValueError:
+            return jsonify({"error": "Invalid since cursor"}), 400
+        # Nothing newer than what the client already has: answer without touching the database
+        latest_entry = LATEST_STORE.get(device_id)
+        if ("latest_ms" in since and latest_entry and DEVICE_REGISTRY.get(device_id)
+                and latest_reading_ms(latest_entry) <= since["latest_ms"]):
+            return jsonify({"cursor": request.args['since'], "incremental": True, "unchanged": True})
+
     conn = get_db_connection()
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -1624,51 +991,39 @@ def get_data():
             return jsonify({"error": "Device not found"}), 404
         logging.info(f"Data access allowed for device {device_id}")
 
-        # Get latest sensor data
-        cur.execute("""
-            SELECT (timestamp AT TIME ZONE 'UTC' AT TIME ZONE 'GMT') as timestamp,
-                   pm1, pm2_5, pm4, pm10, tsp
-            FROM dust_sensor_data
-            WHERE device_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """, (device_id,))
-        latest = cur.fetchone()
-
-        # Get average over past 15 minutes
-        cur.execute("""
-            SELECT AVG(pm1) as avg_pm1,
-                   AVG(pm2_5) as avg_pm2_5,
-                   AVG(pm4) as avg_pm4,
-                   AVG(pm10) as avg_pm10,
-                   AVG(tsp) as avg_tsp
-            FROM dust_sensor_data
-            WHERE device_id = %s AND timestamp >= NOW() - INTERVAL '15 minutes'
-        """, (device_id,))
-        avg_row = cur.fetchone()
-
-        # Get history for chart
-        cur.execute("""
-            SELECT (timestamp AT TIME ZONE 'UTC' AT TIME ZONE 'GMT') as time_bucket,
-                   pm1, pm2_5, pm4, pm10, tsp
-            FROM dust_sensor_data
-            WHERE device_id = %s AND timestamp >= NOW() - INTERVAL %s
-            ORDER BY time_bucket ASC
-        """, (device_id, f'{hours} hours'))
-        history_rows = cur.fetchall()
-
-        # Get thresholds
-        cur.execute("""
-            SELECT pm1, pm2_5, pm4, pm10, tsp, averaging_window
-            FROM dust_thresholds
-            WHERE device_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """, (device_id,))
-        t = cur.fetchone()
+        # Get latest sensor data (memory hit or a primary-key read)
+        latest_entry = LATEST_STORE.get(device_id) or {}
+        latest = latest_entry.get("sensor")
+
+        # Rolling averages over the device's averaging window and its thresholds, from the
+        # threshold engine's cache (a device's window is loaded once, then fed by each flush)
+        averages, t = THRESHOLD_ENGINE.evaluate(int(device_id))
+
+        # Get history for chart: only new raw rows for a cursor, else raw or time-bucketed avg/min/max
+        resolution = "raw"
+        if since and "latest_ms" in since:
+            history, sensor_id = fetch_pm_since(cur, device_id, hours, since)
+            extended_since, extended_id = fetch_extended_since(cur, int(device_id), hours, since)
+            cursor = make_cursor(sensor_id or since["sensor_id"], extended_id or since["extended_id"],
+                                 latest_reading_ms(latest_entry))
+        else:
+            # Taken before the history queries so rows committed meanwhile are picked up by the next poll
+            cursor = current_cursor(cur, int(device_id), hours, latest_reading_ms(latest_entry))
+            if since:
+                history, _ = fetch_pm_since(cur, device_id, hours, since)
+                extended_since, _ = fetch_extended_since(cur, int(device_id), hours, since)
+            else:
+                # Raw rows or a rollup tier, whichever is cheapest for the window and point budget
+                plan = plan_history(hours, max_points, bucket, rollups_ready=ROLLUPS.backfill_done())
+                resolution = plan.resolution
+                history = fetch_pm(cur, device_id, hours, plan)
+                if plan.resolution == "raw":
+                    # Raw windows reaching back into archived months are completed from the cold archive
+                    history = merge_history(ARCHIVE.pm_history(int(device_id), hours, plan.bucket_seconds), history)
+
         thresholds = {
             "pm1": t['pm1'] if t else 50,
-            "pm2.5": t['pm2_5'] if t else 75,
+            "pm2.5": t['pm2.5'] if t else 75,
             "pm4": t['pm4'] if t else 100,
             "pm10": t['pm10'] if t else 150,
             "tsp": t['tsp'] if t else 200,
@@ -1684,37 +1039,19 @@ def get_data():
                 "pm4": latest["pm4"] or 0,
                 "pm10": latest["pm10"] or 0,
                 "tsp": latest["tsp"] or 0,
-                "avg_pm1": avg_row["avg_pm1"] or 0,
-                "avg_pm2_5": avg_row["avg_pm2_5"] or 0,
-                "avg_pm4": avg_row["avg_pm4"] or 0,
-                "avg_pm10": avg_row["avg_pm10"] or 0,
-                "avg_tsp": avg_row["avg_tsp"] or 0
+                **{f"avg_{channel}": average or 0 for channel, average in zip(PM_CHANNELS, averages)}
             }
 
-        history = {
-            "timestamps": [r['time_bucket'].isoformat() for r in history_rows],
-            "pm1": [float(r['pm1'] or 0) for r in history_rows],
-            "pm2_5": [float(r['pm2_5'] or 0) for r in history_rows],
-            "pm4": [float(r['pm4'] or 0) for r in history_rows],
-            "pm10": [float(r['pm10'] or 0) for r in history_rows],
-            "tsp": [float(r['tsp'] or 0) for r in history_rows],
-        }
-
         # Get extended data and history
         logging.info(f"[API] Fetching extended data for device {device_id}")
         extended_row = None
-        extended_history_rows = []
+        extended_history = None
         
         try:
             # Get latest extended data
-            cur.execute("""
-                SELECT *
-                FROM dust_extended_data
-                WHERE device_id = %s
-                ORDER BY timestamp DESC
-                LIMIT 1
-            """, (int(device_id),))
-            extended_row = cur.fetchone()
+            extended_row = serialize_latest_part(latest_entry.get("extended"))
+            if extended_row:
+                extended_row["device_id"] = int(device_id)
             logging.info(f"[API] Extended row found: {extended_row is not None}")
             if extended_row:
                 logging.info(f"[API] Extended row data: temperature_c={extended_row.get('temperature_c')}, humidity_percent={extended_row.get('humidity_percent')}")
@@ -1723,19 +1060,14 @@ def get_data():
 
         try:
             # Get extended data history for charts - INCLUDE ALL PARAMETERS
-            cur.execute("""
-                SELECT (timestamp AT TIME ZONE 'UTC' AT TIME ZONE 'GMT') as timestamp,
-                       temperature_c, humidity_percent, pressure_hpa,
-                       voc_ppb, no2_ppb, noise_db, gps_speed_kmh, cloud_cover_percent,
-                       lux, uv_index, battery_percent
-                FROM dust_extended_data
-                WHERE device_id = %s AND timestamp >= NOW() - INTERVAL '%s hours'
-                ORDER BY timestamp ASC
-            """, (int(device_id), hours))
-            extended_history_rows = cur.fetchall()
-            logging.info(f"[API] Extended history rows: {len(extended_history_rows)}")
-            if extended_history_rows:
-                logging.info(f"[API] First extended history row: temperature_c={extended_history_rows[0].get('temperature_c')}, lux={extended_history_rows[0].get('lux')}")
+            if since:
+                extended_history = extended_since if extended_since["timestamps"] else None
+            else:
+                extended_history = fetch_extended(cur, int(device_id), hours, plan)
+                if plan.resolution == "raw":
+                    extended_history = merge_history(
+                        ARCHIVE.extended_history(int(device_id), hours, plan.bucket_seconds), extended_history)
+            logging.info(f"[API] Extended history points: {len(extended_history['timestamps']) if extended_history else 0}")
         except Exception as e:
             logging.error(f"[API] Error fetching extended history: {e}")
 
@@ -1747,7 +1079,9 @@ def get_data():
                 "relay_state": "OFF",
                 "thresholds": thresholds
             },
-            "history": history
+            "history": {**history, "resolution": resolution},
+            "cursor": cursor,
+            "incremental": since is not None
         }
 
         # Always include extended data if available
@@ -1758,22 +1092,9 @@ def get_data():
             logging.info(f"[API] Extended data keys: {list(response['extended'].keys())}")
 
         # Add extended history for charts if available
-        if extended_history_rows:
-            logging.info(f"[API] Adding extended history to response: {len(extended_history_rows)} rows")
-            response["history"]["extended"] = {
-                "timestamps": [row['timestamp'].isoformat() for row in extended_history_rows],
-                "temperature_c": [float(row['temperature_c'] or 0) for row in extended_history_rows],
-                "humidity_percent": [float(row['humidity_percent'] or 0) for row in extended_history_rows],
-                "pressure_hpa": [float(row['pressure_hpa'] or 0) for row in extended_history_rows],
-                "voc_ppb": [float(row['voc_ppb'] or 0) for row in extended_history_rows],
-                "no2_ppb": [float(row['no2_ppb'] or 0) for row in extended_history_rows],
-                "noise_db": [float(row['noise_db'] or 0) for row in extended_history_rows],
-                "gps_speed_kmh": [float(row['gps_speed_kmh'] or 0) for row in extended_history_rows],
-                "cloud_cover_percent": [float(row['cloud_cover_percent'] or 0) for row in extended_history_rows],
-                "lux": [float(row['lux'] or 0) for row in extended_history_rows],
-                "uv_index": [float(row['uv_index'] or 0) for row in extended_history_rows],
-                "battery_percent": [float(row['battery_percent'] or 0) for row in extended_history_rows]
-            }
+        if extended_history:
+            logging.info(f"[API] Adding extended history to response: {len(extended_history['timestamps'])} points")
+            response["history"]["extended"] = extended_history
 
         logging.info(f"[API] Final response keys: {list(response.keys())}")
         logging.info(f"[API] Response has extended: {'extended' in response}")
@@ -1846,6 +1167,9 @@ def update_thresholds():
             conn.commit()
 
             latest_data["status"]["thresholds"].update(validated)
+            if device_id:
+                THRESHOLD_ENGINE.set_thresholds(int(device_id), validated)
+                notify_ingest({"type": "thresholds", "device_id": int(device_id)})
             publish_thresholds(validated, device_id)
 
             logging.info(f"Thresholds updated for device {device_id}")
@@ -1896,12 +1220,9 @@ def relay_control():
                         "timestamp": datetime.now(timezone.utc).isoformat(),
                         "deviceid": device_id
                     }
-                    # Publish on a generic control topic if available
-                    for client in mqtt_clients.values():
-                        try:
-                            client.publish("dustrak/control", json.dumps(control_message), qos=1)
-                        except Exception:
-                            pass
+                    # Publish on a generic control topic if available (from the active ingester)
+                    notify_ingest({"type": "publish", "topic": "dustrak/control",
+                                   "payload": json.dumps(control_message), "broadcast": True})
                 except Exception:
                     pass
 
@@ -1927,25 +1248,25 @@ def relay_control():
         return jsonify({"success": False, "message": str(e)}), 500
 
 def publish_thresholds(thresholds, device_id):
-    """Publish thresholds to MQTT"""
-    if device_id in mqtt_clients and mqtt_clients[device_id].is_connected():
-        try:
-            message = {
-                "thresholds": {
-                    "pm1": float(thresholds.get("pm1")),
-                    "pm2.5": float(thresholds.get("pm2.5")),
-                    "pm4": float(thresholds.get("pm4")),
-                    "pm10": float(thresholds.get("pm10")),
-                    "tsp": float(thresholds.get("tsp"))
-                },
-                "averaging_window": int(thresholds.get("averaging_window", 15)),
-                "timestamp": datetime.now().isoformat(),
-                "deviceid": device_id
-            }
-            mqtt_clients[device_id].publish("dustrak/control", json.dumps(message), qos=1)
-            logging.info("Thresholds published to MQTT")
-        except Exception as e:
-            logging.error(f"Error publishing thresholds: {e}")
+    """Publish thresholds to MQTT (sent by the active ingester, which holds the broker connections)"""
+    try:
+        message = {
+            "thresholds": {
+                "pm1": float(thresholds.get("pm1")),
+                "pm2.5": float(thresholds.get("pm2.5")),
+                "pm4": float(thresholds.get("pm4")),
+                "pm10": float(thresholds.get("pm10")),
+                "tsp": float(thresholds.get("tsp"))
+            },
+            "averaging_window": int(thresholds.get("averaging_window", 15)),
+            "timestamp": datetime.now().isoformat(),
+            "deviceid": device_id
+        }
+        notify_ingest({"type": "publish", "device_id": device_id, "topic": "dustrak/control",
+                       "payload": json.dumps(message)})
+        logging.info("Thresholds published to MQTT")
+    except Exception as e:
+        logging.error(f"Error publishing thresholds: {e}")
 
 @app.route('/api/admin/users', methods=['GET'])
 @login_required
@@ -2067,25 +1388,24 @@ def get_device_locations():
     try:
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
+        # Last GPS fix per device comes from dust_device_latest (one row per device)
         if current_user.is_admin:
             cur.execute("""
-                SELECT DISTINCT ON (d.id)
-                    d.id, d.deviceid, COALESCE(d.name, d.deviceid) AS name, d.has_relay,
-                    ed.gps_lat, ed.gps_lon, ed.timestamp
+                SELECT d.id, d.deviceid, COALESCE(d.name, d.deviceid) AS name, d.has_relay,
+                       l.gps_lat, l.gps_lon, l.gps_timestamp AS timestamp
                 FROM dust_devices d
-                LEFT JOIN dust_extended_data ed ON ed.device_id = d.id
-                WHERE ed.gps_lat IS NOT NULL AND ed.gps_lon IS NOT NULL
-                ORDER BY d.id, ed.timestamp DESC
+                JOIN dust_device_latest l ON l.device_id = d.id
+                WHERE l.gps_lat IS NOT NULL AND l.gps_lon IS NOT NULL
+                ORDER BY d.id
             """)
         else:
             cur.execute("""
-                SELECT DISTINCT ON (d.id)
-                    d.id, d.deviceid, COALESCE(d.name, d.deviceid) AS name, d.has_relay,
-                    ed.gps_lat, ed.gps_lon, ed.timestamp
+                SELECT d.id, d.deviceid, COALESCE(d.name, d.deviceid) AS name, d.has_relay,
+                       l.gps_lat, l.gps_lon, l.gps_timestamp AS timestamp
                 FROM dust_devices d
-                LEFT JOIN dust_extended_data ed ON ed.device_id = d.id
-                WHERE d.user_id = %s AND ed.gps_lat IS NOT NULL AND ed.gps_lon IS NOT NULL
-                ORDER BY d.id, ed.timestamp DESC
+                JOIN dust_device_latest l ON l.device_id = d.id
+                WHERE d.user_id = %s AND l.gps_lat IS NOT NULL AND l.gps_lon IS NOT NULL
+                ORDER BY d.id
             """, (current_user.id,))
         rows = cur.fetchall()
         devices = []
@@ -2120,6 +1440,7 @@ def delete_user(user_id):
         cur.execute("DELETE FROM dust_devices WHERE user_id = %s", (user_id,))
         cur.execute("DELETE FROM dust_users WHERE id = %s", (user_id,))
         conn.commit()
+        invalidate_devices()
 
         return jsonify({"status": "success"})
     except Exception as e:
@@ -2178,7 +1499,7 @@ def stream():
 
 @app.route('/api/export_csv')
 def export_csv():
-    """Export sensor data as CSV"""
+    """Export sensor data as CSV, streamed in chunks as rows are read"""
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
     device_id = request.args.get('deviceid')
@@ -2251,26 +1572,16 @@ def export_csv():
             </body></html>
             """, 400)
 
-        # Query sensor data
-        cur.execute("""
-            SELECT timestamp, pm1, pm2_5, pm4, pm10, tsp
-            FROM dust_sensor_data
-            WHERE device_id = %s AND timestamp BETWEEN %s AND %s
-            ORDER BY timestamp ASC
-        """, (device_id, start_datetime, end_datetime))
-        sensor_data = cur.fetchall()
-
-        # Query extended data (without removed fields)
-        cur.execute("""
-            SELECT timestamp, temperature_c, humidity_percent, pressure_hpa,
-                   voc_ppb, no2_ppb, noise_db, gps_lat, gps_lon, lux, uv_index
-            FROM dust_extended_data
-            WHERE device_id = %s AND timestamp BETWEEN %s AND %s
-            ORDER BY timestamp ASC
-        """, (device_id, start_datetime, end_datetime))
-        extended_data = cur.fetchall()
-
-        if not sensor_data and not extended_data:
+        # Raw rows unless a coarser resolution or a point budget was requested
+        plan = plan_export(
+            (end_datetime - start_datetime).total_seconds() / 3600,
+            resolution=request.args.get('resolution'),
+            max_points=request.args.get('max_points', type=int),
+            rollups_ready=ROLLUPS.backfill_done(),
+        )
+        archived = ARCHIVE.export_rows(int(device_id), start_datetime, end_datetime) if plan.resolution == "raw" else None
+        if not (export_has_data(cur, device_id, start_datetime, end_datetime, plan)
+                or (archived and ARCHIVE.has_data(int(device_id), start_datetime, end_datetime))):
             return make_response(f"""
             <html><body>
             <h1>Export Error</h1>
@@ -2279,80 +1590,17 @@ def export_csv():
             </body></html>
             """, 404)
 
-        si = io.StringIO()
-        cw = csv.writer(si)
-
-        # Updated headers (removed unwanted fields)
-        headers = [
-            "Timestamp", "PM1", "PM2.5", "PM4", "PM10", "TSP",
-            "Temperature_C", "Humidity_%", "Pressure_hPa",
-            "VOC_ppb", "NO2_ppb", "Noise_db",
-            "GPS_Lat", "GPS_Lon", "Lux", "UV_Index"
-        ]
-        cw.writerow(headers)
-
-        # Merge data by timestamp
-        data_by_timestamp = {}
-
-        for row in sensor_data:
-            ts = row[0].isoformat()
-            data_by_timestamp[ts] = {
-                'pm1': row[1] or 0,
-                'pm2_5': row[2] or 0,
-                'pm4': row[3] or 0,
-                'pm10': row[4] or 0,
-                'tsp': row[5] or 0,
-                'temperature_c': None,
-                'humidity_percent': None,
-                'pressure_hpa': None,
-                'voc_ppb': None,
-                'no2_ppb': None,
-                'noise_db': None,
-                'gps_lat': None,
-                'gps_lon': None,
-                'lux': None,
-                'uv_index': None
-            }
-
-        for row in extended_data:
-            ts = row[0].isoformat()
-            if ts not in data_by_timestamp:
-                data_by_timestamp[ts] = {
-                    'pm1': 0, 'pm2_5': 0, 'pm4': 0, 'pm10': 0, 'tsp': 0,
-                    'temperature_c': None, 'humidity_percent': None, 'pressure_hpa': None,
-                    'voc_ppb': None, 'no2_ppb': None, 'noise_db': None,
-                    'gps_lat': None, 'gps_lon': None, 'lux': None, 'uv_index': None
-                }
-
-            data_by_timestamp[ts].update({
-                'temperature_c': row[1],
-                'humidity_percent': row[2],
-                'pressure_hpa': row[3],
-                'voc_ppb': row[4],
-                'no2_ppb': row[5],
-                'noise_db': row[6],
-                'gps_lat': row[7],
-                'gps_lon': row[8],
-                'lux': row[9],
-                'uv_index': row[10]
-            })
-
-        sorted_timestamps = sorted(data_by_timestamp.keys())
-        for ts in sorted_timestamps:
-            r = data_by_timestamp[ts]
-            cw.writerow([
-                ts, r['pm1'], r['pm2_5'], r['pm4'], r['pm10'], r['tsp'],
-                r['temperature_c'], r['humidity_percent'], r['pressure_hpa'],
-                r['voc_ppb'], r['no2_ppb'], r['noise_db'],
-                r['gps_lat'], r['gps_lon'], r['lux'], r['uv_index']
-            ])
-
-        output = make_response(si.getvalue())
+        # Rows are streamed from server-side cursors on a separate connection
         filename = f"dust_data_{device_id}_{start_date}_to_{end_date}.csv"
+        output = Response(
+            stream_csv(get_db_connection, put_db_connection, int(device_id), start_datetime, end_datetime,
+                       queries=export_sql(plan), archived=archived),
+            mimetype="text/csv",
+        )
         output.headers["Content-Disposition"] = f"attachment; filename={filename}"
         output.headers["Content-type"] = "text/csv; charset=utf-8"
 
-        logging.info(f"CSV exported: {filename} - {len(sorted_timestamps)} records")
+        logging.info(f"CSV export started: {filename} ({plan.resolution})")
         return output
 
     except Exception as e:
@@ -2386,6 +1634,14 @@ def handle_join(data):
         logging.info(f'Joined room: {room_name}')
         emit('message', {'status': f'Joined {room_name}'})
 
+        # One full snapshot for this client; the room then only receives deltas
+        device = DEVICE_REGISTRY.get(device_id)
+        if device:
+            try:
+                emit('snapshot', build_websocket_payload(device, LIVE_FEED.snapshot(device.id), delta=False))
+            except Exception as e:
+                logging.error(f"Error sending snapshot for device {device_id}: {e}")
+
 @socketio.on('leave')
 def handle_leave(data):
     device_id = data.get('device_id')
@@ -2415,8 +1671,29 @@ logging.info(f"[STARTUP]   PORT: {os.getenv('PORT', 'NOT SET')}")
 logging.info("[STARTUP] 🗄️ Initializing database...")
 initialize_database()
 
-logging.info("[STARTUP] 📡 Initializing MQTT clients...")
-initialize_mqtt_clients()
+logging.info("[STARTUP] 📇 Loading device registry...")
+DEVICE_REGISTRY.load()
+
+logging.info("[STARTUP] 🕒 Loading latest readings...")
+LATEST_STORE.load()
+
+logging.info("[STARTUP] 📈 Warm-starting threshold rolling windows...")
+try:
+    THRESHOLD_ENGINE.warm_start()
+except Exception as e:
+    logging.error(f"[STARTUP] Threshold warm start failed, windows will load on demand: {e}")
+
+logging.info("[STARTUP] 📣 Starting websocket emit scheduler...")
+EMIT_SCHEDULER.start()
+
+logging.info("[STARTUP] 🔔 Subscribing to ingest notifications...")
+INGEST_BUS.start()
+
+if INGEST_LEADER:
+    logging.info("[STARTUP] 👑 Campaigning for the ingest lock (collectors start once it is held)...")
+    INGEST_LEADER.start()
+else:
+    logging.info("[STARTUP] 📡 INGEST_IN_WEB=false: MQTT ingest runs in the ingest service")
 
 logging.info("[STARTUP] ✨ Railway Flask app ready!")
 
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Benchmark: MQTT payload parsing and decoding, without a database.
+
+Replays recorded compact-format payloads (one JSON message per line, e.g.
+captured with ``mosquitto_sub -t 'dustrak/+/data' > payloads.jsonl``) through
+each stage of the ingest hot path and prints messages/sec:
+
+* the old path: UTF-8 ``str`` copy, eager f-string payload log line, ``json.loads``;
+* stdlib ``json.loads`` straight from the bytes;
+* ``orjson.loads`` from the bytes (when installed);
+* ``payload_decoders.loads`` plus format match and fixed-slot decode;
+* the same payloads decoded in one batch into column arrays.
+
+Without ``--payloads`` a synthetic compact payload is used.
+
+    python bench_decode.py --payloads payloads.jsonl --messages 200000
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+from itertools import cycle, islice
+
+import payload_decoders
+from payload_decoders import COMPACT, default_registry
+
+SAMPLE_PAYLOAD = {
+    "i": "DT-0001", "t": "2025-06-01T12:00:00Z",
+    "e": [22.67, 33.87, 1012.49, 0.0, 0.44, 32044, 0.605, 66.23],
+    "pm": [1.2, 2.4, 3.1, 4.8, 6.0],
+    "g": {"lat": 51.5072, "lon": -0.1276},
+}
+
+
+def load_payloads(path):
+    """Raw payload bytes from a recorded file, or the synthetic sample"""
+    if not path:
+        return [json.dumps(SAMPLE_PAYLOAD).encode()]
+    with open(path, "rb") as f:
+        payloads = [line.strip() for line in f if line.strip()]
+    if not payloads:
+        raise SystemExit(f"No payloads in {path}")
+    return payloads
+
+
+def bench(label, messages, handle):
+    started = time.perf_counter()
+    for raw in messages:
+        handle(raw)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<34} {elapsed:8.3f} s  {len(messages) / elapsed:12.0f} msg/s")
+    return elapsed
+
+
+def old_path(raw):
+    """What handle_message did before: str copy, eager log formatting, json.loads"""
+    return f"[MQTT-1] Full payload: {raw}", json.loads(raw.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payloads', help='recorded payloads, one JSON message per line')
+    parser.add_argument('--messages', type=int, default=100000, help='messages to decode per run')
+    parser.add_argument('--topic', default='dustrak/bench/data', help='topic used for format matching')
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.payloads)
+    messages = list(islice(cycle(payloads), args.messages))
+    registry = default_registry()
+    received_at = datetime.now(timezone.utc)
+
+    def full_decode(raw):
+        payload = payload_decoders.loads(raw)
+        return registry.match(args.topic, payload).decode(payload, received_at)
+
+    print(f"Messages: {len(messages)} ({len(payloads)} distinct), JSON backend: {payload_decoders.JSON_BACKEND}")
+    baseline = bench("str + f-string log + json.loads", messages, old_path)
+    bench("json.loads(bytes)", messages, json.loads)
+    if payload_decoders.orjson is not None:
+        bench("orjson.loads(bytes)", messages, payload_decoders.orjson.loads)
+    decoded = bench("loads + match + decode", messages, full_decode)
+
+    started = time.perf_counter()
+    COMPACT.decode_columns([payload_decoders.loads(raw) for raw in messages], received_at)
+    columns = time.perf_counter() - started
+    print(f"{'loads + decode_columns':<34} {columns:8.3f} s  {len(messages) / columns:12.0f} msg/s")
+    print(f"Full decode vs old parse:          {baseline / decoded:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
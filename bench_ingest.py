@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Benchmark: per-message INSERT+COMMIT vs the batched ingest writer.
+
+Writes synthetic compact-format readings into TEMP copies of
+dust_sensor_data / dust_extended_data (nothing touches the real tables) and
+prints rows/sec for both strategies.
+
+    python bench_ingest.py --rows 5000 --batch 500
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+import psycopg2
+
+from ingest_writer import BatchWriter, EXTENDED_COLUMNS, SENSOR_COLUMNS
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+
+def connect():
+    if DATABASE_URL:
+        return psycopg2.connect(DATABASE_URL)
+    return psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        database=os.getenv('DB_NAME'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        port=os.getenv('DB_PORT', 5432)
+    )
+
+
+def make_rows(count):
+    """One extended row plus its mirrored sensor row per reading, like a compact payload"""
+    now = datetime.now(timezone.utc)
+    for i in range(count):
+        pm = [1.0 + i % 7, 2.0 + i % 11, 3.0, 4.0 + i % 5, 5.0]
+        extended = dict.fromkeys(EXTENDED_COLUMNS)
+        extended.update({
+            "device_id": 1, "timestamp": now,
+            "temperature_c": 22.67, "humidity_percent": 33.87, "pressure_hpa": 1012.49,
+            "voc_ppb": 32.044, "no2_ppb": 605.0, "noise_db": 66.23,
+            "pm1": pm[0], "pm2_5": pm[1], "pm4": pm[2], "pm10": pm[3], "tsp_um": pm[4],
+            "gps_lat": 51.5, "gps_lon": -0.12,
+        })
+        sensor = {
+            "timestamp": now, "device_id": 1, "data_source_id": 1,
+            "pm1": pm[0], "pm2_5": pm[1], "pm4": pm[2], "pm10": pm[3], "tsp": pm[4],
+        }
+        yield extended, sensor
+
+
+def create_temp_tables(conn):
+    cur = conn.cursor()
+    # Same table names as production so the writer's SQL runs unchanged;
+    # TEMP tables shadow the real ones for this session only.
+    cur.execute("CREATE TEMP TABLE dust_sensor_data (LIKE public.dust_sensor_data INCLUDING DEFAULTS)")
+    cur.execute("CREATE TEMP TABLE dust_extended_data (LIKE public.dust_extended_data INCLUDING DEFAULTS)")
+    conn.commit()
+
+
+def truncate(conn):
+    cur = conn.cursor()
+    cur.execute("TRUNCATE dust_sensor_data, dust_extended_data")
+    conn.commit()
+
+
+def bench_per_message(conn, rows):
+    """Baseline: what on_message did before, one INSERT pair and a COMMIT per reading"""
+    cur = conn.cursor()
+    ext_sql = f"INSERT INTO dust_extended_data ({', '.join(EXTENDED_COLUMNS)}) VALUES ({', '.join(['%s'] * len(EXTENDED_COLUMNS))})"
+    sensor_sql = f"INSERT INTO dust_sensor_data ({', '.join(SENSOR_COLUMNS)}) VALUES ({', '.join(['%s'] * len(SENSOR_COLUMNS))})"
+    started = time.perf_counter()
+    for extended, sensor in rows:
+        cur.execute(ext_sql, [extended[c] for c in EXTENDED_COLUMNS])
+        cur.execute(sensor_sql, [sensor[c] for c in SENSOR_COLUMNS])
+        conn.commit()
+    return time.perf_counter() - started
+
+
+def bench_batched(conn, rows, batch_size):
+    """Batched writer flushing every ``batch_size`` rows on a single connection"""
+    writer = BatchWriter(lambda: conn, lambda c: None, max_rows=batch_size)
+    started = time.perf_counter()
+    for extended, sensor in rows:
+        writer.add("dust_extended_data", extended)
+        writer.add("dust_sensor_data", sensor)
+        if len(writer._batch) >= batch_size:
+            writer.flush()
+    writer.flush()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000, help='readings to write per run')
+    parser.add_argument('--batch', type=int, default=500, help='batch size for the batched writer')
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        create_temp_tables(conn)
+        rows = list(make_rows(args.rows))
+        # Each reading is two table rows (extended + mirrored sensor)
+        table_rows = args.rows * 2
+
+        before = bench_per_message(conn, rows)
+        truncate(conn)
+        after = bench_batched(conn, rows, args.batch)
+
+        print(f"Readings: {args.rows} ({table_rows} table rows), batch size {args.batch}")
+        print(f"Per-message INSERT+COMMIT: {before:8.3f} s  {table_rows / before:10.0f} rows/s")
+        print(f"Batched writer:            {after:8.3f} s  {table_rows / after:10.0f} rows/s")
+        print(f"Speed-up:                  {before / after:8.1f}x")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,509 @@
+"""Cold archive of old raw telemetry in compressed columnar files.
+
+Closed months older than ``archive_after_days`` are moved out of Postgres,
+one file per (table, device, month) under ``<root>/<table>/<device_id>/YYYY-MM.pmc``.
+Each file stores every column as its own zlib-compressed little-endian array
+(timestamps as delta-encoded epoch microseconds, integers as int64 with a
+NULL sentinel, measurements as float64 with NaN for NULL), followed by a JSON
+footer with the column offsets and per-column min/max/null counts::
+
+    MAGIC | column 0 | column 1 | ... | footer JSON | footer length (u32) | MAGIC
+
+Files are written to a temporary name, fsynced and renamed, and only then are
+the archived rows deleted from the database in small batches, so a crash at
+any point leaves the rows in at least one place.  Rows that arrive late for an
+archived month are merged into its file on the next run (deduplicated by id).
+
+The web process reads these files, while the active ingester writes them and
+deletes the archived rows, so ``root`` must be storage every process mounts
+(a shared volume or network filesystem), never a container's local disk.
+Nothing is archived or deleted until the deployment says so with
+``shared=True`` (``ARCHIVE_SHARED=true``); until then raw retention also
+holds off, since it never expires rows past the archive watermark.
+
+Readers mmap the file, check the timestamp min/max in the footer before
+touching any column, and decompress only the columns they need.  Reads by
+``export_csv`` (raw exports) and ``/api/data`` (raw history windows) go
+through ``ColdArchive`` so archived months still show up; rollup tiers are not
+archived and keep serving coarser reads from the database.
+"""
+import array
+import bisect
+import heapq
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from psycopg2 import sql
+
+from csv_export import EXTENDED_EXPORT_COLUMNS
+from history_query import PM_SERIES, EXTENDED_SERIES
+from ingest_writer import TABLE_COLUMNS
+from measurements import EXTENDED_PM_COLUMNS
+from partitions import period_start, next_period
+from retention import delete_in_batches, DELETE_BATCH_ROWS
+from rollups import bucket_start
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PMCA"
+VERSION = 1
+SUFFIX = ".pmc"
+FOOTER_TAIL = struct.Struct("<I4s")
+NULL_INT = -(2 ** 63)
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+ARCHIVE_TABLES = tuple(TABLE_COLUMNS)
+INT_COLUMNS = ("id", "data_source_id", "payload_hash")
+FETCH_ROWS = 10000
+
+
+def archive_columns(table):
+    """Columns stored per row; device and month are implied by the file path"""
+    return ("id", "timestamp") + tuple(c for c in TABLE_COLUMNS[table] if c not in ("device_id", "timestamp"))
+
+
+def column_kind(name):
+    if name == "timestamp":
+        return "ts"
+    return "i8" if name in INT_COLUMNS else "f8"
+
+
+def _utc(ts):
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts
+
+
+def to_micros(ts):
+    return (_utc(ts) - EPOCH) // ONE_MICROSECOND
+
+
+def from_micros(us):
+    return EPOCH + timedelta(microseconds=us)
+
+
+def _encode(kind, values):
+    """(compressed bytes, footer stats) for one column"""
+    if kind == "ts":
+        micros = [to_micros(v) for v in values]
+        data = array.array("q", [b - a for a, b in zip([0] + micros, micros)])
+        present = micros
+    elif kind == "i8":
+        data = array.array("q", (NULL_INT if v is None else int(v) for v in values))
+        present = [int(v) for v in values if v is not None]
+    else:
+        data = array.array("d", (math.nan if v is None else float(v) for v in values))
+        present = [float(v) for v in values if v is not None]
+    if sys.byteorder != "little":
+        data.byteswap()
+    stats = {"min": min(present, default=None), "max": max(present, default=None),
+             "nulls": len(values) - len(present)}
+    return zlib.compress(data.tobytes(), 6), stats
+
+
+def _decode(kind, buffer):
+    data = array.array("d" if kind == "f8" else "q")
+    data.frombytes(zlib.decompress(buffer))
+    if sys.byteorder != "little":
+        data.byteswap()
+    if kind == "ts":
+        return list(itertools.accumulate(data))
+    return data
+
+
+def _to_value(kind, value):
+    if kind == "f8":
+        return None if math.isnan(value) else value
+    if kind == "i8":
+        return None if value == NULL_INT else value
+    return from_micros(value)
+
+
+def write_archive(path, meta, columns, values):
+    """Atomically write one archive file; ``values`` maps column -> list, rows in timestamp order"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    footer = dict(meta, version=VERSION, rows=len(values[columns[0]]), columns=[])
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        for name in columns:
+            kind = column_kind(name)
+            blob, stats = _encode(kind, values[name])
+            footer["columns"].append(dict(stats, name=name, kind=kind, offset=f.tell(), length=len(blob)))
+            f.write(blob)
+        encoded = json.dumps(footer, separators=(",", ":")).encode()
+        f.write(encoded)
+        f.write(FOOTER_TAIL.pack(len(encoded), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return footer
+
+
+class ArchiveFile:
+    """Memory-mapped reader for one archive file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        length, magic = FOOTER_TAIL.unpack_from(self._map, len(self._map) - FOOTER_TAIL.size)
+        if magic != MAGIC or self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an archive file")
+        end = len(self._map) - FOOTER_TAIL.size
+        self.footer = json.loads(self._map[end - length:end])
+        self.columns = {c["name"]: c for c in self.footer["columns"]}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def time_range(self):
+        """(first, last) timestamp from the footer, in epoch microseconds"""
+        stats = self.columns["timestamp"]
+        return stats["min"], stats["max"]
+
+    def overlaps(self, start_us, end_us):
+        first, last = self.time_range()
+        return first is not None and first <= end_us and last >= start_us
+
+    def column(self, name):
+        info = self.columns[name]
+        view = memoryview(self._map)[info["offset"]:info["offset"] + info["length"]]
+        try:
+            return _decode(info["kind"], view)
+        finally:
+            view.release()
+
+    def rows(self, columns, start_us=None, end_us=None):
+        """(timestamp, *values) tuples with ``start_us <= timestamp <= end_us``"""
+        stamps = self.column("timestamp")
+        lo = 0 if start_us is None else bisect.bisect_left(stamps, start_us)
+        hi = len(stamps) if end_us is None else bisect.bisect_right(stamps, end_us)
+        if lo >= hi:
+            return []
+        # Columns added to the table after a file was written read back as NULL
+        data = [(self.columns[c]["kind"], self.column(c)) if c in self.columns else ("i8", None)
+                for c in columns]
+        return [
+            (from_micros(stamps[i]),
+             *(None if values is None else _to_value(kind, values[i]) for kind, values in data))
+            for i in range(lo, hi)
+        ]
+
+
+def _bucketed(rows, channels, seconds, envelope):
+    """Average (and min/max) per epoch-aligned bucket, like the SQL bucketed history"""
+    buckets = {}
+    for ts, *values in rows:
+        entry = buckets.setdefault(bucket_start(ts, seconds), [[] for _ in channels])
+        for j, value in enumerate(values):
+            if value is not None:
+                entry[j].append(value)
+    history = {"timestamps": [b.isoformat() for b in sorted(buckets)]}
+    for j, c in enumerate(channels):
+        series = [buckets[b][j] for b in sorted(buckets)]
+        history[c] = [sum(v) / len(v) if v else 0.0 for v in series]
+        if envelope:
+            history.setdefault("min", {})[c] = [min(v) if v else 0.0 for v in series]
+            history.setdefault("max", {})[c] = [max(v) if v else 0.0 for v in series]
+    return history
+
+
+def _history(rows, channels, seconds=None, envelope=False):
+    if seconds:
+        return _bucketed(rows, channels, seconds, envelope)
+    history = {"timestamps": [r[0].isoformat() for r in rows]}
+    for j, c in enumerate(channels, start=1):
+        history[c] = [float(r[j] or 0) for r in rows]
+    return history
+
+
+def merge_history(older, newer):
+    """Prepend archived column arrays to a database history, keeping timestamp order"""
+    if not older or not older["timestamps"]:
+        return newer
+    if not newer or not newer["timestamps"]:
+        return {**(newer or {}), **older}
+    merged = dict(newer)
+    for key, value in older.items():
+        if isinstance(value, list):
+            merged[key] = value + newer.get(key, [])
+        elif isinstance(value, dict):
+            merged[key] = {c: value[c] + newer.get(key, {}).get(c, []) for c in value}
+    stamps = merged["timestamps"]
+    if any(a > b for a, b in zip(stamps, stamps[1:])):
+        # Late rows can leave the database with readings older than the archive's newest
+        order = sorted(range(len(stamps)), key=stamps.__getitem__)
+        for key, value in list(merged.items()):
+            if isinstance(value, list):
+                merged[key] = [value[i] for i in order]
+            elif isinstance(value, dict):
+                merged[key] = {c: [series[i] for i in order] for c, series in value.items()}
+    return merged
+
+
+class ColdArchive:
+    """Moves closed device-months to archive files and reads them back"""
+
+    def __init__(self, get_conn, put_conn, root, archive_after_days=None, interval_hours=24,
+                 batch_rows=DELETE_BATCH_ROWS, ready=None, shared=False):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.root = root
+        self.archive_after_days = archive_after_days
+        # Confirms that ``root`` is visible to every web and ingest process (see the module docstring)
+        self.shared = shared
+        self.interval_hours = interval_hours
+        self.batch_rows = batch_rows
+        # Nothing is archived until this is true (rows must not leave the database mid-backfill)
+        self.ready = ready
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"files_written": 0, "rows_archived": 0, "rows_deleted": 0, "files_read": 0,
+                      "errors": 0, "archived_before": self._load_watermark(), "last_run": None}
+
+    @property
+    def enabled(self):
+        return bool(self.archive_after_days)
+
+    # -- layout --
+
+    def path(self, table, device_id, month):
+        return os.path.join(self.root, table, str(int(device_id)), f"{month:%Y-%m}{SUFFIX}")
+
+    def _watermark_path(self):
+        return os.path.join(self.root, "watermark.json")
+
+    def _load_watermark(self):
+        try:
+            with open(self._watermark_path()) as f:
+                return json.load(f)["archived_before"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def archived_before(self):
+        """Every closed month before this time has been archived (None until the first full run)"""
+        value = self.stats["archived_before"]
+        return datetime.fromisoformat(value) if value else None
+
+    def files(self, table, device_id, start, end):
+        """Archive files for a device whose month overlaps [start, end], oldest first"""
+        directory = os.path.join(self.root, table, str(int(device_id)))
+        try:
+            names = sorted(n for n in os.listdir(directory) if n.endswith(SUFFIX))
+        except FileNotFoundError:
+            return []
+        start, end = _utc(start), _utc(end)
+        paths = []
+        for name in names:
+            month = datetime.strptime(name[:-len(SUFFIX)], "%Y-%m").replace(tzinfo=timezone.utc)
+            if month <= end and next_period(month, "month") > start:
+                paths.append(os.path.join(directory, name))
+        return paths
+
+    # -- reads --
+
+    def read_rows(self, table, device_id, start, end, columns):
+        """Archived (timestamp, *columns) rows for [start, end] in timestamp order"""
+        start_us, end_us = to_micros(start), to_micros(end)
+        for path in self.files(table, device_id, start, end):
+            with ArchiveFile(path) as archive:
+                if not archive.overlaps(start_us, end_us):
+                    continue
+                self.stats["files_read"] += 1
+                yield from archive.rows(columns, start_us, end_us)
+
+    def has_data(self, device_id, start, end):
+        start_us, end_us = to_micros(start), to_micros(end)
+        for table in ARCHIVE_TABLES:
+            for path in self.files(table, device_id, start, end):
+                with ArchiveFile(path) as archive:
+                    if archive.overlaps(start_us, end_us):
+                        return True
+        return False
+
+    def pm_rows(self, device_id, start, end):
+        """Archived PM readings from both tables, like the ``dust_pm_readings`` view"""
+        sensor = self.read_rows("dust_sensor_data", device_id, start, end, PM_SERIES + ("payload_hash",))
+        extended = (row for row in self.read_rows("dust_extended_data", device_id, start, end,
+                                                  EXTENDED_PM_COLUMNS + ("payload_hash",))
+                    if any(v is not None for v in row[1:-1]))
+        current, seen = None, set()
+        for row in heapq.merge(sensor, extended, key=lambda row: row[0]):
+            if row[0] != current:
+                current, seen = row[0], set()
+            # The writer's reading key (device and timestamp are fixed here); rows stored without a
+            # hash only match an identical row, like a compact reading mirrored into both tables
+            # in months archived before the mirror cleanup
+            key = row[-1] if row[-1] is not None else row[1:-1]
+            if key not in seen:
+                seen.add(key)
+                yield row[:-1]
+
+    def export_rows(self, device_id, start, end):
+        """(sensor rows, extended rows) in the raw export's column layout"""
+        return (self.pm_rows(device_id, start, end),
+                self.read_rows("dust_extended_data", device_id, start, end, EXTENDED_EXPORT_COLUMNS))
+
+    def _window(self, hours):
+        end = datetime.now(timezone.utc)
+        return end - timedelta(hours=hours), end
+
+    def pm_history(self, device_id, hours, bucket_seconds=None):
+        """Archived part of a raw PM history window, shaped like ``fetch_pm_history``"""
+        start, end = self._window(hours)
+        rows = list(self.pm_rows(device_id, start, end))
+        return _history(rows, PM_SERIES, bucket_seconds, envelope=True) if rows else None
+
+    def extended_history(self, device_id, hours, bucket_seconds=None):
+        start, end = self._window(hours)
+        rows = list(self.read_rows("dust_extended_data", device_id, start, end, EXTENDED_SERIES))
+        return _history(rows, EXTENDED_SERIES, bucket_seconds) if rows else None
+
+    # -- archiving --
+
+    def archive_device_month(self, table, device_id, month):
+        """Archive one device-month and delete it from ``table``; returns rows archived"""
+        end = next_period(month, "month")
+        columns = archive_columns(table)
+        values = {c: [] for c in columns}
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor(name=f"archive_{table}_{device_id}")
+            cur.itersize = FETCH_ROWS
+            cur.execute(sql.SQL("""
+                SELECT {} FROM {}
+                WHERE device_id = %s AND timestamp >= %s AND timestamp < %s
+                ORDER BY timestamp, id
+            """).format(sql.SQL(", ").join(map(sql.Identifier, columns)), sql.Identifier(table)),
+                (device_id, month, end))
+            for row in cur:
+                for name, value in zip(columns, row):
+                    values[name].append(value)
+            cur.close()
+            conn.commit()
+            if not values["id"]:
+                return 0
+            max_id = max(values["id"])
+            count = len(values["id"])
+
+            path = self.path(table, device_id, month)
+            if os.path.exists(path):
+                values = self._merge_existing(path, columns, values)
+            write_archive(path, {"table": table, "device_id": int(device_id), "month": f"{month:%Y-%m}"},
+                          columns, values)
+            self.stats["files_written"] += 1
+            self.stats["rows_archived"] += count
+
+            deleted = delete_in_batches(
+                conn, table, ("id", "timestamp"), "timestamp", end,
+                "device_id = %(device_id)s AND timestamp >= %(start)s AND id <= %(max_id)s",
+                {"device_id": device_id, "start": month, "max_id": max_id},
+                self.batch_rows, self._stop,
+            )
+            self.stats["rows_deleted"] += deleted
+            logger.info(f"[ARCHIVE] {table} device {device_id} {month:%Y-%m}: "
+                        f"archived {count} rows, deleted {deleted}")
+            return count
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    @staticmethod
+    def _merge_existing(path, columns, values):
+        """Union of an existing file and new rows, by id, in timestamp order"""
+        with ArchiveFile(path) as archive:
+            old = archive.rows([c for c in columns if c != "timestamp"])
+        by_id = {}
+        for ts, *rest in old:
+            row = dict(zip([c for c in columns if c != "timestamp"], rest), timestamp=ts)
+            by_id[row["id"]] = row
+        for i in range(len(values["id"])):
+            by_id[values["id"][i]] = {c: values[c][i] for c in columns}
+        rows = sorted(by_id.values(), key=lambda r: (r["timestamp"], r["id"]))
+        return {c: [r[c] for r in rows] for c in columns}
+
+    def run_once(self):
+        if not self.shared:
+            logger.error(f"[ARCHIVE] {self.root} is not confirmed as shared storage (ARCHIVE_SHARED=true); "
+                         "nothing archived or deleted")
+            return
+        if self.ready and not self.ready():
+            logger.info("[ARCHIVE] Backfills still running; archiving skipped this run")
+            return
+        now = datetime.now(timezone.utc)
+        cutoff = period_start(now - timedelta(days=self.archive_after_days), "month")
+        complete = True
+        for table in ARCHIVE_TABLES:
+            conn = None
+            try:
+                conn = self.get_conn()
+                cur = conn.cursor()
+                cur.execute(sql.SQL("""
+                    SELECT device_id, date_trunc('month', timestamp AT TIME ZONE 'UTC')
+                    FROM {} WHERE timestamp < %s AND device_id IS NOT NULL
+                    GROUP BY 1, 2 ORDER BY 2, 1
+                """).format(sql.Identifier(table)), (cutoff,))
+                pending = cur.fetchall()
+                conn.commit()
+            finally:
+                if conn:
+                    self.put_conn(conn)
+            for device_id, month in pending:
+                if self._stop.is_set():
+                    return
+                try:
+                    self.archive_device_month(table, device_id, month.replace(tzinfo=timezone.utc))
+                except Exception as e:
+                    complete = False
+                    self.stats["errors"] += 1
+                    logger.error(f"[ARCHIVE] Failed to archive {table} device {device_id} {month:%Y-%m}: {e}")
+        self.stats["last_run"] = now.isoformat()
+        if complete:
+            self.stats["archived_before"] = cutoff.isoformat()
+            os.makedirs(self.root, exist_ok=True)
+            with open(self._watermark_path(), "w") as f:
+                json.dump({"archived_before": cutoff.isoformat()}, f)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"[ARCHIVE] Run failed: {e}")
+            self._stop.wait(self.interval_hours * 3600)
+
+    def start(self):
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="ColdArchive")
+        self._thread.start()
+        logger.info(f"[ARCHIVE] Archiving months older than {self.archive_after_days} days to {self.root}")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
@@ -0,0 +1,172 @@
+"""Streaming CSV export of a device's PM and extended history.
+
+Both tables are read through named (server-side) cursors in timestamp order
+and merged in a single pass, so memory stays bounded by ``itersize`` and the
+chunk size regardless of the date range, and the first bytes reach the client
+as soon as the first rows arrive.  Rows with the same timestamp in both tables
+are combined into one CSV line, as the old dict-based export did.  Coarser
+exports read bucket averages from a rollup tier chosen by ``query_planner``.
+Rows moved to the cold archive can be passed in as ``archived`` and are merged
+into the same ordered streams.
+"""
+import csv
+import heapq
+import io
+import logging
+
+from measurements import PM_VIEW
+
+logger = logging.getLogger(__name__)
+
+EXPORT_HEADERS = [
+    "Timestamp", "PM1", "PM2.5", "PM4", "PM10", "TSP",
+    "Temperature_C", "Humidity_%", "Pressure_hPa",
+    "VOC_ppb", "NO2_ppb", "Noise_db",
+    "GPS_Lat", "GPS_Lon", "Lux", "UV_Index",
+]
+
+# PM comes from the combined view, so extended devices' readings are exported once
+SENSOR_EXPORT_SQL = f"""
+    SELECT timestamp, pm1, pm2_5, pm4, pm10, tsp
+    FROM {PM_VIEW}
+    WHERE device_id = %s AND timestamp BETWEEN %s AND %s
+    ORDER BY timestamp ASC
+"""
+
+EXTENDED_EXPORT_SQL = """
+    SELECT timestamp, temperature_c, humidity_percent, pressure_hpa,
+           voc_ppb, no2_ppb, noise_db, gps_lat, gps_lon, lux, uv_index
+    FROM dust_extended_data
+    WHERE device_id = %s AND timestamp BETWEEN %s AND %s
+    ORDER BY timestamp ASC
+"""
+
+HAS_DATA_SQL = """
+    SELECT EXISTS (SELECT 1 FROM {sensor} WHERE device_id = %(device_id)s
+                   AND {column} BETWEEN %(start)s AND %(end)s)
+        OR EXISTS (SELECT 1 FROM {extended} WHERE device_id = %(device_id)s
+                   AND {column} BETWEEN %(start)s AND %(end)s)
+"""
+
+# Export columns after the timestamp, per source table; GPS fixes are not rolled up
+SENSOR_EXPORT_COLUMNS = ("pm1", "pm2_5", "pm4", "pm10", "tsp")
+EXTENDED_EXPORT_COLUMNS = ("temperature_c", "humidity_percent", "pressure_hpa",
+                           "voc_ppb", "no2_ppb", "noise_db", "gps_lat", "gps_lon", "lux", "uv_index")
+NOT_ROLLED_UP = ("gps_lat", "gps_lon")
+
+
+def rollup_export_sql(table, columns, bucket_seconds):
+    """Bucket averages from a rollup tier, in the same column layout as the raw export"""
+    averages = ", ".join(
+        "NULL::double precision" if c in NOT_ROLLED_UP else f"SUM({c}_sum) / NULLIF(SUM({c}_count), 0)"
+        for c in columns
+    )
+    seconds = int(bucket_seconds)
+    return f"""
+    SELECT to_timestamp(floor(extract(epoch FROM bucket) / {seconds}) * {seconds}) AS timestamp, {averages}
+    FROM {table}
+    WHERE device_id = %s AND bucket BETWEEN %s AND %s
+    GROUP BY 1
+    ORDER BY 1 ASC
+"""
+
+# Placeholders when only one table has a row for a timestamp
+EMPTY_SENSOR = (0, 0, 0, 0, 0)
+EMPTY_EXTENDED = (None,) * 10
+
+ITERSIZE = 2000
+CHUNK_ROWS = 1000
+
+
+def export_queries(rollup_tables=None, bucket_seconds=None):
+    """(sensor SQL, extended SQL) for raw rows, or for a (sensor, extended) pair of rollup tables"""
+    if rollup_tables is None:
+        return SENSOR_EXPORT_SQL, EXTENDED_EXPORT_SQL
+    sensor_table, extended_table = rollup_tables
+    return (rollup_export_sql(sensor_table, SENSOR_EXPORT_COLUMNS, bucket_seconds),
+            rollup_export_sql(extended_table, EXTENDED_EXPORT_COLUMNS, bucket_seconds))
+
+
+def has_export_data(cur, device_id, start, end, rollup_tables=None):
+    """Cheap index probe so an empty range can still get a proper 404"""
+    if rollup_tables is None:
+        query = HAS_DATA_SQL.format(sensor=PM_VIEW, extended="dust_extended_data", column="timestamp")
+    else:
+        query = HAS_DATA_SQL.format(sensor=rollup_tables[0], extended=rollup_tables[1], column="bucket")
+    cur.execute(query, {"device_id": device_id, "start": start, "end": end})
+    return cur.fetchone()[0]
+
+
+def merge_by_timestamp(sensor_rows, extended_rows):
+    """Merge two timestamp-ordered row streams into (timestamp, pm values, extended values).
+
+    Equal timestamps collapse into one record; if a table repeats a timestamp
+    its last row wins.
+    """
+    sensor_rows, extended_rows = iter(sensor_rows), iter(extended_rows)
+    s = next(sensor_rows, None)
+    e = next(extended_rows, None)
+    while s is not None or e is not None:
+        if e is None or (s is not None and s[0] <= e[0]):
+            ts = s[0]
+        else:
+            ts = e[0]
+        pm, ext = None, None
+        while s is not None and s[0] == ts:
+            pm = tuple(v or 0 for v in s[1:])
+            s = next(sensor_rows, None)
+        while e is not None and e[0] == ts:
+            ext = tuple(e[1:])
+            e = next(extended_rows, None)
+        yield ts, pm or EMPTY_SENSOR, ext or EMPTY_EXTENDED
+
+
+def _by_timestamp(row):
+    return row[0]
+
+
+def stream_csv(get_conn, put_conn, device_id, start, end, queries=None,
+               chunk_rows=CHUNK_ROWS, itersize=ITERSIZE, archived=None):
+    """Generator of CSV text chunks; the connection is held only while streaming.
+
+    ``archived`` is an optional (sensor rows, extended rows) pair of ordered
+    iterables in the export column layout, e.g. from ``ColdArchive.export_rows``.
+    """
+    sensor_sql, extended_sql = queries or export_queries()
+    conn = None
+    records = 0
+    try:
+        conn = get_conn()
+        sensor_cur = conn.cursor(name=f"export_sensor_{device_id}")
+        extended_cur = conn.cursor(name=f"export_extended_{device_id}")
+        sensor_cur.itersize = itersize
+        extended_cur.itersize = itersize
+        sensor_cur.execute(sensor_sql, (device_id, start, end))
+        extended_cur.execute(extended_sql, (device_id, start, end))
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_HEADERS)
+        pending = 0
+        sensor_rows, extended_rows = sensor_cur, extended_cur
+        if archived is not None:
+            sensor_rows = heapq.merge(archived[0], sensor_cur, key=_by_timestamp)
+            extended_rows = heapq.merge(archived[1], extended_cur, key=_by_timestamp)
+        for ts, pm, ext in merge_by_timestamp(sensor_rows, extended_rows):
+            writer.writerow((ts.isoformat(), *pm, *ext))
+            records += 1
+            pending += 1
+            if pending >= chunk_rows:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+        yield buffer.getvalue()
+        logger.info(f"CSV exported for device {device_id}: {records} records")
+    except Exception as e:
+        # Headers are already sent, so the best we can do is log and end the stream
+        logger.error(f"Error streaming CSV for device {device_id} after {records} records: {e}")
+        raise
+    finally:
+        if conn:
+            put_conn(conn)
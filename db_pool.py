@@ -0,0 +1,239 @@
+"""Thread- and greenlet-safe PostgreSQL connection pool with metrics.
+
+Replaces psycopg2's ``SimpleConnectionPool``, which is not safe to share
+between the MQTT worker threads and the request greenlets.  Checkout blocks
+(up to ``checkout_timeout`` seconds) when every connection is in use instead
+of raising immediately, idle connections are health-checked before they are
+handed out, and every connection runs with a server-side
+``statement_timeout``.
+
+Typical use::
+
+    with DB_POOL.connection() as conn:
+        cur = conn.cursor()
+        ...
+
+Under ``eventlet.monkey_patch()`` the ingest workers and the writer thread are
+green threads sharing one OS thread with the MQTT loop and Socket.IO, and
+psycopg2's C code blocks that thread while it waits on the server.
+``make_psycopg_green()`` installs a wait callback that polls the connection
+and yields to the eventlet hub instead, so queries only block the green
+thread that runs them.
+"""
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the checkout wait-time histogram buckets; the last bucket is open-ended
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+def db_config_from_env():
+    """Connection settings from DATABASE_URL (Railway) or the individual DB_* variables"""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        parsed = urllib.parse.urlparse(database_url)
+        return {
+            "host": parsed.hostname,
+            "database": parsed.path.lstrip('/'),
+            "user": parsed.username,
+            "password": parsed.password,
+            "port": parsed.port or 5432
+        }
+    return {
+        "host": os.getenv('DB_HOST'),
+        "database": os.getenv('DB_NAME'),
+        "user": os.getenv('DB_USER'),
+        "password": os.getenv('DB_PASSWORD'),
+        "port": int(os.getenv('DB_PORT', 5432))
+    }
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection became available within the checkout timeout"""
+
+
+class ConnectionPool:
+    """Bounded pool of psycopg2 connections guarded by a condition variable"""
+
+    def __init__(self, minconn, maxconn, checkout_timeout=10.0, statement_timeout_ms=30000,
+                 health_check_after=30.0, **dsn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.statement_timeout_ms = statement_timeout_ms
+        self.health_check_after = health_check_after
+        self.dsn = dsn
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, returned_at)]
+        self._in_use = set()
+        self._waiting = 0
+        self._stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "max_wait_ms": 0.0,
+        }
+        self._wait_histogram = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        options = f"-c statement_timeout={int(self.statement_timeout_ms)}" if self.statement_timeout_ms else None
+        conn = psycopg2.connect(options=options, **self.dsn)
+        self._stats["connections_opened"] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._stats["connections_closed"] += 1
+
+    def _healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.health_check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"[DB-POOL] Discarding broken connection: {e}")
+            return False
+
+    def getconn(self, timeout=None):
+        """Check out a connection, waiting up to ``timeout`` seconds for one to be returned"""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            self._waiting += 1
+            try:
+                while not self._idle and len(self._in_use) >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available after {timeout:.1f}s "
+                            f"({len(self._in_use)} in use, {self._waiting} waiting)")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+            idle = self._idle.pop() if self._idle else None
+            # Reserve the slot before doing any network I/O outside the lock
+            placeholder = object()
+            self._in_use.add(placeholder)
+
+        try:
+            conn = None
+            if idle is not None:
+                conn, returned_at = idle
+                if not self._healthy(conn, time.monotonic() - returned_at):
+                    self._stats["health_check_failures"] += 1
+                    self._close(conn)
+                    conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use.discard(placeholder)
+                self._cond.notify()
+            raise
+
+        waited_ms = (time.monotonic() - started) * 1000
+        with self._cond:
+            self._in_use.discard(placeholder)
+            self._in_use.add(conn)
+            self._stats["checkouts"] += 1
+            self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], round(waited_ms, 2))
+            self._wait_histogram[bisect_left(WAIT_BUCKETS_MS, waited_ms)] += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Return a connection; any open transaction is rolled back first"""
+        if not close and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                close = True
+        with self._cond:
+            if conn not in self._in_use:
+                logger.warning("[DB-POOL] Returned a connection that was not checked out")
+                return
+            self._in_use.discard(conn)
+            if close or conn.closed or len(self._idle) >= self.maxconn:
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that always returns the connection, rolling back on error"""
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            self.putconn(conn)
+
+    def metrics(self):
+        with self._cond:
+            histogram = {f"le_{bound}ms": count for bound, count in zip(WAIT_BUCKETS_MS, self._wait_histogram)}
+            histogram["gt_%dms" % WAIT_BUCKETS_MS[-1]] = self._wait_histogram[-1]
+            return {
+                "max_connections": self.maxconn,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                **self._stats,
+                "wait_histogram": histogram,
+            }
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                self._close(conn)
+            self._idle = []
+
+
+def make_psycopg_green():
+    """Make every psycopg2 wait cooperative with the eventlet hub (call once, after monkey patching)"""
+    from eventlet.hubs import trampoline
+
+    def wait_callback(conn, timeout=-1):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                break
+            elif state == extensions.POLL_READ:
+                trampoline(conn.fileno(), read=True)
+            elif state == extensions.POLL_WRITE:
+                trampoline(conn.fileno(), write=True)
+            else:
+                raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+
+    extensions.set_wait_callback(wait_callback)
+    logger.info("[DB-POOL] psycopg2 waits yield to the eventlet hub")
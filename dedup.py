@@ -0,0 +1,91 @@
+"""Duplicate suppression for QoS 1 redeliveries.
+
+Brokers redeliver unacknowledged QoS 1 messages after a reconnect, so the
+same reading can arrive more than once.  ``RecentKeys`` remembers the last
+``per_device`` (timestamp, payload hash) keys of each device and lets the
+pipeline drop a repeat before it is queued for the writer.  It is a
+``BatchWriter`` stage and only remembers the keys of rows once their flush has
+committed: a flush that fails is retried or quarantined, and the broker's
+redelivery of those messages must not be mistaken for a duplicate.  Memory is
+bounded by ``per_device * max_devices`` keys; the least recently seen devices
+are evicted first.
+
+The in-memory check is only a fast path: it forgets keys across restarts.
+The database enforces the same identity with a unique ``(device_id,
+timestamp, payload_hash)`` index on the reading tables (see ``partitions``),
+and the batch writer inserts with ``ON CONFLICT DO NOTHING``, so replays and
+retries never add rows twice.  Only rows stamped with the device's own
+timestamp carry a ``payload_hash``; rows stamped with the server time leave
+it NULL and are never treated as duplicates (NULLs never conflict), and two
+different readings that share a device timestamp (a stuck RTC, a
+second-resolution clock) differ in their hash and are both kept.
+"""
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+from ingest_writer import READING_KEY_COLUMNS, TABLE_COLUMNS
+
+DEFAULT_KEYS_PER_DEVICE = 256
+DEFAULT_MAX_DEVICES = 10000
+
+
+def payload_hash(raw_payload):
+    """64-bit hash of a raw MQTT payload, signed to fit a BIGINT column"""
+    return int.from_bytes(hashlib.blake2b(raw_payload, digest_size=8).digest(), "big", signed=True)
+
+
+class RecentKeys:
+    """Bounded per-device set of recently ingested message keys"""
+
+    def __init__(self, per_device=DEFAULT_KEYS_PER_DEVICE, max_devices=DEFAULT_MAX_DEVICES):
+        self.per_device = per_device
+        self.max_devices = max_devices
+        self._lock = threading.Lock()
+        # device -> (keys in arrival order, the same keys as a set)
+        self._devices = OrderedDict()
+        self.stats = {"checked": 0, "duplicates": 0}
+
+    def seen(self, device, timestamp, digest):
+        """True if this reading (``digest`` from ``payload_hash``) has already been written"""
+        with self._lock:
+            self.stats["checked"] += 1
+            entry = self._devices.get(device)
+            if entry is not None and (timestamp, digest) in entry[1]:
+                self.stats["duplicates"] += 1
+                return True
+            return False
+
+    def _remember(self, device, timestamp, digest):
+        key = (timestamp, digest)
+        entry = self._devices.get(device)
+        if entry is None:
+            entry = self._devices[device] = (deque(), set())
+            if len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        else:
+            self._devices.move_to_end(device)
+        order, keys = entry
+        if key in keys:
+            return
+        order.append(key)
+        keys.add(key)
+        if len(order) > self.per_device:
+            keys.discard(order.popleft())
+
+    def write(self, cur, batch):
+        """Reading keys of the flushed rows that carry a hash (only ones that were inserted remain)"""
+        keys = []
+        for table, rows in batch.rows.items():
+            indexes = [TABLE_COLUMNS[table].index(c) for c in READING_KEY_COLUMNS]
+            keys.extend(key for key in (tuple(values[i] for i in indexes) for values in rows)
+                        if key[-1] is not None)
+        return keys
+
+    def after_commit(self, batch, keys):
+        with self._lock:
+            for device, timestamp, digest in keys:
+                self._remember(device, timestamp, digest)
+
+    def metrics(self):
+        return {**self.stats, "devices": len(self._devices)}
@@ -0,0 +1,106 @@
+"""Process-wide cache of dust_devices for the ingest and emit hot paths.
+
+The registry loads every device once and answers lookups from dicts, so
+resolving ``(deviceid, data_source_id)`` or a database id costs no query.
+Admin routes that change devices call ``invalidate()``; the next lookup
+reloads the table.  Unknown devices are remembered for ``negative_ttl``
+seconds so a misconfigured sensor does not hit the database per message.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+DeviceInfo = namedtuple("DeviceInfo", "id deviceid data_source_id user_id has_relay")
+
+
+class DeviceRegistry:
+    """In-memory index of dust_devices keyed by (deviceid, data_source_id), id and deviceid"""
+
+    def __init__(self, get_conn, put_conn, negative_ttl=300):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._by_key = {}
+        self._by_id = {}
+        self._by_deviceid = {}
+        self._unknown = {}
+        self._stale = True
+        self.stats = {"loads": 0, "hits": 0, "misses": 0, "negative_hits": 0}
+
+    @staticmethod
+    def _key(deviceid, data_source_id):
+        return str(deviceid), int(data_source_id) if data_source_id is not None else None
+
+    def load(self):
+        """(Re)load all devices from the database and swap the indexes in atomically"""
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute("SELECT id, deviceid, data_source_id, user_id, has_relay FROM dust_devices")
+            rows = cur.fetchall()
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+        by_key, by_id, by_deviceid = {}, {}, {}
+        for row in rows:
+            info = DeviceInfo(row[0], str(row[1]), row[2], row[3], bool(row[4]))
+            by_key[self._key(info.deviceid, info.data_source_id)] = info
+            by_id[info.id] = info
+            by_deviceid.setdefault(info.deviceid, info)
+
+        with self._lock:
+            self._by_key, self._by_id, self._by_deviceid = by_key, by_id, by_deviceid
+            self._unknown = {}
+            self._stale = False
+            self.stats["loads"] += 1
+        logger.info(f"[REGISTRY] Loaded {len(by_id)} devices")
+
+    def invalidate(self):
+        """Mark the cache stale; called by the admin device/user/data-source routes"""
+        with self._lock:
+            self._stale = True
+            self._unknown = {}
+
+    def _ensure_loaded(self):
+        if self._stale:
+            self.load()
+
+    def lookup(self, deviceid, data_source_id):
+        """Resolve a device reported on a data source, or None if it is not registered"""
+        self._ensure_loaded()
+        key = self._key(deviceid, data_source_id)
+        info = self._by_key.get(key)
+        if info:
+            self.stats["hits"] += 1
+            return info
+
+        expires = self._unknown.get(key)
+        if expires and expires > time.monotonic():
+            self.stats["negative_hits"] += 1
+            return None
+
+        self.stats["misses"] += 1
+        with self._lock:
+            self._unknown[key] = time.monotonic() + self.negative_ttl
+        logger.warning(f"[REGISTRY] Unknown device {deviceid} on data source {data_source_id} "
+                       f"({len(self._by_key)} devices registered)")
+        return None
+
+    def lookup_deviceid(self, deviceid):
+        """Resolve a device by its hardware id alone (status topic carries no data source)"""
+        self._ensure_loaded()
+        return self._by_deviceid.get(str(deviceid))
+
+    def get(self, device_id):
+        """Resolve a device by its dust_devices.id"""
+        self._ensure_loaded()
+        try:
+            return self._by_id.get(int(device_id))
+        except (TypeError, ValueError):
+            return None
@@ -0,0 +1,83 @@
+"""Per-room coalescing and rate limiting for Socket.IO emits.
+
+Ingest marks a room dirty with a *builder* (a callable returning the payload,
+or None for nothing to send) instead of emitting straight away.  A background
+task ticks at ``max_rate_hz``; each tick calls the latest builder of every
+dirty room once and emits the result once, so a device bursting 50 messages a
+second still costs its viewers at most ``max_rate_hz`` payloads per event, and
+the payload is built (and encoded by python-socketio) once per tick rather
+than once per message.  Rooms with no connected members are skipped before
+any work is done.
+
+Membership is read from the local Socket.IO manager, so each web worker only
+emits to the clients connected to it; every worker gets the ingest updates
+from the ingest bus (see ``ingest_bus``) and fans them out to its own rooms.
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RATE_HZ = 2.0
+
+
+class EmitScheduler:
+    """Latest-wins emit queue keyed by (room, event), drained at a fixed rate"""
+
+    def __init__(self, socketio, max_rate_hz=DEFAULT_MAX_RATE_HZ, namespace="/"):
+        self.socketio = socketio
+        self.interval = 1.0 / max_rate_hz if max_rate_hz > 0 else 0.0
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._task = None
+        self.stats = {"scheduled": 0, "coalesced": 0, "skipped_no_members": 0, "emitted": 0, "errors": 0}
+
+    def has_members(self, room):
+        server = getattr(self.socketio, "server", None)
+        if server is None:
+            return False
+        return bool(server.manager.rooms.get(self.namespace, {}).get(room))
+
+    def schedule(self, room, event, build):
+        """Queue ``build()`` for the next tick; returns False if the room has no members"""
+        if not self.has_members(room):
+            self.stats["skipped_no_members"] += 1
+            return False
+        with self._lock:
+            if (room, event) in self._pending:
+                self.stats["coalesced"] += 1
+            self._pending[(room, event)] = build
+            self.stats["scheduled"] += 1
+        if not self.interval:
+            self.drain()
+        return True
+
+    def start(self):
+        if self._task is not None or not self.interval:
+            return
+        self._task = self.socketio.start_background_task(self._run)
+        logger.info(f"[EMIT] Scheduler started ({1 / self.interval:g} Hz per room)")
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            self.drain()
+
+    def drain(self):
+        """Build and emit every pending (room, event) once"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for (room, event), build in pending.items():
+            if not self.has_members(room):
+                self.stats["skipped_no_members"] += 1
+                continue
+            try:
+                payload = build()
+                if payload is None:
+                    continue
+                self.socketio.emit(event, payload, room=room, namespace=self.namespace)
+                self.stats["emitted"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"[EMIT] Failed to emit {event} to {room}: {e}")
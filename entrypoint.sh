@@ -2,10 +2,18 @@
 # Railway entrypoint script
 set -e
 
+# PROCESS_TYPE=ingest runs the standalone ingest service instead of the web app
+if [ "$PROCESS_TYPE" = "ingest" ]; then
+    echo "Starting ingest service"
+    exec python ingest_service.py
+fi
+
 # Default port if not set
 PORT=${PORT:-8000}
+# Set INGEST_IN_WEB=false (with an ingest service running) before raising the worker count
+WEB_CONCURRENCY=${WEB_CONCURRENCY:-1}
 
-echo "Starting application on port $PORT"
+echo "Starting application on port $PORT with $WEB_CONCURRENCY workers"
 
 # Start gunicorn with the correct port
-exec gunicorn --worker-class eventlet -w 1 --bind 0.0.0.0:$PORT app:app
+exec gunicorn --worker-class eventlet -w $WEB_CONCURRENCY --bind 0.0.0.0:$PORT app:app
@@ -0,0 +1,225 @@
+"""History queries for /api/data with optional server-side downsampling.
+
+Long windows are aggregated in SQL into fixed-width time buckets (avg for the
+chart line, min/max for the PM envelope) so the payload is bounded by
+``max_points`` regardless of how many raw rows the window holds.  Short
+windows, where a bucket would be no wider than a device's report interval,
+stay at raw resolution.  Which source (raw rows or a rollup tier) serves a
+request is decided by ``query_planner``; these functions just run the query.
+Raw PM reads go through the ``dust_pm_readings`` view (see ``measurements``).
+
+Pollers can pass the ``cursor`` returned by a previous response to get only
+rows inserted since then (see ``fetch_pm_since`` / ``fetch_extended_since``).
+Cursors are per device and assume a single writer per device (see
+``current_cursor``).
+"""
+import math
+from datetime import datetime
+
+from measurements import PM_VIEW
+
+PM_SERIES = ("pm1", "pm2_5", "pm4", "pm10", "tsp")
+EXTENDED_SERIES = (
+    "temperature_c", "humidity_percent", "pressure_hpa",
+    "voc_ppb", "no2_ppb", "noise_db", "gps_speed_kmh", "cloud_cover_percent",
+    "lux", "uv_index", "battery_percent",
+)
+
+DEFAULT_MAX_POINTS = 2000
+# Buckets this narrow or narrower are no coarser than a device reporting every 2 s
+RAW_BUCKET_SECONDS = 2
+
+
+def choose_bucket(hours, max_points=None, bucket=None):
+    """Bucket width in seconds for a window, or None for raw resolution"""
+    if bucket:
+        seconds = int(bucket)
+        return seconds if seconds > RAW_BUCKET_SECONDS else None
+    if max_points is None:
+        max_points = DEFAULT_MAX_POINTS
+    if max_points <= 0:
+        return None
+    seconds = math.ceil(hours * 3600 / max_points)
+    return seconds if seconds > RAW_BUCKET_SECONDS else None
+
+
+def _bucket_expr(column="timestamp"):
+    return f"to_timestamp(floor(extract(epoch FROM {column}) / %(bucket)s) * %(bucket)s)"
+
+
+def fetch_pm_history(cur, device_id, hours, bucket_seconds=None, rollup_table=None):
+    """PM chart history as column arrays; bucketed rows also carry min/max envelopes.
+
+    With ``rollup_table`` the buckets are merged from that rollup tier
+    (``bucket_seconds`` must then be a multiple of the tier width).
+    """
+    params = {"device_id": device_id, "hours": hours, "bucket": bucket_seconds}
+    if rollup_table is not None:
+        aggregates = ", ".join(
+            f"SUM({c}_sum) / NULLIF(SUM({c}_count), 0) AS {c}, MIN({c}_min) AS {c}_min, MAX({c}_max) AS {c}_max"
+            for c in PM_SERIES
+        )
+        cur.execute(f"""
+            SELECT {_bucket_expr("bucket")} AS time_bucket, {aggregates}
+            FROM {rollup_table}
+            WHERE device_id = %(device_id)s AND bucket >= NOW() - INTERVAL '1 hour' * %(hours)s
+            GROUP BY 1
+            ORDER BY 1 ASC
+        """, params)
+    elif bucket_seconds is None:
+        cur.execute(f"""
+            SELECT (timestamp AT TIME ZONE 'UTC' AT TIME ZONE 'GMT') as time_bucket,
+                   pm1, pm2_5, pm4, pm10, tsp
+            FROM {PM_VIEW}
+            WHERE device_id = %(device_id)s AND timestamp >= NOW() - INTERVAL '1 hour' * %(hours)s
+            ORDER BY time_bucket ASC
+        """, params)
+    else:
+        aggregates = ", ".join(
+            f"AVG({c}) AS {c}, MIN({c}) AS {c}_min, MAX({c}) AS {c}_max" for c in PM_SERIES
+        )
+        cur.execute(f"""
+            SELECT {_bucket_expr()} AS time_bucket, {aggregates}
+            FROM {PM_VIEW}
+            WHERE device_id = %(device_id)s AND timestamp >= NOW() - INTERVAL '1 hour' * %(hours)s
+            GROUP BY 1
+            ORDER BY 1 ASC
+        """, params)
+    rows = cur.fetchall()
+
+    history = {"timestamps": [r['time_bucket'].isoformat() for r in rows]}
+    for c in PM_SERIES:
+        history[c] = [float(r[c] or 0) for r in rows]
+    if bucket_seconds is not None or rollup_table is not None:
+        history["min"] = {c: [float(r[f"{c}_min"] or 0) for r in rows] for c in PM_SERIES}
+        history["max"] = {c: [float(r[f"{c}_max"] or 0) for r in rows] for c in PM_SERIES}
+    return history
+
+
+def fetch_extended_history(cur, device_id, hours, bucket_seconds=None, rollup_table=None):
+    """Extended chart history as column arrays (bucket averages when downsampled)"""
+    params = {"device_id": device_id, "hours": hours, "bucket": bucket_seconds}
+    columns = ", ".join(EXTENDED_SERIES)
+    if rollup_table is not None:
+        aggregates = ", ".join(f"SUM({c}_sum) / NULLIF(SUM({c}_count), 0) AS {c}" for c in EXTENDED_SERIES)
+        cur.execute(f"""
+            SELECT {_bucket_expr("bucket")} AS timestamp, {aggregates}
+            FROM {rollup_table}
+            WHERE device_id = %(device_id)s AND bucket >= NOW() - INTERVAL '1 hour' * %(hours)s
+            GROUP BY 1
+            ORDER BY 1 ASC
+        """, params)
+    elif bucket_seconds is None:
+        cur.execute(f"""
+            SELECT (timestamp AT TIME ZONE 'UTC' AT TIME ZONE 'GMT') as timestamp, {columns}
+            FROM dust_extended_data
+            WHERE device_id = %(device_id)s AND timestamp >= NOW() - INTERVAL '1 hour' * %(hours)s
+            ORDER BY timestamp ASC
+        """, params)
+    else:
+        aggregates = ", ".join(f"AVG({c}) AS {c}" for c in EXTENDED_SERIES)
+        cur.execute(f"""
+            SELECT {_bucket_expr()} AS timestamp, {aggregates}
+            FROM dust_extended_data
+            WHERE device_id = %(device_id)s AND timestamp >= NOW() - INTERVAL '1 hour' * %(hours)s
+            GROUP BY 1
+            ORDER BY 1 ASC
+        """, params)
+    rows = cur.fetchall()
+    if not rows:
+        return None
+
+    history = {"timestamps": [r['timestamp'].isoformat() for r in rows]}
+    for c in EXTENDED_SERIES:
+        history[c] = [float(r[c] or 0) for r in rows]
+    return history
+
+
+def current_cursor(cur, device_id, hours, latest_ms=0):
+    """Cursor covering every row of ``device_id`` committed so far in the last ``hours``.
+
+    Id cursors rely on each device's rows being written by a single writer
+    (one batch writer flushing one transaction at a time), so a device's ids
+    become visible in increasing order.  A global ``MAX(id)`` would not be
+    safe: with ingest shards several writers commit concurrently, and a slow
+    shard can commit ids below a cursor already handed out, which ``id >
+    cursor`` polls would then never return.  Shards own disjoint devices, so
+    the max is taken per device (and over the window only, so the planner
+    prunes to the recent partitions).
+    """
+    params = {"device_id": device_id, "hours": hours}
+    cur.execute("""
+        SELECT (SELECT COALESCE(MAX(id), 0) FROM dust_sensor_data
+                WHERE device_id = %(device_id)s
+                  AND timestamp >= NOW() - INTERVAL '1 hour' * %(hours)s) AS sensor_id,
+               (SELECT COALESCE(MAX(id), 0) FROM dust_extended_data
+                WHERE device_id = %(device_id)s
+                  AND timestamp >= NOW() - INTERVAL '1 hour' * %(hours)s) AS extended_id
+    """, params)
+    row = cur.fetchone()
+    return make_cursor(row['sensor_id'], row['extended_id'], latest_ms)
+
+
+def make_cursor(sensor_id, extended_id, latest_ms=0):
+    """Opaque cursor string: last seen ids plus the newest reading time the client has"""
+    return f"{int(sensor_id)}.{int(extended_id)}.{int(latest_ms)}"
+
+
+def parse_cursor(value):
+    """Parse a cursor, or an ISO timestamp for clients that only know a time.
+
+    Returns a dict with ``sensor_id``/``extended_id``/``latest_ms`` or with
+    ``since`` (a datetime); raises ValueError if it is neither.
+    """
+    parts = value.split(".")
+    if len(parts) == 3 and all(p.isdigit() for p in parts):
+        return {"sensor_id": int(parts[0]), "extended_id": int(parts[1]), "latest_ms": int(parts[2])}
+    return {"since": datetime.fromisoformat(value.replace("Z", "+00:00"))}
+
+
+def _since_clause(cursor, id_key):
+    if "since" in cursor:
+        return "timestamp > %(since)s", {"since": cursor["since"]}
+    return "id > %(after_id)s", {"after_id": cursor[id_key]}
+
+
+def fetch_pm_since(cur, device_id, hours, cursor):
+    """Raw PM rows newer than the cursor; returns (history, highest dust_sensor_data id seen or None)"""
+    if "since" in cursor:
+        clause, params = _since_clause(cursor, "sensor_id")
+    else:
+        # PM readings come from both tables; each keeps its own id in the cursor
+        clause = ("((origin = 'sensor' AND id > %(sensor_id)s)"
+                  " OR (origin = 'extended' AND id > %(extended_id)s))")
+        params = {"sensor_id": cursor["sensor_id"], "extended_id": cursor["extended_id"]}
+    params.update({"device_id": device_id, "hours": hours})
+    cur.execute(f"""
+        SELECT origin, id, timestamp, pm1, pm2_5, pm4, pm10, tsp
+        FROM {PM_VIEW}
+        WHERE device_id = %(device_id)s AND timestamp >= NOW() - INTERVAL '1 hour' * %(hours)s
+          AND {clause}
+        ORDER BY timestamp ASC
+    """, params)
+    rows = cur.fetchall()
+    history = {"timestamps": [r['timestamp'].isoformat() for r in rows]}
+    for c in PM_SERIES:
+        history[c] = [float(r[c] or 0) for r in rows]
+    return history, max((r['id'] for r in rows if r['origin'] == 'sensor'), default=None)
+
+
+def fetch_extended_since(cur, device_id, hours, cursor):
+    """Raw extended rows newer than the cursor; returns (history, highest id seen or None)"""
+    clause, params = _since_clause(cursor, "extended_id")
+    params.update({"device_id": device_id, "hours": hours})
+    cur.execute(f"""
+        SELECT id, timestamp, {", ".join(EXTENDED_SERIES)}
+        FROM dust_extended_data
+        WHERE device_id = %(device_id)s AND timestamp >= NOW() - INTERVAL '1 hour' * %(hours)s
+          AND {clause}
+        ORDER BY timestamp ASC
+    """, params)
+    rows = cur.fetchall()
+    history = {"timestamps": [r['timestamp'].isoformat() for r in rows]}
+    for c in EXTENDED_SERIES:
+        history[c] = [float(r[c] or 0) for r in rows]
+    return history, max((r['id'] for r in rows), default=None)
@@ -0,0 +1,230 @@
+"""Ingest -> web notifications for the websocket fan-out.
+
+Once ingest runs outside the web worker (the ingest service, a web worker
+other than the one holding the ingest lock, or the ingest shards), its
+flushes no longer reach ``socketio.emit``.  Instead every flush publishes
+compact per-device updates on a bus, and every web worker subscribes, folds
+them into its in-memory ``LatestStore`` mirror and ``LiveFeed`` windows, and
+schedules emits for its own rooms.  Payloads are then built from memory;
+nothing is re-queried per notification.
+
+``IngestNotifier`` is a BatchWriter stage.  An update carries the newest
+sensor, extended and GPS parts of a device plus its new PM points::
+
+    {"d": device_id, "s": {...}, "e": {...}, "g": {...}, "p": [[iso timestamp, pm1, pm2_5, pm4, pm10, tsp], ...]}
+
+Two buses implement ``publish(cur, updates)`` / ``after_commit(updates)`` /
+``subscribe(callback)``:
+
+* ``PostgresBus`` sends ``NOTIFY dust_ingest`` from the flush transaction, so
+  subscribers only hear about committed rows, and LISTENs on a dedicated
+  connection.  NOTIFY payloads are limited to 8000 bytes; updates are split
+  across notifications and a device's oldest points are trimmed if needed.
+* ``LocalBus`` hands updates to in-process subscribers after the commit; it is
+  enough when a single web worker also does the ingest.
+"""
+import json
+import logging
+import select
+import threading
+from datetime import datetime
+
+import psycopg2
+
+from latest_store import LatestStore
+from measurements import pm_rows
+
+logger = logging.getLogger(__name__)
+
+INGEST_CHANNEL = "dust_ingest"
+# Postgres rejects NOTIFY payloads of 8000 bytes or more; leave room for the envelope
+MAX_NOTIFY_BYTES = 7500
+RECONNECT_SECONDS = 5
+
+
+def _encode_part(part):
+    return {**part, "timestamp": part["timestamp"].isoformat()}
+
+
+def _decode_part(part):
+    return {**part, "timestamp": datetime.fromisoformat(part["timestamp"])}
+
+
+def build_updates(batch):
+    """One update per device written in a flush batch"""
+    updates = {}
+    for device_id, parts in LatestStore.latest_from_batch(batch).items():
+        update = updates[device_id] = {"d": device_id}
+        for key, part in (("s", "sensor"), ("e", "extended"), ("g", "gps")):
+            if part in parts:
+                update[key] = _encode_part(parts[part])
+    for device_id, timestamp, pm in pm_rows(batch):
+        update = updates.setdefault(device_id, {"d": device_id})
+        update.setdefault("p", []).append([timestamp.isoformat(), *pm])
+    return list(updates.values())
+
+
+def decode_update(update):
+    """(device_id, {'sensor', 'extended', 'gps'} parts present, [(timestamp, pm tuple)])"""
+    parts = {part: _decode_part(update[key])
+             for key, part in (("s", "sensor"), ("e", "extended"), ("g", "gps")) if key in update}
+    points = [(datetime.fromisoformat(point[0]), tuple(point[1:])) for point in update.get("p", ())]
+    return update["d"], parts, points
+
+
+def chunk_updates(updates, max_bytes=MAX_NOTIFY_BYTES):
+    """JSON arrays of updates, each under ``max_bytes`` (oldest points dropped from oversized devices)"""
+    chunk, size = [], 2
+    for update in updates:
+        encoded = json.dumps(update, separators=(",", ":"))
+        while len(encoded) + 2 > max_bytes and update.get("p"):
+            update = {**update, "p": update["p"][len(update["p"]) // 2 + 1:]}
+            encoded = json.dumps(update, separators=(",", ":"))
+        if chunk and size + len(encoded) + 1 > max_bytes:
+            yield "[" + ",".join(chunk) + "]"
+            chunk, size = [], 2
+        chunk.append(encoded)
+        size += len(encoded) + 1
+    if chunk:
+        yield "[" + ",".join(chunk) + "]"
+
+
+class LocalBus:
+    """In-process bus: subscribers get each flush's updates right after it commits"""
+
+    def __init__(self):
+        self._subscribers = []
+        self.stats = {"published": 0, "delivered": 0}
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def publish(self, cur, updates):
+        pass
+
+    def after_commit(self, updates):
+        self.stats["published"] += len(updates)
+        for callback in self._subscribers:
+            try:
+                callback(updates)
+                self.stats["delivered"] += len(updates)
+            except Exception as e:
+                logger.error(f"[BUS] Subscriber failed: {e}")
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class PostgresBus:
+    """NOTIFY from the flush transaction, LISTEN on a dedicated connection in each subscriber"""
+
+    def __init__(self, dsn=None, on_resync=None):
+        self.dsn = dsn
+        self.on_resync = on_resync
+        self._subscribers = []
+        self._conn = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"published": 0, "notifications_sent": 0, "received": 0, "reconnects": 0, "errors": 0}
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def publish(self, cur, updates):
+        for payload in chunk_updates(updates):
+            cur.execute("SELECT pg_notify(%s, %s)", (INGEST_CHANNEL, payload))
+            self.stats["notifications_sent"] += 1
+        self.stats["published"] += len(updates)
+
+    def after_commit(self, updates):
+        pass
+
+    def _connect(self):
+        conn = psycopg2.connect(keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+                                application_name="dust-ingest-listener", **self.dsn)
+        conn.autocommit = True
+        conn.cursor().execute(f"LISTEN {INGEST_CHANNEL}")
+        return conn
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _dispatch(self, payload):
+        try:
+            updates = json.loads(payload)
+        except ValueError as e:
+            self.stats["errors"] += 1
+            logger.error(f"[BUS] Bad ingest notification: {e}")
+            return
+        self.stats["received"] += len(updates)
+        for callback in self._subscribers:
+            try:
+                callback(updates)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"[BUS] Subscriber failed: {e}")
+
+    def _run(self):
+        connected_before = False
+        while not self._stop.is_set():
+            try:
+                self._conn = self._connect()
+                if connected_before:
+                    # Notifications sent while disconnected are lost; let the app reload its caches
+                    self.stats["reconnects"] += 1
+                    logger.info("[BUS] Listener reconnected")
+                    if self.on_resync:
+                        self.on_resync()
+                connected_before = True
+                conn = self._conn
+                while not self._stop.is_set():
+                    if not select.select([conn], [], [], RECONNECT_SECONDS)[0]:
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"[BUS] Listener failed, reconnecting in {RECONNECT_SECONDS}s: {e}")
+            self._close()
+            self._stop.wait(RECONNECT_SECONDS)
+
+    def start(self):
+        """Start listening (subscribers only; publishers just need ``publish``)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="IngestBusListener")
+        self._thread.start()
+        logger.info(f"[BUS] Listening for ingest notifications on {INGEST_CHANNEL}")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=RECONNECT_SECONDS + 1)
+        self._close()
+
+
+class IngestNotifier:
+    """BatchWriter stage: publish each flush's per-device updates on the bus"""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def write(self, cur, batch):
+        updates = build_updates(batch)
+        if updates:
+            self.bus.publish(cur, updates)
+        return updates
+
+    def after_commit(self, batch, updates):
+        if updates:
+            self.bus.after_commit(updates)
@@ -0,0 +1,172 @@
+"""One active ingester at a time, chosen with a PostgreSQL advisory lock.
+
+Every process that can ingest (the ``ingest`` service, and web workers when
+``INGEST_IN_WEB`` is on) runs a ``LeaderLock``.  It keeps one dedicated
+autocommit connection and retries ``pg_try_advisory_lock`` until it wins; the
+holder starts the MQTT collectors and the singleton maintenance jobs, every
+other instance stays up as a hot standby.  The lock belongs to the session, so
+when the leader dies or its connection drops the database releases it and a
+standby takes over within ``retry_seconds``.  A leader whose session broke must
+stop ingesting at once, since a standby may already hold the lock; callers
+exit the process from ``on_demoted`` and are restarted as standbys.
+
+The lock connection also LISTENs on ``dust_control``.  Processes without
+broker connections (web workers) hand relay commands and device, threshold and
+data-source changes to whichever process leads with ``notify_control``, and
+``IngestControl`` applies them there.
+"""
+import json
+import logging
+import select
+import threading
+from datetime import datetime, timezone
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# Shared by every ingester of a database; any fixed bigint works
+INGEST_LOCK_KEY = 7277101
+CONTROL_CHANNEL = "dust_control"
+
+
+def notify_control(cur, message):
+    """Queue a control message for the leader; it is delivered when the transaction commits"""
+    cur.execute("SELECT pg_notify(%s, %s)", (CONTROL_CHANNEL, json.dumps(message)))
+
+
+class IngestControl:
+    """Applies ``dust_control`` messages in the leader (and, forwarded, in each ingest shard)"""
+
+    def __init__(self, registry, threshold_engine, engine=None, shards=None, load_sources=None):
+        self.registry = registry
+        self.threshold_engine = threshold_engine
+        self.engine = engine
+        self.shards = shards
+        self.load_sources = load_sources
+
+    def sync_sources(self):
+        if self.engine is not None and self.load_sources is not None:
+            self.engine.sync(self.load_sources())
+
+    def __call__(self, message):
+        kind = message.get("type")
+        if kind == "publish":
+            if self.engine is not None:
+                self.engine.publish(message.get("device_id"), message["topic"], message["payload"],
+                                    broadcast=message.get("broadcast", False))
+        elif kind == "sources":
+            self.sync_sources()
+        elif kind == "devices":
+            self.registry.invalidate()
+        elif kind == "thresholds":
+            # Reloaded (window and thresholds) from the database on the next evaluation
+            self.threshold_engine.forget(message["device_id"])
+        else:
+            logger.warning(f"[LEADER] Unknown control message: {message}")
+            return
+        if self.shards is not None and kind in ("devices", "thresholds"):
+            self.shards.broadcast(message)
+
+
+class LeaderLock:
+    """Campaigns for the ingest advisory lock and holds it while the session is healthy"""
+
+    def __init__(self, dsn, on_elected, on_demoted, on_control=None, key=INGEST_LOCK_KEY,
+                 retry_seconds=5, heartbeat_seconds=5):
+        self.dsn = dsn
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.on_control = on_control
+        self.key = key
+        self.retry_seconds = retry_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.is_leader = False
+        self._conn = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"attempts": 0, "elected_at": None, "control_messages": 0}
+
+    def _connect(self):
+        # Keepalives so a half-open session is noticed by the client side as well
+        conn = psycopg2.connect(keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+                                application_name="dust-ingest-leader", **self.dsn)
+        conn.autocommit = True
+        return conn
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _campaign(self):
+        """Block until the lock is ours (returns True) or stop() was called"""
+        while not self._stop.is_set():
+            self.stats["attempts"] += 1
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._conn = self._connect()
+                cur = self._conn.cursor()
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (self.key,))
+                if cur.fetchone()[0]:
+                    return True
+            except Exception as e:
+                logger.warning(f"[LEADER] Lock attempt failed: {e}")
+                self._close()
+            self._stop.wait(self.retry_seconds)
+        return False
+
+    def _hold(self):
+        """Deliver control notifications and heartbeat the session until it fails or stop()"""
+        conn = self._conn
+        cur = conn.cursor()
+        while not self._stop.is_set():
+            readable, _, _ = select.select([conn], [], [], self.heartbeat_seconds)
+            if readable:
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self.stats["control_messages"] += 1
+                    if self.on_control is None:
+                        continue
+                    try:
+                        self.on_control(json.loads(notify.payload))
+                    except Exception as e:
+                        logger.error(f"[LEADER] Control message failed: {e}")
+            else:
+                cur.execute("SELECT 1")
+
+    def _run(self):
+        if not self._campaign():
+            return
+        self.is_leader = True
+        self.stats["elected_at"] = datetime.now(timezone.utc).isoformat()
+        logger.info(f"[LEADER] 👑 Acquired ingest lock {self.key}; this process is the active ingester")
+        try:
+            self._conn.cursor().execute(f"LISTEN {CONTROL_CHANNEL}")
+            self.on_elected()
+            self._hold()
+        except Exception as e:
+            logger.error(f"[LEADER] Ingest lock session lost: {e}")
+        finally:
+            self.is_leader = False
+        if not self._stop.is_set():
+            self.on_demoted()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="IngestLeader")
+        self._thread.start()
+        logger.info(f"[LEADER] Waiting for ingest lock {self.key} (hot standby until acquired)")
+
+    def stop(self):
+        """Release the lock by ending the session"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.heartbeat_seconds + 1)
+        self._close()
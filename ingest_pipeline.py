@@ -0,0 +1,254 @@
+"""Flask-free ingest path: payload decoding, routing and relay thresholds.
+
+``IngestPipeline`` turns one raw MQTT message into rows for the batch writer
+(compact ``e``/``pm``/``g``, legacy ``PM_data``/``GPS`` and basic PM-only
+payloads, decoded by ``payload_decoders``), applies status messages, and
+evaluates relay thresholds after a flush.  It only depends on the registry,
+writer and threshold engine it is given, so the same code runs inside the web
+process and in the ingest shard processes (see ``ingest_shards``), which never
+import Flask.
+
+Payloads are parsed from the raw bytes (``payload_decoders.loads``) and only
+one in ``payload_log_every`` messages is logged, with lazily formatted
+arguments, so the hot path does no string formatting for log lines nobody
+reads.
+
+Relay control messages are handed to a ``publish(device_id, topic, payload)``
+callable, since only the process holding the broker connections can send them.
+"""
+import itertools
+import json
+import logging
+from datetime import datetime, timezone
+
+from dedup import payload_hash
+from payload_decoders import default_registry, loads
+
+logger = logging.getLogger(__name__)
+
+# Log one raw payload in this many messages (0 disables)
+PAYLOAD_LOG_EVERY = 1000
+
+DEFAULT_THRESHOLDS = {
+    "pm1": 50.0,
+    "pm2.5": 75.0,
+    "pm4": 100.0,
+    "pm10": 150.0,
+    "tsp": 200.0
+}
+
+
+def default_status():
+    """Fresh copy of the device status block used before any status message arrives"""
+    return {"mode": "auto", "relay_state": "OFF", "thresholds": dict(DEFAULT_THRESHOLDS)}
+
+
+class IngestPipeline:
+    """Decodes MQTT messages into batch writer rows and runs relay threshold checks"""
+
+    def __init__(self, get_conn, put_conn, registry, writer, threshold_engine, status=None, publish=None,
+                 recent_keys=None, decoders=None, payload_log_every=PAYLOAD_LOG_EVERY):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.registry = registry
+        self.writer = writer
+        self.threshold_engine = threshold_engine
+        # Shared with the web process' status endpoints when running in-process
+        self.status = status if status is not None else default_status()
+        self.publish = publish
+        # QoS 1 redeliveries are dropped here when the payload carries a device timestamp (see dedup)
+        self.recent_keys = recent_keys
+        # Payload formats, extensible with decoders.register() (see payload_decoders)
+        self.decoders = decoders if decoders is not None else default_registry()
+        self.payload_log_every = payload_log_every
+        self._messages = itertools.count()
+
+    def handle_message(self, data_source_id, topic, raw_payload):
+        """Decode one MQTT message and route it"""
+        try:
+            if self.payload_log_every and next(self._messages) % self.payload_log_every == 0:
+                logger.info("[MQTT-%s] Sampled payload on %s (%d bytes): %r",
+                            data_source_id, topic, len(raw_payload), raw_payload)
+
+            payload = loads(raw_payload)
+            device_id = payload.get("deviceid") or payload.get("i")
+
+            if not device_id:
+                logger.warning(f"[MQTT-{data_source_id}] Message missing deviceid or i")
+                return
+
+            payload_format = self.decoders.match(topic, payload)
+            if payload_format is None:
+                return
+            logger.debug("[MQTT-%s] Format: %s", data_source_id, payload_format.name)
+
+            if payload_format.table is None:
+                self.process_status_data(payload, device_id)
+                return
+
+            digest = payload_hash(raw_payload) if payload_format.device_timestamp(payload) else None
+            received_at = datetime.now(timezone.utc)
+            values = payload_format.decode(payload, received_at)
+            if values[payload_format.timestamp_slot] is not received_at:
+                # Only device-stamped rows take part in the database reading key (see dedup)
+                values[payload_format.hash_slot] = digest
+            if payload_format.table == "dust_extended_data":
+                self.process_extended_record(payload_format, values, device_id, data_source_id)
+            else:
+                self.process_sensor_record(payload_format, values, device_id, data_source_id)
+
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            logger.error(f"[MQTT-{data_source_id}] JSON decode error: {e}")
+            logger.error(f"[MQTT-{data_source_id}] Raw payload: {raw_payload}")
+        except Exception as e:
+            logger.error(f"[MQTT-{data_source_id}] Error processing message: {e}")
+
+    def is_duplicate(self, payload_format, values, data_source_id):
+        """True for a QoS 1 redelivery of a reading that has already been written (see dedup)"""
+        digest = values[payload_format.hash_slot]
+        if digest is None or self.recent_keys is None:
+            return False
+        device_id, timestamp = values[payload_format.device_slot], values[payload_format.timestamp_slot]
+        if not self.recent_keys.seen(device_id, timestamp, digest):
+            return False
+        logger.info("[MQTT-%s] Duplicate delivery from device %s at %s, skipped",
+                    data_source_id, device_id, timestamp)
+        return True
+
+    def process_extended_record(self, payload_format, values, device_id, data_source_id):
+        """Queue a decoded dust_extended_data record (PM included, see measurements)"""
+        # Get or validate device (registry logs unknown devices once per TTL)
+        device = self.registry.lookup(device_id, data_source_id)
+        if not device:
+            return
+        values[payload_format.device_slot] = device.id
+        if self.is_duplicate(payload_format, values, data_source_id):
+            return
+
+        # Emits run after the flush; the threshold engine is fed from the committed rows
+        self.writer.add_values("dust_extended_data", values, {"device_id": device.id, "extended": True})
+        logger.debug("[EXTENDED] Queued %s data for device %s", payload_format.name, device.id)
+
+    def process_sensor_record(self, payload_format, values, device_id, data_source_id):
+        """Queue a decoded dust_sensor_data record for the device registered on this data source"""
+        device = self.registry.lookup(device_id, data_source_id)
+        if not device:
+            logger.warning(f"Unauthorized device creation attempted: {device_id}")
+            return
+        values[payload_format.device_slot] = device.id
+        values[payload_format.source_slot] = data_source_id
+        if self.is_duplicate(payload_format, values, data_source_id):
+            return
+
+        # Rolling windows, thresholds and WebSocket update run after the flush
+        self.writer.add_values("dust_sensor_data", values, {
+            "device_id": device.id,
+            "user_id": device.user_id,
+            "has_relay": device.has_relay,
+        })
+
+    def process_status_data(self, payload, device_id):
+        """Process status data from MQTT"""
+        conn = None
+        try:
+            device = self.registry.lookup_deviceid(device_id)
+
+            self.status.update(payload)
+
+            if "thresholds" in payload and device:
+                conn = self.get_conn()
+                cur = conn.cursor()
+                cur.execute("""
+                    INSERT INTO dust_thresholds (device_id, pm1, pm2_5, pm4, pm10, tsp, averaging_window)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                """, (
+                    device.id,
+                    payload["thresholds"].get("pm1", self.status["thresholds"]["pm1"]),
+                    payload["thresholds"].get("pm2.5", self.status["thresholds"]["pm2.5"]),
+                    payload["thresholds"].get("pm4", self.status["thresholds"]["pm4"]),
+                    payload["thresholds"].get("pm10", self.status["thresholds"]["pm10"]),
+                    payload["thresholds"].get("tsp", self.status["thresholds"]["tsp"]),
+                    payload.get("averaging_window", 15)
+                ))
+
+                conn.commit()
+                self.threshold_engine.set_thresholds(device.id, {
+                    **self.status["thresholds"],
+                    **payload["thresholds"],
+                    "averaging_window": payload.get("averaging_window", 15),
+                })
+        except Exception as e:
+            logger.error(f"Error saving thresholds: {e}")
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def process_thresholds(self, device_id, user_id):
+        """Check thresholds and control relay if needed"""
+        try:
+            # Averages over the configured window come from the in-memory rolling windows
+            averages, threshold_row = self.threshold_engine.evaluate(device_id)
+            defaults = self.status["thresholds"]
+            thresholds = {
+                key: threshold_row[key] if threshold_row else defaults[key]
+                for key in ["pm1", "pm2.5", "pm4", "pm10", "tsp"]
+            }
+            thresholds["averaging_window"] = threshold_row["averaging_window"] if threshold_row else 15
+
+            # Check if any threshold is exceeded
+            trigger_relay = False
+            if averages and any([
+                averages[0] and averages[0] > thresholds["pm1"],
+                averages[1] and averages[1] > thresholds["pm2.5"],
+                averages[2] and averages[2] > thresholds["pm4"],
+                averages[3] and averages[3] > thresholds["pm10"],
+                averages[4] and averages[4] > thresholds["tsp"]
+            ]):
+                trigger_relay = True
+                self.create_alert(device_id, "threshold_exceeded", "One or more thresholds exceeded",
+                                  thresholds, averages)
+
+            # Publish control message
+            control_message = {
+                "command": "all_on" if trigger_relay else "all_off",
+                "source": "server",
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "deviceid": device_id
+            }
+            if self.publish:
+                self.publish(device_id, "dustrak/control", json.dumps(control_message))
+
+        except Exception as e:
+            logger.error(f"Error processing thresholds: {e}")
+
+    def create_alert(self, device_id, alert_type, message, thresholds=None, readings=None):
+        """Create an alert in the database"""
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+
+            threshold_value = None
+            measured_value = None
+
+            if alert_type == "threshold_exceeded" and thresholds and readings:
+                for i, param in enumerate(["pm1", "pm2.5", "pm4", "pm10", "tsp"]):
+                    if readings[i] and readings[i] > thresholds[param]:
+                        threshold_value = thresholds[param]
+                        measured_value = readings[i]
+                        break
+
+            cur.execute("""
+                INSERT INTO dust_device_alerts
+                (device_id, alert_type, message, threshold_value, measured_value)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (device_id, alert_type, message, threshold_value, measured_value))
+            conn.commit()
+
+        except Exception as e:
+            logger.error(f"Error creating alert: {e}")
+            if conn:
+                conn.rollback()
+        finally:
+            if conn:
+                self.put_conn(conn)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Standalone ingest service: MQTT collectors, batch writer and maintenance jobs, without Flask.
+
+    ingest: python ingest_service.py        (Procfile)
+
+Run one or more instances next to the web process.  Each builds the ingest
+stack, creates the tables, columns and partitions it writes into (the same
+``IngestStack.ensure_schema`` the web process runs at boot), then campaigns
+for the ingest advisory lock (see ``ingest_leader``);
+only the holder connects to the brokers, writes readings and runs the
+singleton jobs (partitions, rollup backfill, mirror cleanup, cold archive,
+retention), the others wait as hot standbys.  With ``INGEST_IN_WEB=false`` on
+the web process, gunicorn workers only serve HTTP and websockets and can be
+scaled out freely.  The cold archive is read by the web process, so
+``ARCHIVE_DIR`` must be storage both can see when archiving is enabled, and
+nothing is archived until ``ARCHIVE_SHARED=true`` says it is.
+
+``INGEST_PROCESSES`` > 0 shards decoding and writes across that many processes
+(see ``ingest_shards``), exactly as it does inside the web process.
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+
+from dotenv import load_dotenv
+
+from cold_archive import ColdArchive
+from db_pool import ConnectionPool, db_config_from_env
+from dedup import RecentKeys
+from device_registry import DeviceRegistry
+from ingest_bus import IngestNotifier, PostgresBus
+from ingest_leader import IngestControl, LeaderLock
+from ingest_pipeline import IngestPipeline, PAYLOAD_LOG_EVERY
+from ingest_shards import ShardedIngest
+from ingest_spool import spool_from_env
+from ingest_writer import BatchWriter
+from latest_store import LatestStore, ensure_latest_table
+from measurements import LegacyExtendedRepair, MirrorCleanup
+from mqtt_engine import MqttEngine, load_sources, message_spool
+from partitions import PartitionManager, ensure_reading_key_columns
+from retention import RetentionManager, load_policy
+from rolling_window import ThresholdEngine
+from rollups import RollupManager
+
+logger = logging.getLogger(__name__)
+
+# Safety net for missed 'sources' notifications (e.g. sent while no leader was listening)
+SOURCE_SYNC_SECONDS = 300
+
+# Serializes schema setup between web workers and ingest instances starting at the same time
+SCHEMA_LOCK_KEY = 7277102
+# Wait between schema setup attempts (e.g. while the web process creates the base tables)
+SCHEMA_RETRY_SECONDS = 30
+
+
+class IngestStack:
+    """The ingest object graph, built the same way by the web process, the ingest service and the shards
+
+    Device registry, threshold engine, the batch writer with its stages (latest
+    readings, rollups, thresholds, ``bus`` notifications), the decoding
+    pipeline and the singleton maintenance jobs.  The active ingester also gets
+    the MQTT engine, the shard processes (``INGEST_PROCESSES``) and the control
+    handler that drives both.  A shard process passes its ``shard`` index and a
+    ``publish`` that sends relay commands up its control pipe; it only writes,
+    since the parent's leader runs the collectors and jobs.
+    """
+
+    def __init__(self, get_conn, put_conn, bus, publish=None, shard=None, status=None, clients=None):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.shard = shard
+        self.publish = publish or self.publish_mqtt
+
+        self.registry = DeviceRegistry(get_conn, put_conn)
+        self.threshold_engine = ThresholdEngine(get_conn, put_conn)
+        # Backfills and migrations wait until legacy extended rows have been put back in place
+        self.legacy_repair = LegacyExtendedRepair(get_conn, put_conn)
+        self.rollups = RollupManager(get_conn, put_conn, ready=self.legacy_repair.done)
+        self.latest = LatestStore(get_conn, put_conn, ready=self.legacy_repair.done)
+        # Each device hashes to one shard, so its recent keys live in one place; a writer stage,
+        # since keys are only remembered once their rows have committed
+        self.recent_keys = RecentKeys(per_device=int(os.getenv('DEDUP_KEYS_PER_DEVICE', 256)))
+        # Flushes by size (INGEST_BATCH_ROWS) or age (INGEST_BATCH_MS); batches the database
+        # cannot take go to the on-disk spool (INGEST_SPOOL_DIR) and are replayed in order
+        self.writer = BatchWriter(
+            get_conn,
+            put_conn,
+            max_rows=int(os.getenv('INGEST_BATCH_ROWS', 500)),
+            max_delay=int(os.getenv('INGEST_BATCH_MS', 250)) / 1000,
+            on_flush=self.handle_flush,
+            stages=[self.latest, self.rollups, self.threshold_engine, self.recent_keys, IngestNotifier(bus)],
+            spool=spool_from_env(f"shard-{shard}" if shard is not None else None),
+        )
+        self.pipeline = IngestPipeline(get_conn, put_conn, self.registry, self.writer, self.threshold_engine,
+                                       status=status, publish=self.publish, recent_keys=self.recent_keys,
+                                       payload_log_every=int(os.getenv('PAYLOAD_LOG_EVERY', PAYLOAD_LOG_EVERY)))
+
+        if shard is not None:
+            self.shards = self.engine = None
+            self.control = IngestControl(self.registry, self.threshold_engine)
+            self.jobs = ()
+            return
+
+        processes = int(os.getenv('INGEST_PROCESSES', 0))
+        self.shards = ShardedIngest(processes, publish=self.publish) if processes else None
+        # One network loop for every broker plus a fixed worker pool; MQTT_OVERFLOW (block,
+        # drop_oldest, spill) decides what a full queue does with new messages
+        overflow = os.getenv('MQTT_OVERFLOW', 'block')
+        self.engine = MqttEngine(
+            self.shards.submit if self.shards else self.pipeline.handle_message,
+            workers=int(os.getenv('MQTT_WORKERS', '4')),
+            queue_size=int(os.getenv('MQTT_QUEUE_SIZE', '10000')),
+            clients=clients,
+            overflow=overflow,
+            spill=message_spool() if overflow == 'spill' else None,
+        )
+        self.control = IngestControl(self.registry, self.threshold_engine, engine=self.engine,
+                                     shards=self.shards, load_sources=lambda: load_sources(get_conn, put_conn))
+
+        # Deletes the PM rows compact devices used to mirror into dust_sensor_data (after the rollup backfill)
+        self.mirror_cleanup = MirrorCleanup(get_conn, put_conn, ready=self.rollups.backfill_done)
+        self.partitions = PartitionManager(
+            get_conn,
+            put_conn,
+            interval=os.getenv('PARTITION_INTERVAL', 'month'),
+            ahead=int(os.getenv('PARTITIONS_AHEAD', 3)),
+            after_swap=self.mirror_cleanup.ensure_view,
+            ready=self.legacy_repair.done,
+        )
+        # Archiving is off unless ARCHIVE_AFTER_DAYS is set, and refuses to run until ARCHIVE_SHARED
+        # confirms that ARCHIVE_DIR is storage the web workers can read too
+        self.archive = ColdArchive(
+            get_conn,
+            put_conn,
+            root=os.getenv('ARCHIVE_DIR', 'archive'),
+            archive_after_days=int(os.getenv('ARCHIVE_AFTER_DAYS', 0)) or None,
+            ready=self.rollups.backfill_done,
+            shared=os.getenv('ARCHIVE_SHARED', 'false').lower() == 'true',
+        )
+        # Expires raw rows and rollup tiers per RETENTION_POLICY (JSON; see retention.DEFAULT_POLICY);
+        # with the archive on, raw rows are only expired once they are safely archived
+        self.retention = RetentionManager(
+            get_conn,
+            put_conn,
+            policy=load_policy(os.getenv('RETENTION_POLICY')),
+            interval_hours=float(os.getenv('RETENTION_INTERVAL_HOURS', 6)),
+            ready=self.rollups.backfill_done,
+            raw_floor=self.archive.archived_before if self.archive.enabled else None,
+        )
+        self.jobs = (self.partitions, self.legacy_repair, self.rollups, self.latest, self.mirror_cleanup,
+                     self.archive, self.retention)
+
+    def ensure_schema(self):
+        """Create what the writer and jobs rely on beyond the base tables; idempotent, run before ingesting"""
+        conn = self.get_conn()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_KEY,))
+            try:
+                # Combined PM view (and the cleanup of legacy mirrored rows), then the
+                # latest-reading table and rollup tiers maintained by the ingest writer
+                self.mirror_cleanup.ensure(cur)
+                self.legacy_repair.ensure(cur)
+                ensure_latest_table(cur)
+                self.rollups.ensure(cur)
+                conn.commit()
+
+                # Hash column of the writer's reading key; the unique index itself is built
+                # concurrently by the partition manager on the ingest leader
+                ensure_reading_key_columns(cur)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_KEY,))
+                conn.commit()
+        finally:
+            self.put_conn(conn)
+
+        # Current and upcoming time partitions (heap tables are migrated in the background)
+        self.partitions.ensure()
+
+    def publish_mqtt(self, device_id, topic, payload):
+        """Publish a relay control message if a connected client is registered under the key"""
+        self.engine.publish(device_id, topic, payload)
+
+    def handle_flush(self, events):
+        """Relay thresholds after a flush; web workers emit from the ingest bus notifications"""
+        for event in events:
+            try:
+                if event.get("has_relay"):
+                    self.pipeline.process_thresholds(event["device_id"], event.get("user_id"))
+            except Exception as e:
+                logger.error(f"[INGEST] Post-flush processing failed for device {event['device_id']}: {e}")
+
+    def start(self):
+        """Load the caches and start writing; the active ingester then starts its jobs and collectors"""
+        logger.info("[INGEST] 📇 Loading device registry...")
+        self.registry.load()
+        try:
+            self.threshold_engine.warm_start()
+        except Exception as e:
+            logger.error(f"[INGEST] Threshold warm start failed: {e}")
+        self.writer.start()
+        for job in self.jobs:
+            job.start()
+        if self.engine is None:
+            return
+        self.control.sync_sources()
+        if self.shards:
+            self.shards.start()
+        self.engine.start()
+        logger.info("[INGEST] ✨ Active ingester ready")
+
+    def stop(self):
+        if self.engine is not None:
+            self.engine.stop()
+        if self.shards:
+            self.shards.stop()
+        self.writer.stop()
+
+
+class IngestService:
+    """Campaigns for the ingest lock and runs the ingest stack while holding it"""
+
+    def __init__(self):
+        db_config = db_config_from_env()
+        self.pool = ConnectionPool(
+            minconn=1,
+            maxconn=int(os.getenv('DB_POOL_MAX', 20)),
+            checkout_timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+            statement_timeout_ms=int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 30000)),
+            **db_config
+        )
+        self.stack = IngestStack(self.pool.getconn, self.pool.putconn, PostgresBus())
+        self.leader = LeaderLock(db_config, on_elected=self.stack.start, on_demoted=self.demoted,
+                                 on_control=self.stack.control)
+        self._stop = threading.Event()
+
+    def demoted(self):
+        """The lock session broke: stop at once and let the supervisor restart us as a standby"""
+        logger.error("[INGEST] 💥 Lost the ingest lock; stopping so a standby can take over")
+        self.stack.stop()
+        os._exit(3)
+
+    def run(self):
+        # Schema first: an instance must not be elected and write into tables that are not there yet
+        while not self._stop.is_set():
+            try:
+                self.stack.ensure_schema()
+                break
+            except Exception as e:
+                logger.error(f"[INGEST] Schema setup failed, retrying in {SCHEMA_RETRY_SECONDS}s: {e}")
+                self._stop.wait(SCHEMA_RETRY_SECONDS)
+        else:
+            return
+        self.leader.start()
+        while not self._stop.wait(SOURCE_SYNC_SECONDS):
+            if self.leader.is_leader:
+                try:
+                    self.stack.control.sync_sources()
+                except Exception as e:
+                    logger.error(f"[INGEST] Data source sync failed: {e}")
+        if self.leader.is_leader:
+            self.stack.stop()
+        self.leader.stop()
+
+    def stop(self, *_):
+        self._stop.set()
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    service = IngestService()
+    signal.signal(signal.SIGTERM, service.stop)
+    signal.signal(signal.SIGINT, service.stop)
+    service.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,324 @@
+"""Multi-process ingest sharded by device.
+
+With ``INGEST_PROCESSES`` > 0 the MQTT receiver stops decoding messages
+itself.  Each message is routed by a consistent hash of (data source, device
+id) to one of N shard processes, so a device always lands on the same process:
+its rows are written in arrival order and its rolling threshold window lives
+in one place.  The device id is found with a byte-level scan of the raw
+payload; JSON parsing, payload mapping, logging and the batch writer all run
+in the shards, so ingest throughput scales with cores, not with the web tier.
+
+Shards are ``python -m ingest_shards`` subprocesses that build their own pool
+and writer-side ``ingest_service.IngestStack`` from the environment and never
+import Flask.  Messages travel over an OS pipe as length-prefixed batches of
+raw frames, with no pickling; a payload is copied once into the batch buffer
+and once out of it::
+
+    batch := u32 length | frame*
+    frame := i32 data_source_id | u16 topic length | u32 payload length | topic | payload
+
+Relay control messages produced by a shard come back as JSON lines on a second
+pipe and are published by the receiver, which owns the broker connections.
+Device and threshold changes travel the other way as frames with data source
+``CONTROL_SOURCE_ID`` carrying an ``ingest_leader`` control message.
+A shard whose pipe breaks is restarted, and the batch whose write failed is
+sent to its replacement.  Whatever the dead shard had already taken is lost:
+frames still in the old pipe and rows in its writer's unflushed batch (up to
+``INGEST_BATCH_MS`` of its devices' traffic).  The broker will not redeliver
+them, because the receiver has already acknowledged them.  Batches the shard
+had spooled are kept and replayed by the replacement, which reopens the same
+spool directory.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import select
+import struct
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+FRAME = struct.Struct("<iHI")
+BATCH_HEADER = struct.Struct("<I")
+RING_REPLICAS = 64
+MAX_BATCH_BYTES = 256 * 1024
+QUEUE_PUT_TIMEOUT_SECONDS = 1.0
+CONTROL_SOURCE_ID = -1
+
+_DEVICE_ID_RE = re.compile(rb'"(?:deviceid|i)"\s*:\s*"?([^",}\s]*)')
+
+
+def _hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes; resizing moves about 1/N of the keys"""
+
+    def __init__(self, shards, replicas=RING_REPLICAS):
+        points = sorted((_hash(b"%d#%d" % (shard, replica)), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        index = bisect.bisect(self._points, _hash(key))
+        return self._shards[index % len(self._points)]
+
+
+def shard_key(data_source_id, raw_payload):
+    """Routing key without decoding JSON: data source plus the ``deviceid``/``i`` value"""
+    match = _DEVICE_ID_RE.search(raw_payload)
+    return b"%d:%s" % (data_source_id, match.group(1) if match else b"")
+
+
+def iter_frames(batch):
+    """(data_source_id, topic, payload bytes) for every frame in a batch body"""
+    offset, end = 0, len(batch)
+    while offset < end:
+        data_source_id, topic_length, payload_length = FRAME.unpack_from(batch, offset)
+        offset += FRAME.size
+        topic = batch[offset:offset + topic_length].decode()
+        offset += topic_length
+        yield data_source_id, topic, batch[offset:offset + payload_length]
+        offset += payload_length
+
+
+def _write_all(fd, data):
+    """Write a whole buffer to a non-blocking fd (cooperative under eventlet as well)"""
+    view = memoryview(data)
+    while view:
+        try:
+            written = os.write(fd, view)
+        except BlockingIOError:
+            select.select([], [fd], [])
+            continue
+        view = view[written:]
+
+
+class _Shard:
+    def __init__(self, index, process, data_fd, control_fd):
+        self.index = index
+        self.process = process
+        self.data_fd = data_fd
+        self.control_fd = control_fd
+
+    def close(self):
+        for fd in (self.data_fd, self.control_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class ShardedIngest:
+    """Receiver side: routes raw messages to shard processes and relays their control messages"""
+
+    def __init__(self, processes, publish=None, queue_size=10000, max_batch_bytes=MAX_BATCH_BYTES):
+        self.processes = processes
+        self.publish = publish
+        self.max_batch_bytes = max_batch_bytes
+        self.ring = HashRing(processes)
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(processes)]
+        self._shards = [None] * processes
+        self._threads = []
+        self._running = False
+        self.stats = {"submitted": 0, "dropped": 0, "batches": 0, "bytes_sent": 0, "restarts": 0,
+                      "control_messages": 0, "per_shard": [0] * processes}
+
+    def submit(self, data_source_id, topic, payload):
+        """Queue one raw message for the shard that owns its device"""
+        index = self.ring.shard_for(shard_key(data_source_id, payload))
+        try:
+            self._queues[index].put((data_source_id, topic, payload), timeout=QUEUE_PUT_TIMEOUT_SECONDS)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            logger.error(f"[SHARDS] Queue of shard {index} full, dropped message from source {data_source_id}")
+            return
+        self.stats["submitted"] += 1
+        self.stats["per_shard"][index] += 1
+
+    def broadcast(self, message):
+        """Send a control message (see ``ingest_leader.IngestControl``) to every shard"""
+        payload = json.dumps(message).encode()
+        for pending in self._queues:
+            pending.put((CONTROL_SOURCE_ID, "control", payload))
+
+    def _spawn(self, index):
+        data_r, data_w = os.pipe()
+        control_r, control_w = os.pipe()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "ingest_shards", str(index), str(data_r), str(control_w)],
+            pass_fds=(data_r, control_w),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        os.close(data_r)
+        os.close(control_w)
+        os.set_blocking(data_w, False)
+        os.set_blocking(control_r, False)
+        shard = _Shard(index, process, data_w, control_r)
+        self._shards[index] = shard
+        thread = threading.Thread(target=self._control_loop, args=(shard,), daemon=True,
+                                  name=f"IngestShard-{index}-control")
+        thread.start()
+        logger.info(f"[SHARDS] Started shard {index} (pid {process.pid})")
+        return shard
+
+    def _restart(self, index):
+        shard = self._shards[index]
+        shard.close()
+        if shard.process.poll() is None:
+            shard.process.terminate()
+        self.stats["restarts"] += 1
+        return self._spawn(index)
+
+    def _send(self, index, buffer, frames):
+        for attempt in range(2):
+            try:
+                _write_all(self._shards[index].data_fd, buffer)
+                self.stats["batches"] += 1
+                self.stats["bytes_sent"] += len(buffer)
+                return
+            except OSError as e:
+                logger.error(f"[SHARDS] Shard {index} pipe failed ({e}); restarting it")
+                if not self._running:
+                    break
+                self._restart(index)
+        self.stats["dropped"] += frames
+
+    def _send_loop(self, index):
+        """Coalesce whatever is queued for a shard into one batch per write"""
+        pending = self._queues[index]
+        stopping = False
+        while not stopping:
+            item = pending.get()
+            if item is None:
+                break
+            buffer = bytearray(BATCH_HEADER.size)
+            frames = 0
+            while item is not None:
+                data_source_id, topic, payload = item
+                topic = topic.encode()
+                buffer += FRAME.pack(data_source_id, len(topic), len(payload))
+                buffer += topic
+                buffer += payload
+                frames += 1
+                if len(buffer) >= self.max_batch_bytes:
+                    break
+                try:
+                    item = pending.get_nowait()
+                except queue.Empty:
+                    break
+                stopping = item is None
+            BATCH_HEADER.pack_into(buffer, 0, len(buffer) - BATCH_HEADER.size)
+            self._send(index, buffer, frames)
+
+    def _control_loop(self, shard):
+        """Publish the relay control messages a shard sends back, until its pipe closes"""
+        pending = b""
+        while True:
+            try:
+                chunk = os.read(shard.control_fd, 65536)
+            except BlockingIOError:
+                select.select([shard.control_fd], [], [])
+                continue
+            except OSError:
+                break
+            if not chunk:
+                break
+            *lines, pending = (pending + chunk).split(b"\n")
+            for line in lines:
+                try:
+                    device_id, topic, payload = json.loads(line)
+                    self.stats["control_messages"] += 1
+                    if self.publish:
+                        self.publish(device_id, topic, payload)
+                except Exception as e:
+                    logger.error(f"[SHARDS] Bad control message from shard {shard.index}: {e}")
+
+    def metrics(self):
+        return {**self.stats,
+                "queue_depths": [q.qsize() for q in self._queues],
+                "alive": [bool(s and s.process.poll() is None) for s in self._shards]}
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        for index in range(self.processes):
+            self._spawn(index)
+        self._threads = [threading.Thread(target=self._send_loop, args=(index,), daemon=True,
+                                          name=f"IngestShard-{index}-send")
+                         for index in range(self.processes)]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"[SHARDS] Sharded ingest started with {self.processes} processes")
+
+    def stop(self):
+        """Drain the queues, then close the pipes so every shard flushes and exits"""
+        for pending in self._queues:
+            pending.put(None)
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._running = False
+        for shard in self._shards:
+            if shard:
+                shard.close()
+                try:
+                    shard.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    shard.process.kill()
+
+
+def run_shard(index, data_fd, control_fd):
+    """Shard process: decode and write every message read from ``data_fd`` until it closes"""
+    from db_pool import ConnectionPool, db_config_from_env
+    from ingest_bus import PostgresBus
+    from ingest_service import IngestStack
+
+    logging.basicConfig(level=logging.INFO,
+                        format=f"%(asctime)s [shard-{index}] %(levelname)s %(name)s: %(message)s")
+    pool = ConnectionPool(
+        minconn=1,
+        maxconn=int(os.getenv('INGEST_SHARD_DB_POOL_MAX', 4)),
+        checkout_timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        statement_timeout_ms=int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 30000)),
+        **db_config_from_env()
+    )
+    control = os.fdopen(control_fd, "w", buffering=1)
+    control_lock = threading.Lock()
+
+    def publish(device_id, topic, payload):
+        with control_lock:
+            control.write(json.dumps([device_id, topic, payload]) + "\n")
+
+    # Web workers update their live windows from the ingest bus notifications
+    stack = IngestStack(pool.getconn, pool.putconn, PostgresBus(), publish=publish, shard=index)
+    stack.start()
+
+    data = os.fdopen(data_fd, "rb")
+    try:
+        while True:
+            header = data.read(BATCH_HEADER.size)
+            if len(header) < BATCH_HEADER.size:
+                break
+            (length,) = BATCH_HEADER.unpack(header)
+            for data_source_id, topic, payload in iter_frames(data.read(length)):
+                if data_source_id == CONTROL_SOURCE_ID:
+                    stack.control(json.loads(payload))
+                else:
+                    stack.pipeline.handle_message(data_source_id, topic, payload)
+    finally:
+        stack.stop()
+        pool.closeall()
+        logger.info(f"[SHARDS] Shard {index} stopped")
+
+
+if __name__ == "__main__":
+    run_shard(int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3]))
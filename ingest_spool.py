@@ -0,0 +1,277 @@
+"""Durable on-disk spool for ingest batches the database cannot take right now.
+
+When a flush fails (Postgres down, timeouts) or the in-memory batch grows past
+``max_pending_rows`` because a flush is stuck, the ``BatchWriter`` appends the
+batch here instead of dropping it.  While the spool holds anything, every new
+batch is appended behind it, and the writer thread replays the oldest records
+with its normal bulk-insert flush once the database answers again, so rows
+reach the database in arrival order and ingest never waits on the database.
+
+Records are appended to numbered segment files under ``root``::
+
+    record := u32 length | u32 crc32 | JSON {"rows": {table: [row, ...]}, "events": [...]}
+
+Each append is fsynced.  A segment is rolled at ``segment_bytes`` and deleted
+once fully replayed; the replay position is kept in ``cursor`` so a restart
+resumes where it stopped.  A torn record at the end of a segment (crash during
+append) is skipped.
+
+Records are ingest batches by default; ``encode``/``decode`` store other items
+(the MQTT engine spills raw messages here when its queue overflows).
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
+
+from ingest_writer import IngestBatch, TABLE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct("<II")
+SEGMENT_BYTES = 16 * 1024 * 1024
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+RATE_WINDOW_SECONDS = 60
+
+_TIMESTAMP_INDEX = {table: columns.index("timestamp") for table, columns in TABLE_COLUMNS.items()}
+
+
+def encode_batch(batch):
+    rows = {}
+    for table, table_rows in batch.rows.items():
+        if not table_rows:
+            continue
+        ts_index = _TIMESTAMP_INDEX[table]
+        encoded = rows[table] = []
+        for values in table_rows:
+            values = list(values)
+            if isinstance(values[ts_index], datetime):
+                values[ts_index] = values[ts_index].isoformat()
+            encoded.append(values)
+    return json.dumps({"rows": rows, "events": list(batch.events.values())},
+                      separators=(",", ":"), default=str).encode()
+
+
+def decode_batch(data):
+    record = json.loads(data)
+    batch = IngestBatch()
+    for table, table_rows in record["rows"].items():
+        ts_index = _TIMESTAMP_INDEX[table]
+        width = len(TABLE_COLUMNS[table])
+        for values in table_rows:
+            # Records spooled before a column was added (e.g. payload_hash) leave it NULL
+            values.extend([None] * (width - len(values)))
+            if values[ts_index] is not None:
+                values[ts_index] = datetime.fromisoformat(values[ts_index])
+            batch.rows[table].append(tuple(values))
+    batch.events = {event["device_id"]: event for event in record["events"]}
+    return batch
+
+
+class Spool:
+    """Append-only segment files with a persisted replay cursor"""
+
+    def __init__(self, root, segment_bytes=SEGMENT_BYTES, fsync=True, encode=encode_batch, decode=decode_batch,
+                 size=len):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.encode = encode
+        self.decode = decode
+        # Rows in an item, for the spooled/replayed row counts
+        self.size = size
+        self._lock = threading.Lock()
+        self._segments = []
+        self._write_file = None
+        self._read_segment = None
+        self._read_offset = 0
+        self._read_file = None
+        self._pending_size = 0
+        self._opened = False
+        self._replayed = deque()
+        self.depth_records = 0
+        self.depth_bytes = 0
+        self.stats = {"spooled_records": 0, "spooled_rows": 0, "replayed_records": 0, "replayed_rows": 0,
+                      "torn_records": 0}
+
+    # -- files --
+
+    def child(self, name):
+        """A separate spool in subdirectory ``name`` with the same settings (e.g. a quarantine)"""
+        return Spool(os.path.join(self.root, name), segment_bytes=self.segment_bytes, fsync=self.fsync,
+                     encode=self.encode, decode=self.decode, size=self.size)
+
+    def _path(self, segment):
+        return os.path.join(self.root, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _scan(self, segment, offset=0):
+        """(records, bytes) of complete records in a segment from ``offset``"""
+        records, size = 0, 0
+        with open(self._path(segment), "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                length, _ = RECORD.unpack(header)
+                if len(f.read(length)) < length:
+                    break
+                records += 1
+                size += RECORD.size + length
+        return records, size
+
+    def _save_cursor(self):
+        tmp = os.path.join(self.root, CURSOR_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(f"{self._read_segment} {self._read_offset}")
+        os.replace(tmp, os.path.join(self.root, CURSOR_FILE))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.root, CURSOR_FILE)) as f:
+                segment, offset = f.read().split()
+            return int(segment), int(offset)
+        except (OSError, ValueError):
+            return None, 0
+
+    def _roll(self):
+        if self._write_file is not None:
+            self._write_file.close()
+        segment = self._segments[-1] + 1 if self._segments else 1
+        self._segments.append(segment)
+        self._write_file = open(self._path(segment), "ab")
+
+    def open(self):
+        """Find leftover segments (and the replay cursor) and start a fresh write segment"""
+        with self._lock:
+            if self._opened:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            self.depth_records = self.depth_bytes = 0
+            self._read_segment, self._read_offset = None, 0
+            self._segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.root)
+                                    if name.endswith(SEGMENT_SUFFIX))
+            cursor_segment, cursor_offset = self._load_cursor()
+            for segment in list(self._segments):
+                if cursor_segment is not None and segment < cursor_segment:
+                    os.remove(self._path(segment))
+                    self._segments.remove(segment)
+                    continue
+                offset = cursor_offset if segment == cursor_segment else 0
+                records, size = self._scan(segment, offset)
+                self.depth_records += records
+                self.depth_bytes += size
+            if self._segments:
+                self._read_segment = self._segments[0]
+                self._read_offset = cursor_offset if self._read_segment == cursor_segment else 0
+            self._roll()
+            if self._read_segment is None:
+                self._read_segment = self._segments[0]
+            self._opened = True
+        if self.depth_records:
+            logger.warning(f"[SPOOL] {self.depth_records} spooled records ({self.depth_bytes} bytes) "
+                           f"waiting for replay in {self.root}")
+
+    def close(self):
+        with self._lock:
+            for f in (self._write_file, self._read_file):
+                if f is not None:
+                    f.close()
+            self._write_file = self._read_file = None
+            self._opened = False
+
+    # -- append / replay --
+
+    def append(self, item):
+        data = self.encode(item)
+        with self._lock:
+            if self._write_file.tell() >= self.segment_bytes:
+                self._roll()
+            self._write_file.write(RECORD.pack(len(data), zlib.crc32(data)) + data)
+            self._write_file.flush()
+            if self.fsync:
+                os.fsync(self._write_file.fileno())
+            self.depth_records += 1
+            self.depth_bytes += RECORD.size + len(data)
+            self.stats["spooled_records"] += 1
+            self.stats["spooled_rows"] += self.size(item)
+
+    def peek(self):
+        """Oldest unreplayed item (None when empty); ``advance()`` once it is written"""
+        with self._lock:
+            while self.depth_records:
+                if self._read_file is None:
+                    self._read_file = open(self._path(self._read_segment), "rb")
+                self._read_file.seek(self._read_offset)
+                header = self._read_file.read(RECORD.size)
+                if len(header) == RECORD.size:
+                    length, crc = RECORD.unpack(header)
+                    data = self._read_file.read(length)
+                    if len(data) == length and zlib.crc32(data) == crc:
+                        self._pending_size = RECORD.size + length
+                        return self.decode(data)
+                    if len(data) == length:
+                        # Corrupt but complete: skip this record only
+                        self.stats["torn_records"] += 1
+                        logger.error(f"[SPOOL] Skipping corrupt record in segment {self._read_segment}")
+                        self._read_offset += RECORD.size + length
+                        self.depth_records -= 1
+                        self.depth_bytes -= RECORD.size + length
+                        continue
+                if self._read_segment == self._segments[-1]:
+                    return None
+                if header:
+                    self.stats["torn_records"] += 1
+                    logger.error(f"[SPOOL] Skipping torn record at the end of segment {self._read_segment}")
+                self._next_segment()
+            return None
+
+    def advance(self, rows):
+        """Mark the item returned by ``peek()`` as written"""
+        with self._lock:
+            self._read_offset += self._pending_size
+            self.depth_records -= 1
+            self.depth_bytes -= self._pending_size
+            self.stats["replayed_records"] += 1
+            self.stats["replayed_rows"] += rows
+            self._replayed.append((time.monotonic(), rows))
+            if self._read_segment != self._segments[-1] and self._read_offset >= os.path.getsize(
+                    self._path(self._read_segment)):
+                self._next_segment()
+            self._save_cursor()
+
+    def _next_segment(self):
+        if self._read_file is not None:
+            self._read_file.close()
+            self._read_file = None
+        os.remove(self._path(self._read_segment))
+        self._segments.remove(self._read_segment)
+        self._read_segment = self._segments[0]
+        self._read_offset = 0
+
+    def replay_rate(self):
+        """Rows per second replayed over the last ``RATE_WINDOW_SECONDS``"""
+        cutoff = time.monotonic() - RATE_WINDOW_SECONDS
+        with self._lock:
+            while self._replayed and self._replayed[0][0] < cutoff:
+                self._replayed.popleft()
+            return round(sum(rows for _, rows in self._replayed) / RATE_WINDOW_SECONDS, 1)
+
+    def metrics(self):
+        return {**self.stats, "depth_records": self.depth_records, "depth_bytes": self.depth_bytes,
+                "segments": len(self._segments), "replay_rows_per_s": self.replay_rate()}
+
+
+def spool_from_env(name=None, **kwargs):
+    """Spool under ``INGEST_SPOOL_DIR`` (default ``spool``; empty disables), in subdirectory ``name``"""
+    root = os.getenv('INGEST_SPOOL_DIR', 'spool')
+    if not root:
+        return None
+    return Spool(os.path.join(root, name) if name else root,
+                 segment_bytes=int(os.getenv('INGEST_SPOOL_SEGMENT_MB', 16)) * 1024 * 1024, **kwargs)
@@ -0,0 +1,416 @@
+"""Batched writer for MQTT telemetry.
+
+Ingest callbacks parse messages into row dicts and hand them to a
+``BatchWriter``.  A dedicated writer thread flushes the pending rows with one
+multi-row INSERT per table and a single COMMIT, either when ``max_rows`` rows
+are waiting or ``max_delay`` seconds after the first row of the batch arrived.
+Post-processing (websocket emits, threshold checks) runs after the flush via
+the ``on_flush`` callback.
+
+Derived tables are maintained by *stages*: objects with a
+``write(cur, batch)`` method that runs inside the flush transaction and an
+``after_commit(batch, state)`` method that receives whatever ``write``
+returned once the transaction has committed.
+
+Rows are inserted with ``ON CONFLICT DO NOTHING`` against the unique
+``(device_id, timestamp, payload_hash)`` reading key (see ``dedup``); rows
+that already existed are
+removed from the batch before the stages run, so a redelivered message or a
+replayed batch is never counted twice in rollups or the live feed.
+
+A flush is one transaction: either it commits or nothing of it is written.
+Rows the database rejects as bad data (invalid values, constraint
+violations) are isolated by bisecting the batch under savepoints and logged,
+so one bad row costs that row only; a failing stage is rolled back to its
+savepoint and logged without costing the raw rows.
+
+With a ``spool`` (see ``ingest_spool``) a batch the database cannot take
+right now (connection or pool errors, ``TRANSIENT_ERRORS``) is written to
+disk instead of being dropped, and replayed in order by this thread once
+flushes succeed again; a spooled batch is only advanced past once its flush
+has committed.  A batch that fails for any other reason would fail again on
+every replay and block the batches behind it, so it is moved to a
+``quarantine`` spool in a subdirectory of the main one (never replayed
+automatically) and the writer moves on.  Spool appends from producer threads happen outside
+the queue lock, so a slow fsync only holds up the thread that spills.
+"""
+import logging
+import threading
+import time
+from collections import Counter, deque
+from datetime import timezone
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from db_pool import PoolTimeout
+
+logger = logging.getLogger(__name__)
+
+# Failures worth retrying from the spool; anything else (bad data) would fail again on replay
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+# Errors caused by the values of a row, isolated and rejected row by row
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 30.0
+# Spooled batches replayed per pass, so new batches keep being spooled while a backlog drains
+REPLAY_BATCHES_PER_PASS = 20
+
+# Outcome of BatchWriter._write: committed, rolled back and worth retrying, or rolled back for good
+WRITTEN = "written"
+RETRY = "retry"
+QUARANTINED = "quarantined"
+STAGE_FAILED = object()
+
+SENSOR_COLUMNS = (
+    "timestamp", "device_id", "data_source_id",
+    "pm1", "pm2_5", "pm4", "pm10", "tsp",
+    "payload_hash",
+)
+
+EXTENDED_COLUMNS = (
+    "device_id", "timestamp",
+    "temperature_c", "humidity_percent", "pressure_hpa",
+    "voc_ppb", "no2_ppb", "noise_db",
+    "pm1", "pm2_5", "pm4", "pm10", "tsp_um",
+    "gps_lat", "gps_lon", "gps_alt_m", "gps_speed_kmh",
+    "cloud_cover_percent", "lux", "uv_index", "battery_percent",
+    "payload_hash",
+)
+
+TABLE_COLUMNS = {
+    "dust_sensor_data": SENSOR_COLUMNS,
+    "dust_extended_data": EXTENDED_COLUMNS,
+}
+
+
+# Identity of a reading for duplicate suppression; ``payload_hash`` is NULL unless
+# the row carries the device's own timestamp
+READING_KEY_COLUMNS = ("device_id", "timestamp", "payload_hash")
+
+
+def _reading_key(device_id, timestamp, digest):
+    # Naive timestamps are stored as UTC (the sessions run in UTC)
+    if timestamp is not None and timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return device_id, timestamp, digest
+
+
+class IngestBatch:
+    """Rows and post-flush events collected between two flushes"""
+
+    def __init__(self):
+        self.rows = {table: [] for table in TABLE_COLUMNS}
+        self.events = {}
+        self.started_at = None
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.rows.values())
+
+
+class BatchWriter:
+    """Collects telemetry rows and writes them in bulk from a single thread"""
+
+    def __init__(self, get_conn, put_conn, max_rows=500, max_delay=0.25, on_flush=None, stages=None,
+                 spool=None, max_pending_rows=None):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.on_flush = on_flush
+        self.stages = list(stages or [])
+        self.spool = spool
+        # Batches that failed with a non-transient error, kept for inspection instead of blocking replay
+        self.quarantine = None
+        if spool is not None:
+            self.quarantine = spool.child("quarantine")
+        # With a spool, rows piling up behind a stuck flush are spilled to disk past this many
+        self.max_pending_rows = max_pending_rows or max_rows * 10
+        self._batch = IngestBatch()
+        self._cond = threading.Condition()
+        # Batches on their way to the spool, appended in order by whichever thread holds _spill_lock
+        self._spills = deque()
+        self._spill_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._failures = 0
+        self._retry_at = 0.0
+        self.stats = {"flushes": 0, "rows_written": 0, "duplicates": 0, "rejected": 0, "errors": 0,
+                      "stage_errors": 0, "quarantined_batches": 0, "quarantined_rows": 0,
+                      "last_flush_ms": 0.0}
+
+    def add(self, table, row, event=None):
+        """Queue one row for ``table``; ``event`` is merged per device for the post-flush hook"""
+        self.add_values(table, tuple(row.get(col) for col in TABLE_COLUMNS[table]), event)
+
+    def add_values(self, table, values, event=None):
+        """Queue one row already laid out in ``TABLE_COLUMNS[table]`` order (see ``payload_decoders``)"""
+        self._queue(table, (tuple(values),), (event,) if event else ())
+
+    def add_columns(self, table, columns, events=()):
+        """Queue many rows given as column arrays (``PayloadFormat.decode_columns``)"""
+        self._queue(table, list(zip(*columns)), events)
+
+    def _queue(self, table, rows, events):
+        spilled = False
+        with self._cond:
+            batch = self._batch
+            if batch.started_at is None:
+                batch.started_at = time.monotonic()
+            batch.rows[table].extend(rows)
+            for event in events:
+                merged = batch.events.setdefault(event["device_id"], {})
+                for key, value in event.items():
+                    # Flags such as ``extended`` stay set once any row in the batch set them
+                    merged[key] = merged.get(key) or value
+            if self.spool is not None and len(batch) >= self.max_pending_rows:
+                # The writer is stuck in a slow flush: keep the rows on disk rather than in memory
+                self._batch = IngestBatch()
+                self._spills.append(batch)
+                spilled = True
+            elif len(batch) >= self.max_rows:
+                self._cond.notify()
+        if spilled:
+            self._drain_spills()
+
+    def _spill(self, batch):
+        self._spills.append(batch)
+        self._drain_spills()
+
+    def _drain_spills(self):
+        """Append queued spills to the spool in order, without holding the queue lock"""
+        with self._spill_lock:
+            while self._spills:
+                self.spool.append(self._spills.popleft())
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        if self.spool is not None:
+            self.spool.open()
+            self.quarantine.open()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="IngestWriter")
+        self._thread.start()
+        logger.info(f"[INGEST] Batch writer started (max_rows={self.max_rows}, max_delay={self.max_delay}s)")
+
+    def stop(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.flush()
+        if self.spool is not None:
+            self.spool.close()
+            self.quarantine.close()
+
+    def metrics(self):
+        return {**self.stats, "spool": self.spool.metrics() if self.spool is not None else None}
+
+    def _take_batch(self):
+        with self._cond:
+            while self._running and not self._replay_due():
+                batch = self._batch
+                if batch.started_at is not None:
+                    remaining = batch.started_at + self.max_delay - time.monotonic()
+                    if len(batch) >= self.max_rows or remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait(self.max_delay)
+            batch, self._batch = self._batch, IngestBatch()
+            return batch
+
+    def _run(self):
+        while self._running:
+            batch = self._take_batch()
+            if len(batch):
+                self._write_or_spool(batch)
+            if self._replay_due():
+                self._replay()
+
+    def flush(self):
+        """Write whatever is pending right now (used on shutdown and by tests/benchmarks)"""
+        with self._cond:
+            batch, self._batch = self._batch, IngestBatch()
+        if len(batch):
+            self._write_or_spool(batch)
+
+    def _replay_due(self):
+        return self.spool is not None and self.spool.depth_records > 0 and time.monotonic() >= self._retry_at
+
+    def _write_or_spool(self, batch):
+        if self.spool is None:
+            self._write(batch)
+        elif self.spool.depth_records or self._spills:
+            # Stay behind the backlog so rows reach the database in arrival order
+            self._spill(batch)
+        elif self._write(batch) is RETRY:
+            self._spill(batch)
+            self._backoff()
+
+    def _backoff(self):
+        delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** self._failures)
+        self._failures += 1
+        self._retry_at = time.monotonic() + delay
+        logger.warning(f"[INGEST] Spooling to disk, retrying the database in {delay:.0f}s "
+                       f"({self.spool.depth_records} batches spooled)")
+
+    def _replay(self):
+        for _ in range(REPLAY_BATCHES_PER_PASS):
+            batch = self.spool.peek()
+            if batch is None:
+                break
+            outcome = self._write(batch)
+            if outcome is RETRY:
+                self._backoff()
+                return
+            # A quarantined batch is moved past like a written one, so it cannot block the spool
+            self.spool.advance(len(batch) if outcome is WRITTEN else 0)
+        self._failures = 0
+        if not self.spool.depth_records:
+            logger.info("[INGEST] Spool drained, writing to the database directly again")
+
+    def _drop_duplicates(self, batch, table, inserted):
+        """Keep only the rows this flush actually inserted, for the stages and post-flush hook"""
+        indexes = [TABLE_COLUMNS[table].index(c) for c in READING_KEY_COLUMNS]
+        # A Counter, since rows without a hash never conflict and can share a key
+        keys = Counter(_reading_key(*key) for key in inserted)
+        rows, kept = batch.rows[table], []
+        for values in rows:
+            key = _reading_key(*(values[i] for i in indexes))
+            if keys[key] > 0:
+                keys[key] -= 1
+                kept.append(values)
+        batch.rows[table] = kept
+        self.stats["duplicates"] += len(rows) - len(batch.rows[table])
+
+    def _insert(self, cur, table, rows):
+        """Insert rows under a savepoint; returns the reading keys of the rows actually inserted"""
+        columns = TABLE_COLUMNS[table]
+        cur.execute("SAVEPOINT ingest_rows")
+        inserted = execute_values(
+            cur,
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s "
+            f"ON CONFLICT DO NOTHING RETURNING {', '.join(READING_KEY_COLUMNS)}",
+            rows,
+            page_size=self.max_rows,
+            fetch=True,
+        )
+        cur.execute("RELEASE SAVEPOINT ingest_rows")
+        return inserted
+
+    def _insert_bisect(self, cur, table, rows):
+        """Insert what can be inserted of ``rows`` after a bulk insert failed on bad data.
+
+        Halves are retried under their own savepoints until the offending rows
+        are isolated; those are logged and left out.  Any other error aborts
+        the whole flush as usual.
+        """
+        try:
+            return self._insert(cur, table, rows), []
+        except ROW_ERRORS as e:
+            cur.execute("ROLLBACK TO SAVEPOINT ingest_rows")
+            if len(rows) == 1:
+                logger.error(f"[INGEST] Rejected {table} row {rows[0]!r}: {e}")
+                return [], rows
+        middle = len(rows) // 2
+        inserted, rejected = self._insert_bisect(cur, table, rows[:middle])
+        more_inserted, more_rejected = self._insert_bisect(cur, table, rows[middle:])
+        return inserted + more_inserted, rejected + more_rejected
+
+    def _write(self, batch):
+        """Flush one batch in one transaction.
+
+        Returns WRITTEN once committed, RETRY if nothing was written for a
+        transient reason, or QUARANTINED if nothing was written and retrying
+        would not help.
+        """
+        started = time.perf_counter()
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            for table, rows in batch.rows.items():
+                if not rows:
+                    continue
+                try:
+                    inserted = self._insert(cur, table, rows)
+                except ROW_ERRORS as e:
+                    logger.warning(f"[INGEST] Bulk insert of {len(rows)} {table} rows failed, isolating bad rows: {e}")
+                    cur.execute("ROLLBACK TO SAVEPOINT ingest_rows")
+                    inserted, rejected = self._insert_bisect(cur, table, rows)
+                    if rejected:
+                        rejected_ids = {id(values) for values in rejected}
+                        rows = batch.rows[table] = [values for values in rows if id(values) not in rejected_ids]
+                        self.stats["rejected"] += len(rejected)
+                if len(inserted) < len(rows):
+                    self._drop_duplicates(batch, table, inserted)
+            stage_states = [self._stage_write(cur, stage, batch) for stage in self.stages]
+            conn.commit()
+        except Exception as e:
+            self.stats["errors"] += 1
+            if conn:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+            if isinstance(e, TRANSIENT_ERRORS):
+                logger.error(f"[INGEST] Failed to flush {len(batch)} rows: {e}")
+                return RETRY
+            self._quarantine(batch, e)
+            return QUARANTINED
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["flushes"] += 1
+        self.stats["rows_written"] += len(batch)
+        self.stats["last_flush_ms"] = round(elapsed_ms, 2)
+        logger.debug(f"[INGEST] Flushed {len(batch)} rows in {elapsed_ms:.1f} ms")
+
+        for stage, state in zip(self.stages, stage_states):
+            if state is STAGE_FAILED:
+                continue
+            try:
+                stage.after_commit(batch, state)
+            except Exception as e:
+                logger.error(f"[INGEST] {type(stage).__name__} after-commit failed: {e}")
+
+        if self.on_flush and batch.events:
+            try:
+                self.on_flush(list(batch.events.values()))
+            except Exception as e:
+                logger.error(f"[INGEST] Post-flush hook failed: {e}")
+        return WRITTEN
+
+    def _quarantine(self, batch, error):
+        self.stats["quarantined_batches"] += 1
+        self.stats["quarantined_rows"] += len(batch)
+        if self.quarantine is None:
+            logger.error(f"[INGEST] Dropped {len(batch)} rows the database will not take: {error}")
+            return
+        try:
+            self.quarantine.append(batch)
+        except Exception as e:
+            logger.error(f"[INGEST] Could not quarantine {len(batch)} rows, dropped them: {e}")
+            return
+        logger.error(f"[INGEST] Quarantined {len(batch)} rows the database will not take "
+                     f"in {self.quarantine.root}: {error}")
+
+    def _stage_write(self, cur, stage, batch):
+        """Run a stage under a savepoint so a failing stage does not cost the raw rows"""
+        cur.execute("SAVEPOINT ingest_stage")
+        try:
+            state = stage.write(cur, batch)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT ingest_stage")
+            self.stats["stage_errors"] += 1
+            logger.error(f"[INGEST] {type(stage).__name__} failed, rows written without it: {e}")
+            return STAGE_FAILED
+        cur.execute("RELEASE SAVEPOINT ingest_stage")
+        return state
@@ -0,0 +1,303 @@
+"""Latest reading per device, kept in ``dust_device_latest`` and mirrored in memory.
+
+The batch writer calls ``write()`` inside its flush transaction to upsert the
+newest PM values, extended values and GPS fix of every device in the batch,
+and ``after_commit()`` once the flush is durable to update the in-process
+mirror.  Readers get a dict hit, or a single primary-key read on a miss,
+instead of ``ORDER BY timestamp DESC LIMIT 1`` over the history tables.
+
+When the table is first created it is filled in the background on the ingest
+leader, a chunk of device ids per short transaction (tracked in
+``dust_migration_state``), from each device's newest rows within
+``LATEST_BACKFILL_DAYS``.  Devices silent for longer start empty.  Other
+processes pick backfilled devices up on their next mirror miss.
+"""
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from psycopg2.extras import execute_values, Json, RealDictCursor
+
+from ingest_writer import TABLE_COLUMNS
+from measurements import MIGRATION_STATE_SQL, PM_VIEW, pm_rows
+
+logger = logging.getLogger(__name__)
+
+PM_FIELDS = ("pm1", "pm2_5", "pm4", "pm10", "tsp")
+EXTENDED_FIELDS = tuple(c for c in TABLE_COLUMNS["dust_extended_data"]
+                        if c not in ("device_id", "timestamp", "payload_hash"))
+
+LATEST_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS dust_device_latest (
+    device_id INTEGER PRIMARY KEY REFERENCES dust_devices(id) ON DELETE CASCADE,
+    sensor_timestamp TIMESTAMPTZ,
+    pm1 DOUBLE PRECISION,
+    pm2_5 DOUBLE PRECISION,
+    pm4 DOUBLE PRECISION,
+    pm10 DOUBLE PRECISION,
+    tsp DOUBLE PRECISION,
+    extended_timestamp TIMESTAMPTZ,
+    extended JSONB,
+    gps_timestamp TIMESTAMPTZ,
+    gps_lat DOUBLE PRECISION,
+    gps_lon DOUBLE PRECISION,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+)
+"""
+
+# Each part only moves forward in time, so late rows never overwrite newer ones
+_SENSOR_UPSERT = """
+INSERT INTO dust_device_latest AS l (device_id, sensor_timestamp, pm1, pm2_5, pm4, pm10, tsp)
+{rows}
+ON CONFLICT (device_id) DO UPDATE
+SET sensor_timestamp = EXCLUDED.sensor_timestamp,
+    pm1 = EXCLUDED.pm1, pm2_5 = EXCLUDED.pm2_5, pm4 = EXCLUDED.pm4,
+    pm10 = EXCLUDED.pm10, tsp = EXCLUDED.tsp, updated_at = NOW()
+WHERE l.sensor_timestamp IS NULL OR EXCLUDED.sensor_timestamp >= l.sensor_timestamp
+"""
+
+_EXTENDED_UPSERT = """
+INSERT INTO dust_device_latest AS l (device_id, extended_timestamp, extended)
+{rows}
+ON CONFLICT (device_id) DO UPDATE
+SET extended_timestamp = EXCLUDED.extended_timestamp, extended = EXCLUDED.extended, updated_at = NOW()
+WHERE l.extended_timestamp IS NULL OR EXCLUDED.extended_timestamp >= l.extended_timestamp
+"""
+
+_GPS_UPSERT = """
+INSERT INTO dust_device_latest AS l (device_id, gps_timestamp, gps_lat, gps_lon)
+{rows}
+ON CONFLICT (device_id) DO UPDATE
+SET gps_timestamp = EXCLUDED.gps_timestamp, gps_lat = EXCLUDED.gps_lat,
+    gps_lon = EXCLUDED.gps_lon, updated_at = NOW()
+WHERE l.gps_timestamp IS NULL OR EXCLUDED.gps_timestamp >= l.gps_timestamp
+"""
+
+
+UPSERT_SENSOR_SQL = _SENSOR_UPSERT.format(rows="VALUES %s")
+UPSERT_EXTENDED_SQL = _EXTENDED_UPSERT.format(rows="VALUES %s")
+UPSERT_GPS_SQL = _GPS_UPSERT.format(rows="VALUES %s")
+
+# Backfill of one device from its newest rows within the window.  Each probe walks the
+# (device_id, timestamp) index backwards and only touches the newest partitions; the
+# forward-only upserts never replace a part the ingest writer has already moved on.
+BACKFILL_SQL = (
+    _SENSOR_UPSERT.format(rows=f"""
+SELECT device_id, timestamp, pm1, pm2_5, pm4, pm10, tsp FROM {PM_VIEW}
+WHERE device_id = %(device_id)s AND timestamp >= NOW() - %(window)s
+ORDER BY timestamp DESC LIMIT 1"""),
+    _EXTENDED_UPSERT.format(rows="""
+SELECT device_id, timestamp, to_jsonb(e) - 'id' - 'device_id' - 'timestamp' - 'payload_hash'
+FROM dust_extended_data e
+WHERE device_id = %(device_id)s AND timestamp >= NOW() - %(window)s
+ORDER BY timestamp DESC LIMIT 1"""),
+    _GPS_UPSERT.format(rows="""
+SELECT device_id, timestamp, gps_lat, gps_lon FROM dust_extended_data
+WHERE device_id = %(device_id)s AND timestamp >= NOW() - %(window)s
+  AND gps_lat IS NOT NULL AND gps_lon IS NOT NULL
+ORDER BY timestamp DESC LIMIT 1"""),
+)
+
+BACKFILL_NAME = "latest_backfill"
+BACKFILL_WINDOW = timedelta(days=int(os.getenv('LATEST_BACKFILL_DAYS', 90)))
+BACKFILL_CHUNK_DEVICES = 50
+BACKFILL_TIMEOUT_MS = 60000
+
+
+def ensure_latest_table(cur):
+    """Create dust_device_latest; the first time, schedule a background backfill of every device"""
+    cur.execute("SELECT to_regclass('dust_device_latest')")
+    exists = cur.fetchone()[0] is not None
+    cur.execute(LATEST_TABLE_SQL)
+    if not exists:
+        cur.execute(MIGRATION_STATE_SQL)
+        cur.execute("""
+            INSERT INTO dust_migration_state (name, through_id)
+            SELECT %s, COALESCE(MAX(id), 0) FROM dust_devices
+            ON CONFLICT (name) DO NOTHING
+        """, (BACKFILL_NAME,))
+        logger.info("[LATEST] Created dust_device_latest; backfill scheduled on the ingest leader")
+
+
+def _newer(current, timestamp):
+    return current is None or current["timestamp"] is None or timestamp >= current["timestamp"]
+
+
+class LatestStore:
+    """In-process mirror of dust_device_latest; also a BatchWriter stage"""
+
+    def __init__(self, get_conn, put_conn, ready=None):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        # The backfill waits for this (e.g. a repair of the rows it reads) before it starts
+        self.ready = ready
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"backfilled_devices": 0, "backfill_done": False}
+
+    @staticmethod
+    def _entry_from_row(row):
+        entry = {"sensor": None, "extended": None, "gps": None}
+        if row["sensor_timestamp"] is not None:
+            entry["sensor"] = {"timestamp": row["sensor_timestamp"], **{f: row[f] for f in PM_FIELDS}}
+        if row["extended_timestamp"] is not None:
+            entry["extended"] = {"timestamp": row["extended_timestamp"], **(row["extended"] or {})}
+        if row["gps_timestamp"] is not None:
+            entry["gps"] = {"timestamp": row["gps_timestamp"], "gps_lat": row["gps_lat"], "gps_lon": row["gps_lon"]}
+        return entry
+
+    def _fetch(self, device_id=None):
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            if device_id is None:
+                cur.execute("SELECT * FROM dust_device_latest")
+            else:
+                cur.execute("SELECT * FROM dust_device_latest WHERE device_id = %s", (device_id,))
+            return cur.fetchall()
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def load(self):
+        rows = self._fetch()
+        with self._lock:
+            self._devices = {row["device_id"]: self._entry_from_row(row) for row in rows}
+        logger.info(f"[LATEST] Loaded latest readings for {len(rows)} devices")
+
+    def get(self, device_id):
+        """Latest {'sensor', 'extended', 'gps'} for a device, or None if it never reported"""
+        try:
+            device_id = int(device_id)
+        except (TypeError, ValueError):
+            return None
+        entry = self._devices.get(device_id)
+        if entry is None:
+            rows = self._fetch(device_id)
+            if not rows:
+                return None
+            entry = self._entry_from_row(rows[0])
+            with self._lock:
+                self._devices.setdefault(device_id, entry)
+        return entry
+
+    def forget(self, device_id):
+        with self._lock:
+            self._devices.pop(int(device_id), None)
+
+    def apply(self, device_id, sensor=None, extended=None, gps=None):
+        """Merge newer parts into the mirror (used for updates coming from another process)"""
+        with self._lock:
+            entry = self._devices.setdefault(device_id, {"sensor": None, "extended": None, "gps": None})
+            for part, value in (("sensor", sensor), ("extended", extended), ("gps", gps)):
+                if value is not None and _newer(entry[part], value["timestamp"]):
+                    entry[part] = value
+
+    def backfill_step(self):
+        """Backfill one chunk of device ids; returns False when the backfill is complete"""
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute("SET LOCAL statement_timeout = %s", (BACKFILL_TIMEOUT_MS,))
+            cur.execute("""
+                SELECT done_id, through_id FROM dust_migration_state WHERE name = %s FOR UPDATE
+            """, (BACKFILL_NAME,))
+            row = cur.fetchone()
+            if not row or row[0] >= row[1]:
+                conn.rollback()
+                return False
+            after_id, through_id = row[0], min(row[0] + BACKFILL_CHUNK_DEVICES, row[1])
+            cur.execute("SELECT id FROM dust_devices WHERE id > %s AND id <= %s ORDER BY id",
+                        (after_id, through_id))
+            device_ids = [r[0] for r in cur.fetchall()]
+            for device_id in device_ids:
+                for statement in BACKFILL_SQL:
+                    cur.execute(statement, {"device_id": device_id, "window": BACKFILL_WINDOW})
+            cur.execute("""
+                UPDATE dust_migration_state SET done_id = %s, updated_at = NOW() WHERE name = %s
+            """, (through_id, BACKFILL_NAME))
+            conn.commit()
+            self.stats["backfilled_devices"] += len(device_ids)
+            return True
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.ready and not self.ready():
+                self._stop.wait(60)
+                continue
+            try:
+                if not self.backfill_step():
+                    self.stats["backfill_done"] = True
+                    if self.stats["backfilled_devices"]:
+                        self.load()
+                        logger.info(f"[LATEST] Backfilled {self.stats['backfilled_devices']} devices")
+                    return
+            except Exception as e:
+                logger.error(f"[LATEST] Backfill step failed: {e}")
+                self._stop.wait(30)
+
+    def start(self):
+        """Run any pending backfill in the background (ingest leader only)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="LatestBackfill")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    @staticmethod
+    def latest_from_batch(batch):
+        """Newest sensor (PM), extended and GPS parts per device in a flush batch"""
+        latest = {}
+        for device_id, timestamp, pm in pm_rows(batch):
+            parts = latest.setdefault(device_id, {})
+            if _newer(parts.get("sensor"), timestamp):
+                parts["sensor"] = {"timestamp": timestamp, **dict(zip(PM_FIELDS, pm))}
+        for values in batch.rows["dust_extended_data"]:
+            row = dict(zip(TABLE_COLUMNS["dust_extended_data"], values))
+            parts = latest.setdefault(row["device_id"], {})
+            if _newer(parts.get("extended"), row["timestamp"]):
+                parts["extended"] = {"timestamp": row["timestamp"], **{f: row[f] for f in EXTENDED_FIELDS}}
+            if row["gps_lat"] is not None and row["gps_lon"] is not None and _newer(parts.get("gps"), row["timestamp"]):
+                parts["gps"] = {"timestamp": row["timestamp"], "gps_lat": row["gps_lat"], "gps_lon": row["gps_lon"]}
+        return latest
+
+    def write(self, cur, batch):
+        """BatchWriter stage: upsert the newest parts per device inside the flush transaction"""
+        latest = self.latest_from_batch(batch)
+        sensor_rows, extended_rows, gps_rows = [], [], []
+        for device_id, parts in latest.items():
+            if "sensor" in parts:
+                sensor = parts["sensor"]
+                sensor_rows.append((device_id, sensor["timestamp"], *[sensor[f] for f in PM_FIELDS]))
+            if "extended" in parts:
+                extended = parts["extended"]
+                extended_rows.append((device_id, extended["timestamp"],
+                                      Json({f: extended[f] for f in EXTENDED_FIELDS})))
+            if "gps" in parts:
+                gps = parts["gps"]
+                gps_rows.append((device_id, gps["timestamp"], gps["gps_lat"], gps["gps_lon"]))
+        if sensor_rows:
+            execute_values(cur, UPSERT_SENSOR_SQL, sensor_rows)
+        if extended_rows:
+            execute_values(cur, UPSERT_EXTENDED_SQL, extended_rows)
+        if gps_rows:
+            execute_values(cur, UPSERT_GPS_SQL, gps_rows)
+        return latest
+
+    def after_commit(self, batch, latest):
+        """BatchWriter stage: publish the committed values to the in-memory mirror"""
+        for device_id, parts in latest.items():
+            self.apply(device_id, **parts)
@@ -0,0 +1,118 @@
+"""Delta websocket feed: a snapshot on join, then only new points per flush.
+
+A client joining a device room gets one ``snapshot`` with the last
+``window_minutes`` of PM history and its averages; that load also starts a
+rolling window for the device.  Each flush's new PM points then arrive
+through ``apply`` from the ingest bus (see ``ingest_bus``), wherever ingest
+runs, so ``take()`` hands the emitter just those points plus the updated
+rolling averages, without any SQL.  Devices nobody has joined are not tracked
+and cost nothing per flush.
+"""
+import logging
+import threading
+
+from psycopg2.extras import RealDictCursor
+
+from measurements import PM_VIEW
+from rolling_window import RollingWindow, PM_CHANNELS
+
+logger = logging.getLogger(__name__)
+
+WINDOW_MINUTES = 15
+
+
+def _history(readings):
+    """Chart arrays in the shape /api/data and the old full emit used"""
+    history = {"timestamps": [ts.isoformat() for ts, _ in readings]}
+    for i, channel in enumerate(PM_CHANNELS):
+        history[channel] = [float(values[i]) if values[i] else 0 for _, values in readings]
+    return history
+
+
+def _averages(window):
+    return {f"avg_{channel}": avg or 0 for channel, avg in zip(PM_CHANNELS, window.averages())}
+
+
+class LiveFeed:
+    """Rolling PM windows for devices with websocket viewers"""
+
+    def __init__(self, get_conn, put_conn, window_minutes=WINDOW_MINUTES):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.window_minutes = window_minutes
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._loaded_until = {}
+        self._pending = {}
+
+    def snapshot(self, device_id):
+        """Full recent history and averages for a device; starts tracking it.
+
+        Points already queued for the device's room are left queued (and left
+        out of the snapshot) so the viewers already watching still get them.
+        """
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(f"""
+                SELECT timestamp, pm1, pm2_5, pm4, pm10, tsp
+                FROM {PM_VIEW}
+                WHERE device_id = %s AND timestamp >= NOW() - INTERVAL '1 minute' * %s
+                ORDER BY timestamp ASC
+            """, (device_id, self.window_minutes))
+            rows = cur.fetchall()
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+        readings = [(row["timestamp"], tuple(row[c] for c in PM_CHANNELS)) for row in rows]
+        with self._lock:
+            window = self._windows.get(device_id)
+            # A device other viewers already watch keeps its window, which is at least as current
+            if window is None:
+                window = RollingWindow(self.window_minutes * 60)
+                for ts, values in readings:
+                    window.add(ts, values)
+                self._windows[device_id] = window
+                self._loaded_until[device_id] = readings[-1][0] if readings else None
+            # Points still queued for the room reach this viewer with the next delta
+            pending = {ts for ts, _ in self._pending.get(device_id, ())}
+            averages = _averages(window)
+        if pending:
+            readings = [reading for reading in readings if reading[0] not in pending]
+        return {"history": _history(readings), "averages": averages}
+
+    def tracked(self, device_id):
+        return device_id in self._windows
+
+    def forget(self, device_id):
+        with self._lock:
+            self._windows.pop(device_id, None)
+            self._loaded_until.pop(device_id, None)
+            self._pending.pop(device_id, None)
+
+    def apply(self, points):
+        """Fold committed {device_id: [(timestamp, pm)]} from the ingest bus into tracked windows"""
+        with self._lock:
+            for device_id, readings in points.items():
+                window = self._windows.get(device_id)
+                if window is None:
+                    continue
+                readings.sort(key=lambda reading: reading[0])
+                # A flush that committed while the snapshot was loading is already in it
+                loaded_until = self._loaded_until.pop(device_id, None)
+                if loaded_until is not None:
+                    readings = [r for r in readings if r[0] > loaded_until]
+                for ts, values in readings:
+                    window.add(ts, values)
+                self._pending.setdefault(device_id, []).extend(readings)
+
+    def take(self, device_id):
+        """New points since the last call plus current averages, or None if the device is not tracked"""
+        with self._lock:
+            window = self._windows.get(device_id)
+            if window is None:
+                return None
+            readings = self._pending.pop(device_id, [])
+            return {"history": _history(readings), "averages": _averages(window)}
@@ -0,0 +1,327 @@
+"""Single-write PM measurement model.
+
+Every reading is stored once.  Basic PM-only devices write ``dust_sensor_data``;
+extended devices (compact and legacy formats) write one ``dust_extended_data``
+row whose ``pm1 .. tsp_um`` columns carry their PM channels.  Compact devices
+used to get a second, mirrored row in ``dust_sensor_data`` as well, doubling
+their write, WAL and index cost.
+
+Code that wants "every PM reading of a device" reads both tables through one
+of two adapters, in the ``dust_sensor_data`` column layout:
+
+* SQL: the ``dust_pm_readings`` view (``UNION ALL`` of both tables plus an
+  ``origin`` column, so incremental readers can keep one id cursor per table);
+* ingest stages: ``pm_rows(batch)`` over a flush batch.
+
+Existing mirrored rows are removed by ``MirrorCleanup``, which walks
+``dust_sensor_data`` in id chunks up to the max id seen when it was installed
+and deletes rows that have an extended row with PM for the same device and
+timestamp, one short transaction per chunk.  Until it finishes, the view
+hides those duplicates.  It waits for the rollup backfill, so the view the
+backfill reads does not change under it.
+
+Legacy-format (``PM_data``/``GPS``) rows written before the batch writer
+passed their values to the old insert helper one position short: every
+column from ``noise_db`` to ``cloud_cover_percent`` holds the value of the
+next one (``tsp_um`` holds the latitude).  ``LegacyExtendedRepair`` shifts
+them back, in id chunks up to the max id seen when it was installed.  It
+only touches rows that have none of the columns that old helper always left
+empty (lux, UV index, battery, cloud cover) and no mirrored PM row, which
+compact rows have.  Everything that reads those rows in bulk (rollup
+backfill, latest-reading backfill, partition migration) waits for it.
+"""
+import logging
+import threading
+
+from ingest_writer import TABLE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+PM_VIEW = "dust_pm_readings"
+
+# PM channel columns per table, in dust_sensor_data order
+PM_SOURCE_COLUMNS = {
+    "dust_sensor_data": ("pm1", "pm2_5", "pm4", "pm10", "tsp"),
+    "dust_extended_data": ("pm1", "pm2_5", "pm4", "pm10", "tsp_um"),
+}
+EXTENDED_PM_COLUMNS = PM_SOURCE_COLUMNS["dust_extended_data"]
+
+_EXTENDED_HAS_PM = " OR ".join(f"e.{c} IS NOT NULL" for c in EXTENDED_PM_COLUMNS)
+
+
+def pm_view_sql(mirrors_through_id=None):
+    """``dust_pm_readings`` definition; while mirrored rows up to ``mirrors_through_id`` still
+    exist, sensor rows that duplicate an extended row are filtered out"""
+    sensor_filter = ""
+    if mirrors_through_id is not None:
+        sensor_filter = f"""
+WHERE s.id > {int(mirrors_through_id)} OR NOT EXISTS (
+    SELECT 1 FROM dust_extended_data e
+    WHERE e.device_id = s.device_id AND e.timestamp = s.timestamp AND ({_EXTENDED_HAS_PM}))"""
+    return f"""
+CREATE OR REPLACE VIEW {PM_VIEW} AS
+SELECT 'sensor'::text AS origin, s.id, s.timestamp, s.device_id, s.pm1, s.pm2_5, s.pm4, s.pm10, s.tsp
+FROM dust_sensor_data s{sensor_filter}
+UNION ALL
+SELECT 'extended'::text AS origin, e.id, e.timestamp, e.device_id, e.pm1, e.pm2_5, e.pm4, e.pm10, e.tsp_um
+FROM dust_extended_data e
+WHERE {_EXTENDED_HAS_PM}
+"""
+
+
+MIGRATION_STATE_SQL = """
+CREATE TABLE IF NOT EXISTS dust_migration_state (
+    name TEXT PRIMARY KEY,
+    through_id BIGINT NOT NULL,
+    done_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+)
+"""
+
+# Mirrors were written with the extended row's device and timestamp (same rule as the view filter)
+DELETE_MIRRORED_SQL = f"""
+DELETE FROM dust_sensor_data s
+USING dust_extended_data e
+WHERE s.id > %(after_id)s AND s.id <= %(through_id)s
+  AND e.device_id = s.device_id AND e.timestamp = s.timestamp AND ({_EXTENDED_HAS_PM})
+"""
+
+CLEANUP_CHUNK_IDS = 20000
+
+# Columns the old legacy insert filled one position early, in table order
+LEGACY_SHIFTED_COLUMNS = (
+    "noise_db", "pm1", "pm2_5", "pm4", "pm10", "tsp_um",
+    "gps_lat", "gps_lon", "gps_alt_m", "gps_speed_kmh", "cloud_cover_percent",
+)
+
+_LEGACY_SHIFT = ", ".join(
+    [f"{LEGACY_SHIFTED_COLUMNS[0]} = NULL"]
+    + [f"{column} = e.{previous}" for previous, column in zip(LEGACY_SHIFTED_COLUMNS, LEGACY_SHIFTED_COLUMNS[1:])]
+)
+
+REPAIR_LEGACY_SQL = f"""
+UPDATE dust_extended_data e SET {_LEGACY_SHIFT}
+WHERE e.id > %(after_id)s AND e.id <= %(through_id)s
+  AND e.lux IS NULL AND e.uv_index IS NULL AND e.battery_percent IS NULL AND e.cloud_cover_percent IS NULL
+  AND NOT EXISTS (
+    SELECT 1 FROM dust_sensor_data s WHERE s.device_id = e.device_id AND s.timestamp = e.timestamp)
+"""
+
+
+def pm_rows(batch):
+    """(device_id, timestamp, (pm1, pm2_5, pm4, pm10, tsp)) for every PM reading in a flush batch.
+
+    Extended rows without any PM value (devices that only report environment
+    data) are skipped.
+    """
+    for table, channels in PM_SOURCE_COLUMNS.items():
+        columns = TABLE_COLUMNS[table]
+        device_index = columns.index("device_id")
+        ts_index = columns.index("timestamp")
+        indexes = [columns.index(c) for c in channels]
+        extended = table == "dust_extended_data"
+        for values in batch.rows[table]:
+            pm = tuple(values[i] for i in indexes)
+            if extended and all(v is None for v in pm):
+                continue
+            yield values[device_index], values[ts_index], pm
+
+
+def extended_pm_rows(batch):
+    """Extended rows of a batch that carry PM values"""
+    columns = TABLE_COLUMNS["dust_extended_data"]
+    indexes = [columns.index(c) for c in EXTENDED_PM_COLUMNS]
+    return [values for values in batch.rows["dust_extended_data"]
+            if any(values[i] is not None for i in indexes)]
+
+
+class MirrorCleanup:
+    """Background migration deleting the legacy mirrored PM rows of compact devices"""
+
+    NAME = "pm_mirror_cleanup"
+
+    def __init__(self, get_conn, put_conn, ready=None, chunk_ids=CLEANUP_CHUNK_IDS):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.ready = ready
+        self.chunk_ids = chunk_ids
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"rows_deleted": 0, "scanned_ids": 0, "done": False}
+
+    def ensure(self, cur):
+        """Record the id range to clean; rows written from now on are never mirrored"""
+        cur.execute(MIGRATION_STATE_SQL)
+        cur.execute("""
+            INSERT INTO dust_migration_state (name, through_id)
+            SELECT %s, COALESCE(MAX(id), 0) FROM dust_sensor_data
+            ON CONFLICT (name) DO NOTHING
+        """, (self.NAME,))
+        if cur.rowcount:
+            logger.info("[MEASUREMENTS] Scheduled cleanup of mirrored PM rows")
+        self.ensure_view(cur)
+
+    def ensure_view(self, cur):
+        """(Re)create the PM view; also run after a table swap so it points at the new tables"""
+        cur.execute("SELECT done_id, through_id FROM dust_migration_state WHERE name = %s", (self.NAME,))
+        row = cur.fetchone()
+        cur.execute(pm_view_sql(row[1] if row and row[0] < row[1] else None))
+
+    def step(self):
+        """Clean one id chunk; returns False when the migration is complete"""
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT done_id, through_id FROM dust_migration_state WHERE name = %s FOR UPDATE
+            """, (self.NAME,))
+            row = cur.fetchone()
+            if not row or row[0] >= row[1]:
+                conn.rollback()
+                return False
+            after_id, through_id = row[0], min(row[0] + self.chunk_ids, row[1])
+            cur.execute(DELETE_MIRRORED_SQL, {"after_id": after_id, "through_id": through_id})
+            deleted = cur.rowcount
+            cur.execute("""
+                UPDATE dust_migration_state SET done_id = %s, updated_at = NOW() WHERE name = %s
+            """, (through_id, self.NAME))
+            conn.commit()
+            self.stats["rows_deleted"] += deleted
+            self.stats["scanned_ids"] += through_id - after_id
+            return True
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def _finish(self):
+        """Drop the duplicate filter from the view once no mirrored rows are left"""
+        conn = None
+        try:
+            conn = self.get_conn()
+            self.ensure_view(conn.cursor())
+            conn.commit()
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.ready and not self.ready():
+                self._stop.wait(60)
+                continue
+            try:
+                if not self.step():
+                    self._finish()
+                    self.stats["done"] = True
+                    logger.info(f"[MEASUREMENTS] Mirrored PM rows removed ({self.stats['rows_deleted']} rows)")
+                    return
+            except Exception as e:
+                logger.error(f"[MEASUREMENTS] Mirror cleanup step failed: {e}")
+                self._stop.wait(30)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="MirrorCleanup")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+
+class LegacyExtendedRepair:
+    """Background migration shifting the columns of old legacy-format extended rows back into place"""
+
+    NAME = "legacy_extended_shift"
+
+    def __init__(self, get_conn, put_conn, chunk_ids=CLEANUP_CHUNK_IDS):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.chunk_ids = chunk_ids
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"rows_repaired": 0, "scanned_ids": 0, "done": False}
+
+    def ensure(self, cur):
+        """Record the id range to repair; rows written by the batch writer are already correct"""
+        cur.execute(MIGRATION_STATE_SQL)
+        cur.execute("""
+            INSERT INTO dust_migration_state (name, through_id)
+            SELECT %s, COALESCE(MAX(id), 0) FROM dust_extended_data
+            ON CONFLICT (name) DO NOTHING
+        """, (self.NAME,))
+        if cur.rowcount:
+            logger.info("[MEASUREMENTS] Scheduled repair of legacy extended rows")
+
+    def done(self):
+        """Whether every scheduled row has been repaired (read from the state table once, then cached)"""
+        if self.stats["done"]:
+            return True
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute("SELECT done_id, through_id FROM dust_migration_state WHERE name = %s", (self.NAME,))
+            row = cur.fetchone()
+            conn.rollback()
+            self.stats["done"] = row is None or row[0] >= row[1]
+        except Exception as e:
+            logger.error(f"[MEASUREMENTS] Could not read the legacy repair state: {e}")
+        finally:
+            if conn:
+                self.put_conn(conn)
+        return self.stats["done"]
+
+    def step(self):
+        """Repair one id chunk; returns False when the migration is complete"""
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT done_id, through_id FROM dust_migration_state WHERE name = %s FOR UPDATE
+            """, (self.NAME,))
+            row = cur.fetchone()
+            if not row or row[0] >= row[1]:
+                conn.rollback()
+                return False
+            after_id, through_id = row[0], min(row[0] + self.chunk_ids, row[1])
+            cur.execute(REPAIR_LEGACY_SQL, {"after_id": after_id, "through_id": through_id})
+            repaired = cur.rowcount
+            cur.execute("""
+                UPDATE dust_migration_state SET done_id = %s, updated_at = NOW() WHERE name = %s
+            """, (through_id, self.NAME))
+            conn.commit()
+            self.stats["rows_repaired"] += repaired
+            self.stats["scanned_ids"] += through_id - after_id
+            return True
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if not self.step():
+                    self.stats["done"] = True
+                    logger.info(f"[MEASUREMENTS] Legacy extended rows repaired ({self.stats['rows_repaired']} rows)")
+                    return
+            except Exception as e:
+                logger.error(f"[MEASUREMENTS] Legacy repair step failed: {e}")
+                self._stop.wait(30)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="LegacyExtendedRepair")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
@@ -0,0 +1,474 @@
+"""Single-loop MQTT ingest engine for every broker connection.
+
+All paho clients are driven by one network loop (paho's external-loop API:
+``loop_read`` / ``loop_write`` / ``loop_misc`` on non-blocking sockets
+multiplexed with ``select``) instead of a ``loop_forever`` thread per data
+source.  ``on_message`` runs on that loop and only queues the raw payload;
+a fixed pool of workers takes messages off a bounded queue and runs the
+handler (JSON parsing, registry lookups, batch writer), so a slow database
+never stalls the sockets.  In the eventlet web process these are green
+threads; database waits yield to the hub through the psycopg2 wait callback
+installed by ``db_pool.make_psycopg_green``.  Connects and reconnects also run on the pool, with
+exponential backoff and full jitter per source.
+
+When the queue is full, ``overflow`` decides what happens to a new message:
+
+* ``block``: the network loop waits for a free slot, which pushes back on the
+  brokers through TCP flow control (keepalives stall if it lasts too long);
+* ``drop_oldest``: the oldest queued message is discarded to make room;
+* ``spill``: messages go to an on-disk spool (``ingest_spool``) and are fed
+  back in arrival order as the workers catch up; while anything is spilled,
+  new messages queue behind it on disk.
+
+Queue depth, drops, spills and receive-to-handled latency are also kept per
+data source.  The thread count is ``1 + workers`` whatever the number of data
+sources.
+"""
+import logging
+import queue
+import random
+import select
+import socket
+import ssl
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from ingest_spool import spool_from_env
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOPICS = ("sensor/data", "dustrak/status")
+MQTT_SOURCES_SQL = """
+    SELECT ds.id, ds.broker_url, ds.username, ds.password
+    FROM dust_data_sources ds
+    WHERE ds.source_type = 'mqtt'
+"""
+MQTT_TLS_PORT = 8883
+KEEPALIVE_SECONDS = 60
+CONNECT_TIMEOUT_SECONDS = 10
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 300.0
+TICK_SECONDS = 1.0
+OVERFLOW_POLICIES = ("block", "drop_oldest", "spill")
+# Spilled messages moved back per refill, once the queue is at most half full
+REFILL_MESSAGES = 500
+LATENCY_EWMA_ALPHA = 0.1
+
+SPILL_FRAME = struct.Struct("<idH")
+
+
+def encode_message(item):
+    """Spill record of a queued message: i32 source | f64 received_at | u16 topic length | topic | payload"""
+    source_id, topic, payload, received_at = item
+    topic = topic.encode()
+    return SPILL_FRAME.pack(source_id, received_at, len(topic)) + topic + payload
+
+
+def decode_message(data):
+    source_id, received_at, topic_length = SPILL_FRAME.unpack_from(data)
+    offset = SPILL_FRAME.size + topic_length
+    return source_id, data[SPILL_FRAME.size:offset].decode(), data[offset:], received_at
+
+
+def message_spool(name="mqtt"):
+    """Spill spool for raw messages (not fsynced: it absorbs bursts, the batch spool guards the database)"""
+    return spool_from_env(name, encode=encode_message, decode=decode_message, size=lambda item: 1, fsync=False)
+
+
+def load_sources(get_conn, put_conn):
+    """(data_source_id, broker_url, username, password) of every MQTT data source"""
+    conn = None
+    try:
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute(MQTT_SOURCES_SQL)
+        return cur.fetchall()
+    finally:
+        if conn:
+            put_conn(conn)
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)]"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class _Source:
+    """Connection state of one data source"""
+
+    def __init__(self, source_id, broker_url, topics, username=None, password=None, port=MQTT_TLS_PORT):
+        self.source_id = source_id
+        self.broker_url = broker_url
+        self.topics = tuple(topics)
+        self.username = username
+        self.password = password
+        self.port = port
+        self.client = None
+        self.attempt = 0
+        self.retry_at = 0.0
+        self.connecting = False
+        self.removed = False
+
+
+class MqttEngine:
+    """Drives every broker connection from one loop and hands messages to a worker pool"""
+
+    def __init__(self, handle_message, workers=4, queue_size=10000, clients=None,
+                 backoff_base=BACKOFF_BASE_SECONDS, backoff_max=BACKOFF_MAX_SECONDS, overflow="block", spill=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        if overflow == "spill" and spill is None:
+            logger.warning("[MQTT] Overflow policy 'spill' needs a spool; blocking instead")
+            overflow = "block"
+        self.handle_message = handle_message
+        self.workers = workers
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.overflow = overflow
+        self._spill = spill
+        self._spill_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._sources = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self._threads = []
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        # data_source_id -> connected paho client, for publishing control messages
+        self.clients = clients if clients is not None else {}
+        self.stats = {"received": 0, "handled": 0, "handler_errors": 0, "dropped": 0, "spilled": 0,
+                      "connects": 0, "connect_failures": 0, "disconnects": 0}
+        # data_source_id -> queue depth, drop/spill counts and latency of that source
+        self.source_stats = {}
+
+    # -- sources --
+
+    def add_source(self, source_id, broker_url, topics=DEFAULT_TOPICS, username=None, password=None,
+                   port=MQTT_TLS_PORT):
+        with self._lock:
+            if source_id in self._sources:
+                logger.warning(f"[MQTT-{source_id}] Source already registered")
+                return False
+            self._sources[source_id] = _Source(source_id, broker_url, topics, username, password, port)
+            self.source_stats.setdefault(source_id, {"received": 0, "handled": 0, "depth": 0, "dropped": 0,
+                                                     "spilled": 0, "spill_depth": 0, "latency_ms": 0.0,
+                                                     "last_latency_ms": 0.0})
+        self._wake()
+        logger.info(f"[MQTT-{source_id}] Registered broker {broker_url}")
+        return True
+
+    def remove_source(self, source_id):
+        with self._lock:
+            source = self._sources.pop(source_id, None)
+        self.clients.pop(source_id, None)
+        if source is None:
+            return False
+        source.removed = True
+        if source.client is not None:
+            try:
+                source.client.disconnect()
+            except Exception as e:
+                logger.warning(f"[MQTT-{source_id}] Disconnect failed: {e}")
+        self._wake()
+        return True
+
+    def sync(self, sources, topics=DEFAULT_TOPICS):
+        """Match the registered sources to (id, broker_url, username, password) rows"""
+        wanted = {row[0]: tuple(row[1:]) for row in sources}
+        with self._lock:
+            current = {source_id: (s.broker_url, s.username, s.password) for source_id, s in self._sources.items()}
+        for source_id, settings in current.items():
+            if wanted.get(source_id) != settings:
+                self.remove_source(source_id)
+                logger.info(f"[MQTT-{source_id}] Removed (data source deleted or changed)")
+        for source_id, (broker_url, username, password) in wanted.items():
+            if current.get(source_id) != (broker_url, username, password):
+                self.add_source(source_id, broker_url, topics, username, password)
+
+    def publish(self, key, topic, payload, broadcast=False):
+        """Publish on the connected client registered under ``key``, or on every connected client"""
+        clients = list(self.clients.values()) if broadcast else [self.clients.get(key)]
+        for client in clients:
+            if client is not None and client.is_connected():
+                client.publish(topic, payload, qos=1)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def metrics(self):
+        return {**self.stats, "queue_depth": self.queue_depth(), "overflow": self.overflow,
+                "spill": self._spill.metrics() if self._spill is not None else None,
+                "sources": {source_id: dict(counters) for source_id, counters in self.source_stats.items()}}
+
+    # -- client setup --
+
+    def _make_client(self, source):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                             userdata={"data_source_id": source.source_id, "topics": source.topics})
+        if source.username and source.password:
+            client.username_pw_set(source.username, source.password)
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        client.tls_set_context(context)
+        client.connect_timeout = CONNECT_TIMEOUT_SECONDS
+        client.max_inflight_messages_set(10)
+        client.max_queued_messages_set(100)
+        client.on_connect = lambda c, userdata, flags, rc, properties=None: self._on_connect(source, c, rc)
+        client.on_disconnect = (lambda c, userdata, flags, rc, properties=None:
+                                self._on_disconnect(source, rc))
+        client.on_message = lambda c, userdata, msg: self._on_message(source, msg)
+        # Publishes from worker threads wake the loop so they are written straight away
+        client.on_socket_register_write = lambda c, userdata, sock: self._wake()
+        return client
+
+    def _connect(self, source):
+        """Runs on a worker: blocking TCP/TLS connect, then the loop takes over the socket"""
+        try:
+            if source.client is None:
+                source.client = self._make_client(source)
+            logger.info(f"[MQTT-{source.source_id}] Connecting to {source.broker_url}:{source.port}...")
+            source.client.connect(source.broker_url, source.port, KEEPALIVE_SECONDS)
+            self.stats["connects"] += 1
+            # Safety net if the socket goes away without on_disconnect; CONNACK resets the backoff
+            source.retry_at = time.monotonic() + backoff_delay(source.attempt, self.backoff_base, self.backoff_max)
+        except Exception as e:
+            self.stats["connect_failures"] += 1
+            self._schedule_retry(source, f"connect failed: {e}")
+        finally:
+            source.connecting = False
+            self._wake()
+
+    def _schedule_retry(self, source, reason):
+        delay = backoff_delay(source.attempt, self.backoff_base, self.backoff_max)
+        source.attempt += 1
+        source.retry_at = time.monotonic() + delay
+        logger.warning(f"[MQTT-{source.source_id}] {reason}; retrying in {delay:.1f}s (attempt {source.attempt})")
+
+    # -- paho callbacks (on the loop thread) --
+
+    def _on_connect(self, source, client, rc):
+        if rc == 0:
+            source.attempt = 0
+            self.clients[source.source_id] = client
+            logger.info(f"[MQTT-{source.source_id}] Connected to broker: {source.broker_url}")
+            for topic in source.topics:
+                client.subscribe(topic, qos=1)
+                logger.info(f"[MQTT-{source.source_id}] Subscribed to topic: {topic}")
+        else:
+            logger.error(f"[MQTT-{source.source_id}] Connection refused with rc={rc}")
+
+    def _on_disconnect(self, source, rc):
+        self.stats["disconnects"] += 1
+        self.clients.pop(source.source_id, None)
+        if not source.removed:
+            self._schedule_retry(source, f"disconnected (rc={rc})")
+
+    def _on_message(self, source, msg):
+        self.stats["received"] += 1
+        counters = self.source_stats[source.source_id]
+        counters["received"] += 1
+        item = (source.source_id, msg.topic, msg.payload, time.time())
+        if self.overflow == "spill":
+            # Once anything is on disk, new messages queue behind it to keep arrival order
+            if not self._spill.depth_records:
+                try:
+                    self._queue.put_nowait(item)
+                    counters["depth"] += 1
+                    return
+                except queue.Full:
+                    pass
+            self._spill.append(item)
+            self.stats["spilled"] += 1
+            counters["spilled"] += 1
+            counters["spill_depth"] += 1
+            return
+        if self.overflow == "drop_oldest":
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    self._drop_oldest()
+        else:
+            self._queue.put(item)
+        counters["depth"] += 1
+
+    def _drop_oldest(self):
+        try:
+            item = self._queue.get_nowait()
+        except queue.Empty:
+            return
+        if item is None:
+            # Shutdown sentinel; the workers also stop on their next tick
+            return
+        source_id, topic, payload, _ = item
+        if source_id is None:
+            # A connect job: let the loop schedule it again
+            payload.connecting = False
+            payload.retry_at = 0.0
+            return
+        self.stats["dropped"] += 1
+        counters = self.source_stats.get(source_id)
+        if counters is not None:
+            counters["depth"] -= 1
+            counters["dropped"] += 1
+        logger.warning(f"[MQTT-{source_id}] Ingest queue full, dropped oldest message on {topic}")
+
+    def _refill(self):
+        """Move spilled messages back into the queue, in order, while it is at most half full"""
+        if self._spill is None or not self._spill.depth_records or self._queue.qsize() > self._queue.maxsize // 2:
+            return
+        if not self._spill_lock.acquire(blocking=False):
+            return
+        try:
+            for _ in range(REFILL_MESSAGES):
+                item = self._spill.peek()
+                if item is None:
+                    break
+                try:
+                    self._queue.put_nowait(item)
+                except queue.Full:
+                    break
+                self._spill.advance(1)
+                counters = self.source_stats.get(item[0])
+                if counters is not None:
+                    counters["spill_depth"] -= 1
+                    counters["depth"] += 1
+        finally:
+            self._spill_lock.release()
+
+    # -- loop --
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _due_connects(self):
+        now = time.monotonic()
+        with self._lock:
+            sources = list(self._sources.values())
+        for source in sources:
+            sock = source.client.socket() if source.client is not None else None
+            if sock is None and not source.connecting and now >= source.retry_at:
+                source.connecting = True
+                source.retry_at = float("inf")
+                self._queue_connect(source)
+        return sources
+
+    def _queue_connect(self, source):
+        try:
+            self._queue.put_nowait((None, "connect", source, None))
+        except queue.Full:
+            source.connecting = False
+            self._schedule_retry(source, "worker queue full")
+
+    def _run_loop(self):
+        last_misc = 0.0
+        while self._running:
+            sources = self._due_connects()
+            sockets = {}
+            readable, writable = [self._wake_r], []
+            pending = []
+            for source in sources:
+                if source.connecting or source.client is None:
+                    continue
+                sock = source.client.socket()
+                if sock is None:
+                    continue
+                sockets[sock] = source
+                readable.append(sock)
+                if source.client.want_write():
+                    writable.append(sock)
+                # TLS may already hold decrypted bytes that select cannot see
+                if getattr(sock, "pending", None) and sock.pending():
+                    pending.append(sock)
+            try:
+                ready_r, ready_w, _ = select.select(readable, writable, [], 0 if pending else TICK_SECONDS)
+            except (OSError, ValueError):
+                # A socket closed between building the lists and select; rebuild next pass
+                continue
+            for sock in set(ready_r) | set(pending):
+                if sock is self._wake_r:
+                    self._drain_wake()
+                elif sock in sockets:
+                    sockets[sock].client.loop_read()
+            for sock in ready_w:
+                if sock in sockets:
+                    sockets[sock].client.loop_write()
+            now = time.monotonic()
+            if now - last_misc >= TICK_SECONDS:
+                last_misc = now
+                for source in sockets.values():
+                    source.client.loop_misc()
+
+    def _run_worker(self):
+        while self._running:
+            try:
+                item = self._queue.get(timeout=TICK_SECONDS)
+            except queue.Empty:
+                self._refill()
+                continue
+            if item is None:
+                break
+            source_id, topic, payload, received_at = item
+            if source_id is None:
+                self._connect(payload)
+                continue
+            try:
+                self.handle_message(source_id, topic, payload)
+                self.stats["handled"] += 1
+            except Exception as e:
+                self.stats["handler_errors"] += 1
+                logger.error(f"[MQTT-{source_id}] Error processing message: {e}")
+            counters = self.source_stats.get(source_id)
+            if counters is not None:
+                latency_ms = (time.time() - received_at) * 1000
+                counters["depth"] -= 1
+                counters["handled"] += 1
+                counters["last_latency_ms"] = round(latency_ms, 2)
+                counters["latency_ms"] = round(counters["latency_ms"] +
+                                               LATENCY_EWMA_ALPHA * (latency_ms - counters["latency_ms"]), 2)
+            self._refill()
+
+    def start(self):
+        if self._running:
+            return
+        if self._spill is not None:
+            self._spill.open()
+        self._running = True
+        self._threads = [threading.Thread(target=self._run_loop, daemon=True, name="MQTT-loop")]
+        self._threads += [threading.Thread(target=self._run_worker, daemon=True, name=f"MQTT-worker-{i}")
+                          for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"[MQTT] Engine started: 1 network loop, {self.workers} workers")
+
+    def stop(self):
+        self._running = False
+        for source_id in list(self._sources):
+            self.remove_source(source_id)
+        for _ in range(self.workers):
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        self._wake()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        if self._spill is not None:
+            # Whatever is still spilled is fed back on the next start
+            self._spill.close()
@@ -0,0 +1,538 @@
+"""Range partitioning of the time-series tables by month (or ISO week).
+
+``dust_sensor_data`` and ``dust_extended_data`` are declaratively partitioned
+on ``timestamp``.  The ``PartitionManager``:
+
+* pre-creates partitions ``ahead`` periods into the future at startup and
+  every ``check_hours`` from a background thread, so inserts never land in
+  the default partition under normal operation;
+* keeps a DEFAULT partition for rows with wildly wrong device clocks, and
+  moves any of its rows into a new partition when that range is created;
+* migrates an existing unpartitioned (heap) table online: a trigger on the
+  old table applies every insert, update and delete to a partitioned twin
+  while ingest keeps writing to the old table, and the rows that predate the
+  trigger are copied over in id-ordered chunks, each in its own short
+  transaction.  A chunk locks its source rows ``FOR SHARE``, so a concurrent
+  update or delete waits for the chunk and its trigger then replaces the
+  copied row.  The swap drops the trigger and renames the tables in one
+  transaction; the renames take an ACCESS EXCLUSIVE lock, so readers and
+  writers wait for the few catalog updates it makes.
+
+Every partition gets the parent's indexes: a B-tree on ``(device_id,
+timestamp DESC)`` for per-device range scans, a BRIN on ``timestamp``,
+which is tiny for append-ordered data, and a partial unique ``(device_id,
+timestamp, payload_hash)`` reading key that lets the batch writer insert
+with ``ON CONFLICT DO NOTHING`` (see ``dedup``).  On tables that predate the
+key it is built by the manager's background thread with ``CREATE UNIQUE
+INDEX CONCURRENTLY`` (per partition, then attached to the parent index) and
+no statement timeout, so ingest keeps writing meanwhile; existing rows have
+no hash, so nothing has to be deleted first.  Queries that filter on
+``timestamp`` are pruned to the matching partitions by the planner (at plan
+time for literal bounds, at executor start for ``NOW() - interval``).
+"""
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from psycopg2 import sql
+
+from measurements import MIGRATION_STATE_SQL
+
+logger = logging.getLogger(__name__)
+
+# Foreign keys of each partitioned table, as they were on the original heap tables
+PARTITIONED_TABLES = {
+    "dust_sensor_data": {
+        "index_prefix": "idx_sensor_data",
+        "foreign_keys": (
+            ("device_id", "dust_devices"),
+            ("data_source_id", "dust_data_sources"),
+        ),
+    },
+    "dust_extended_data": {
+        "index_prefix": "idx_extended_data",
+        "foreign_keys": (
+            ("device_id", "dust_devices"),
+        ),
+    },
+}
+
+MIGRATION_CHUNK_ROWS = 50000
+
+# Applies each change to a heap table being migrated to its partitioned twin
+CAPTURE_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        DELETE FROM {twin} WHERE id = OLD.id AND timestamp = OLD.timestamp;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO {twin} SELECT NEW.* ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+# Older rows than this go to the default partition instead of one partition per period
+MAX_BACKFILL_PERIODS = 36
+
+
+def period_start(ts, interval):
+    """Start (UTC) of the month or ISO week containing ``ts``"""
+    ts = ts.astimezone(timezone.utc)
+    if interval == "week":
+        day = ts.date() - timedelta(days=ts.weekday())
+        return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    return datetime(ts.year, ts.month, 1, tzinfo=timezone.utc)
+
+
+def next_period(start, interval):
+    if interval == "week":
+        return start + timedelta(days=7)
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(table, start, interval):
+    if interval == "week":
+        year, week, _ = start.isocalendar()
+        return f"{table}_p{year}w{week:02d}"
+    return f"{table}_p{start.year}_{start.month:02d}"
+
+
+def is_partitioned(cur, table):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def create_partitioned_table(cur, table, like, name=None):
+    """Create ``name`` (default ``table``) as a partitioned copy of ``like``'s columns,
+    with the primary key, foreign keys, indexes and default partition of ``table``"""
+    name = name or table
+    spec = PARTITIONED_TABLES[table]
+    ident = sql.Identifier(name)
+    cur.execute(sql.SQL(
+        "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS, PRIMARY KEY (id, timestamp)) "
+        "PARTITION BY RANGE (timestamp)"
+    ).format(ident, sql.Identifier(like)))
+    for column, referenced in spec["foreign_keys"]:
+        cur.execute(sql.SQL(
+            "ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {}(id) ON DELETE CASCADE"
+        ).format(ident, sql.Identifier(column), sql.Identifier(referenced)))
+    # A migration twin takes temporary index names until the swap frees the originals
+    create_partition_indexes(cur, table, name, suffix="" if name == table else "_partitioned")
+    cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} DEFAULT").format(
+        sql.Identifier(f"{name}_default"), ident))
+
+
+def create_partition_indexes(cur, table, name=None, suffix=""):
+    """Partitioned indexes on ``name``; they cascade to every current and future partition"""
+    name = name or table
+    prefix = PARTITIONED_TABLES[table]["index_prefix"]
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (device_id, timestamp DESC)").format(
+        sql.Identifier(f"{prefix}_device_timestamp{suffix}"), sql.Identifier(name)))
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING brin (timestamp)").format(
+        sql.Identifier(f"{prefix}_timestamp_brin{suffix}"), sql.Identifier(name)))
+    cur.execute(reading_key_sql(f"{prefix}_reading_hash{suffix}", name))
+
+
+def reading_key_sql(index, table, only=False, concurrently=False):
+    """CREATE statement of the partial unique reading key (see ``dedup``)"""
+    return sql.SQL(
+        "CREATE UNIQUE INDEX {}IF NOT EXISTS {} ON {}{} (device_id, timestamp, payload_hash) "
+        "WHERE payload_hash IS NOT NULL"
+    ).format(sql.SQL("CONCURRENTLY " if concurrently else ""), sql.Identifier(index),
+             sql.SQL("ONLY " if only else ""), sql.Identifier(table))
+
+
+def ensure_reading_key_columns(cur):
+    """Add the nullable ``payload_hash`` column the writer inserts (a catalog-only change)"""
+    cur.execute("SET LOCAL lock_timeout = '5s'")
+    for table in PARTITIONED_TABLES:
+        # A migration twin too, so its SELECT * copy keeps matching column for column
+        for name in (table, f"{table}_partitioned"):
+            cur.execute(sql.SQL("ALTER TABLE IF EXISTS {} ADD COLUMN IF NOT EXISTS payload_hash BIGINT").format(
+                sql.Identifier(name)))
+
+
+class PartitionManager:
+    """Creates upcoming partitions and migrates heap tables to partitioned ones"""
+
+    def __init__(self, get_conn, put_conn, interval="month", ahead=3, check_hours=12,
+                 chunk_rows=MIGRATION_CHUNK_ROWS, lock_timeout_ms=5000, after_swap=None, ready=None):
+        if interval not in ("month", "week"):
+            raise ValueError(f"Unsupported partition interval: {interval}")
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.interval = interval
+        self.ahead = ahead
+        self.check_hours = check_hours
+        self.chunk_rows = chunk_rows
+        self.lock_timeout_ms = lock_timeout_ms
+        # Called with the cursor inside the swap transaction, e.g. to re-point views at the new table
+        self.after_swap = after_swap
+        # Heap migrations wait for this (e.g. a repair of the rows they copy) before they start
+        self.ready = ready
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"partitions_created": 0, "rows_moved_from_default": 0,
+                      "rows_migrated": 0, "migrations_completed": 0, "reading_keys_pending": None,
+                      "last_check": None}
+
+    def _set_lock_timeout(self, cur):
+        cur.execute("SET LOCAL lock_timeout = %s", (f"{int(self.lock_timeout_ms)}ms",))
+
+    def existing_partitions(self, cur, table):
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+        """, (table,))
+        return {row[0] for row in cur.fetchall()}
+
+    def _periods(self, first, last):
+        start = period_start(first, self.interval)
+        while start <= last:
+            yield start
+            start = next_period(start, self.interval)
+
+    def create_partition(self, cur, table, start, name=None):
+        """Create one period's partition, moving matching rows out of the default partition"""
+        parent = name or table
+        end = next_period(start, self.interval)
+        partition = partition_name(parent, start, self.interval)
+        default = f"{parent}_default"
+        self._set_lock_timeout(cur)
+        cur.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(
+            sql.Identifier(partition), sql.Identifier(parent)))
+        # Lets ATTACH skip its validation scan of the new partition
+        cur.execute(sql.SQL(
+            "ALTER TABLE {} ADD CONSTRAINT {} CHECK (timestamp >= %s AND timestamp < %s)"
+        ).format(sql.Identifier(partition), sql.Identifier(f"{partition}_range")), (start, end))
+        cur.execute(sql.SQL("""
+            WITH moved AS (
+                DELETE FROM {} WHERE timestamp >= %s AND timestamp < %s RETURNING *
+            )
+            INSERT INTO {} SELECT * FROM moved
+        """).format(sql.Identifier(default), sql.Identifier(partition)), (start, end))
+        moved = cur.rowcount
+        cur.execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(
+            sql.Identifier(parent), sql.Identifier(partition)), (start, end))
+        cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+            sql.Identifier(partition), sql.Identifier(f"{partition}_range")))
+        self.stats["partitions_created"] += 1
+        self.stats["rows_moved_from_default"] += max(moved, 0)
+        logger.info(f"[PARTITIONS] Created {partition}" + (f" ({moved} rows from default)" if moved > 0 else ""))
+
+    def ensure(self, tables=None, first=None, name=None):
+        """Create any missing partitions from ``first`` (default: now) to ``ahead`` periods out"""
+        now = datetime.now(timezone.utc)
+        last = now
+        for _ in range(self.ahead):
+            last = next_period(period_start(last, self.interval), self.interval)
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            for table in tables or PARTITIONED_TABLES:
+                parent = name or table
+                if not is_partitioned(cur, parent):
+                    continue
+                existing = self.existing_partitions(cur, parent)
+                for start in self._periods(first or now, last):
+                    if partition_name(parent, start, self.interval) in existing:
+                        continue
+                    try:
+                        self.create_partition(cur, table, start, name=name)
+                        conn.commit()
+                    except Exception as e:
+                        conn.rollback()
+                        logger.error(f"[PARTITIONS] Could not create {parent} partition for {start:%Y-%m-%d}: {e}")
+            self.stats["last_check"] = now.isoformat()
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def migrate(self, table):
+        """Convert a heap table to a partitioned one without blocking ingest; returns True when done"""
+        twin = f"{table}_partitioned"
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            if is_partitioned(cur, table):
+                return True
+            if self.ready and not self.ready():
+                return False
+            cur.execute("SELECT to_regclass(%s)", (twin,))
+            if cur.fetchone()[0] is None:
+                create_partitioned_table(cur, table, like=table, name=twin)
+                conn.commit()
+                logger.info(f"[PARTITIONS] Migrating {table} into partitioned {twin}")
+
+            cur.execute(sql.SQL("SELECT MIN(timestamp) FROM {}").format(sql.Identifier(table)))
+            oldest = cur.fetchone()[0]
+            conn.commit()
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+        if oldest is not None:
+            first = max(oldest, datetime.now(timezone.utc) - timedelta(days=31 * MAX_BACKFILL_PERIODS))
+            self.ensure(tables=[table], first=first, name=twin)
+
+        if not self._capture(table, twin) or not self._copy_chunks(table, twin):
+            return False
+        return self._swap(table, twin)
+
+    @staticmethod
+    def _state_name(table):
+        return f"partition:{table}"
+
+    def _capture(self, table, twin):
+        """Install the trigger that keeps ``twin`` in step with ``table``, and schedule the copy of older rows"""
+        name = self._state_name(table)
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute(MIGRATION_STATE_SQL)
+            cur.execute("SELECT 1 FROM dust_migration_state WHERE name = %s", (name,))
+            if cur.fetchone():
+                conn.commit()
+                return True
+            self._set_lock_timeout(cur)
+            # Rows copied without the trigger may have been updated or deleted since
+            cur.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(twin)))
+            cur.execute(sql.SQL(CAPTURE_FUNCTION_SQL).format(
+                function=sql.Identifier(f"{twin}_capture"), twin=sql.Identifier(twin)))
+            cur.execute(sql.SQL(
+                "CREATE TRIGGER {} AFTER INSERT OR UPDATE OR DELETE ON {} FOR EACH ROW EXECUTE FUNCTION {}()"
+            ).format(sql.Identifier(f"{table}_capture"), sql.Identifier(table),
+                     sql.Identifier(f"{twin}_capture")))
+            # The trigger's lock waited out every open writer, so rows it misses all have ids up to here
+            cur.execute(sql.SQL("""
+                INSERT INTO dust_migration_state (name, through_id) SELECT %s, COALESCE(MAX(id), 0) FROM {}
+            """).format(sql.Identifier(table)), (name,))
+            conn.commit()
+            logger.info(f"[PARTITIONS] Capturing changes to {table} into {twin}")
+            return True
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            logger.warning(f"[PARTITIONS] Change capture on {table} postponed: {e}")
+            return False
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def _copy_chunks(self, table, twin):
+        """Copy the rows that predate the trigger; returns True once all of them are in ``twin``"""
+        name = self._state_name(table)
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            while not self._stop.is_set():
+                cur.execute("SELECT done_id, through_id FROM dust_migration_state WHERE name = %s FOR UPDATE",
+                            (name,))
+                done_id, through_id = cur.fetchone()
+                if done_id >= through_id:
+                    conn.commit()
+                    return True
+                upper = min(done_id + self.chunk_rows, through_id)
+                # FOR SHARE: an update or delete of these rows waits for this commit, then its trigger
+                # replaces (or removes) the copy; a row already changed is copied as it is now
+                cur.execute(sql.SQL("INSERT INTO {} SELECT * FROM {} WHERE id > %s AND id <= %s FOR SHARE "
+                                    "ON CONFLICT DO NOTHING").format(
+                    sql.Identifier(twin), sql.Identifier(table)), (done_id, upper))
+                copied = cur.rowcount
+                cur.execute("UPDATE dust_migration_state SET done_id = %s, updated_at = NOW() WHERE name = %s",
+                            (upper, name))
+                conn.commit()
+                self.stats["rows_migrated"] += copied
+                logger.debug(f"[PARTITIONS] {table}: copied through id {upper} of {through_id}")
+            return False
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def _swap(self, table, twin):
+        """Drop the capture trigger and swap the tables in one short transaction"""
+        if self._stop.is_set():
+            return False
+        prefix = PARTITIONED_TABLES[table]["index_prefix"]
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            self._set_lock_timeout(cur)
+            # Taken by the renames anyway; asking first means waiting once, up to the lock timeout
+            cur.execute(sql.SQL("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE").format(sql.Identifier(table)))
+            cur.execute(sql.SQL("DROP TRIGGER {} ON {}").format(
+                sql.Identifier(f"{table}_capture"), sql.Identifier(table)))
+            cur.execute(sql.SQL("DROP FUNCTION {}()").format(sql.Identifier(f"{twin}_capture")))
+            cur.execute("DELETE FROM dust_migration_state WHERE name = %s", (self._state_name(table),))
+            cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+            sequence = cur.fetchone()[0]
+
+            legacy = f"{table}_unpartitioned"
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(table), sql.Identifier(legacy)))
+            for index in (f"{table}_pkey", f"{prefix}_device_timestamp", f"{prefix}_timestamp",
+                          f"{prefix}_reading_hash"):
+                cur.execute(sql.SQL("ALTER INDEX IF EXISTS {} RENAME TO {}").format(
+                    sql.Identifier(index), sql.Identifier(f"{index}_unpartitioned")))
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(twin), sql.Identifier(table)))
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                sql.Identifier(f"{twin}_default"), sql.Identifier(f"{table}_default")))
+            for child in self.existing_partitions(cur, table):
+                if child.startswith(f"{twin}_p"):
+                    cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                        sql.Identifier(child), sql.Identifier(table + child[len(twin):])))
+            cur.execute(sql.SQL("ALTER INDEX IF EXISTS {} RENAME TO {}").format(
+                sql.Identifier(f"{twin}_pkey"), sql.Identifier(f"{table}_pkey")))
+            for index in (f"{prefix}_device_timestamp", f"{prefix}_timestamp_brin", f"{prefix}_reading_hash"):
+                cur.execute(sql.SQL("ALTER INDEX IF EXISTS {} RENAME TO {}").format(
+                    sql.Identifier(f"{index}_partitioned"), sql.Identifier(index)))
+            if sequence:
+                # Keep the id sequence alive if the legacy table is dropped later
+                cur.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY {}.id").format(
+                    sql.SQL(sequence), sql.Identifier(table)))
+            if self.after_swap:
+                self.after_swap(cur)
+            conn.commit()
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            logger.warning(f"[PARTITIONS] Swap of {table} postponed: {e}")
+            return False
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+        self.stats["migrations_completed"] += 1
+        logger.info(f"[PARTITIONS] {table} is now partitioned; the old heap is kept as "
+                    f"{table}_unpartitioned and can be dropped once verified")
+        return True
+
+    def _index_valid(self, cur, index):
+        """None if ``index`` does not exist, otherwise whether it is valid"""
+        cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (index,))
+        row = cur.fetchone()
+        return None if row is None else row[0]
+
+    def _build_concurrently(self, cur, index, table):
+        """Build the reading key on a heap table or a single partition without blocking writes"""
+        if self._index_valid(cur, index) is False:
+            # Left behind by an interrupted concurrent build
+            cur.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(index)))
+        # Redeliveries written between adding the hash column and building its key
+        ident = sql.Identifier(table)
+        cur.execute(sql.SQL("""
+            DELETE FROM {} a USING {} b
+            WHERE a.payload_hash IS NOT NULL AND a.payload_hash = b.payload_hash
+              AND a.device_id = b.device_id AND a.timestamp = b.timestamp AND a.id > b.id
+        """).format(ident, ident))
+        if cur.rowcount > 0:
+            logger.info(f"[PARTITIONS] Removed {cur.rowcount} redelivered rows from {table}")
+        cur.execute(reading_key_sql(index, table, concurrently=True))
+
+    def _build_reading_key(self, cur, table, index):
+        if not is_partitioned(cur, table):
+            self._build_concurrently(cur, index, table)
+            return
+        # Invalid until every partition has an attached index of its own
+        cur.execute(reading_key_sql(index, table, only=True))
+        for partition in sorted(self.existing_partitions(cur, table)):
+            if self._stop.is_set():
+                return
+            cur.execute("""
+                SELECT 1 FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid
+                WHERE i.inhparent = to_regclass(%s) AND x.indrelid = to_regclass(%s)
+            """, (index, partition))
+            if cur.fetchone():
+                continue
+            child = f"{partition}_reading_hash"
+            self._build_concurrently(cur, child, partition)
+            cur.execute(sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(
+                sql.Identifier(index), sql.Identifier(child)))
+
+    def ensure_reading_keys(self, tables=None):
+        """Build the reading key on tables that predate it; returns the tables still without a valid key"""
+        missing = []
+        conn = None
+        try:
+            conn = self.get_conn()
+            # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+            conn.autocommit = True
+            cur = conn.cursor()
+            # A concurrent build on years of history outlasts the pool's statement timeout
+            cur.execute("SET statement_timeout = 0")
+            for table in tables or PARTITIONED_TABLES:
+                index = f"{PARTITIONED_TABLES[table]['index_prefix']}_reading_hash"
+                try:
+                    if self._index_valid(cur, index):
+                        continue
+                    logger.info(f"[PARTITIONS] Building the unique reading key of {table} concurrently")
+                    self._build_reading_key(cur, table, index)
+                    if self._index_valid(cur, index):
+                        logger.info(f"[PARTITIONS] Unique reading key of {table} is ready")
+                    else:
+                        missing.append(table)
+                except Exception as e:
+                    missing.append(table)
+                    logger.error(f"[PARTITIONS] Building the reading key of {table} failed: {e}")
+            cur.execute("RESET statement_timeout")
+            conn.autocommit = False
+        except Exception:
+            # Never hand a session without a statement timeout back to the pool
+            if conn:
+                conn.close()
+            raise
+        finally:
+            if conn:
+                self.put_conn(conn)
+        self.stats["reading_keys_pending"] = missing
+        return missing
+
+    def run_once(self):
+        pending = []
+        for table in PARTITIONED_TABLES:
+            try:
+                if not self.migrate(table):
+                    pending.append(table)
+            except Exception as e:
+                pending.append(table)
+                logger.error(f"[PARTITIONS] Migration of {table} failed: {e}")
+        try:
+            self.ensure()
+        except Exception as e:
+            logger.error(f"[PARTITIONS] Partition check failed: {e}")
+        # A table still being migrated gets the key from its partitioned twin; a failed
+        # build is retried at the next regular check rather than every minute
+        ready = [table for table in PARTITIONED_TABLES if table not in pending]
+        if ready:
+            try:
+                self.ensure_reading_keys(ready)
+            except Exception as e:
+                logger.error(f"[PARTITIONS] Reading key check failed: {e}")
+        return pending
+
+    def _run(self):
+        while not self._stop.is_set():
+            pending = self.run_once()
+            # Retry an unfinished migration soon; otherwise just keep partitions ahead
+            self._stop.wait(60 if pending else self.check_hours * 3600)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="PartitionManager")
+        self._thread.start()
+        logger.info(f"[PARTITIONS] Manager started ({self.interval}ly partitions, {self.ahead} ahead)")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
@@ -0,0 +1,252 @@
+"""Compiled decoders for the MQTT payload formats devices send.
+
+Each known payload shape is declared once as a ``PayloadFormat``: the topic
+it arrives on, the keys that identify it, the table it is written to and a
+list of ``Field`` specs (where a value lives in the payload, its unit
+conversion and its default).  Registering a format compiles the specs into
+flat ``(key or index, slot, convert)`` tuples grouped by container, so
+decoding a message is one pass over the spec into a fixed-slot record laid
+out like ``TABLE_COLUMNS[table]``, ready for ``BatchWriter.add_values``.
+There are no per-field ``in`` checks or bounds-checked index chains.
+
+Built-in formats (``default_registry()``), tried in ``priority`` order:
+
+* ``compact``: ``{"i", "t", "e": [...], "pm": [...], "g": {...}}``;
+* ``legacy_extended``: ``PM_data`` plus ``Temperature_C``/``Humidity_%``/``GPS``;
+* ``basic``: PM-only ``PM_data`` in mg/m³, stored as µg/m³;
+* ``status``: anything on a ``status`` topic (no table; applied as device status).
+
+New firmware formats are added with ``registry.register(PayloadFormat(...))``;
+the pipeline's hot path does not change.  ``decode_columns`` decodes many
+messages of one format into column arrays.
+
+``loads`` parses a payload straight from the MQTT ``bytes`` buffer, without a
+UTF-8 ``str`` copy first.  It uses ``orjson`` when it is installed (optional,
+several times faster on the compact format) and the stdlib ``json`` otherwise;
+both raise ``json.JSONDecodeError`` (or ``UnicodeDecodeError``) on bad input.
+"""
+import json
+import logging
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from ingest_writer import TABLE_COLUMNS
+from measurements import PM_SOURCE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch one type either way
+loads = orjson.loads if orjson is not None else json.loads
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+class Field:
+    """One column of a format: ``source`` is a top-level key, or (container key, index or key)"""
+
+    def __init__(self, column, source, convert=None, default=None):
+        self.column = column
+        self.source = source
+        self.convert = convert
+        self.default = default
+
+
+def parse_device_timestamp(value):
+    """ISO 8601 device timestamp, with a trailing ``Z`` accepted for UTC"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _nonzero(scale):
+    """Unit conversion that treats 0 as "no reading", as the compact firmware sends 0 for absent sensors"""
+    return lambda value: value * scale if value != 0 else None
+
+
+def _mg_to_ug(value):
+    return float(value) * 1000
+
+
+class PayloadFormat:
+    """Declarative payload shape, compiled into a single-pass decoder"""
+
+    def __init__(self, name, table, fields=(), topic_suffix="data", required=(), any_of=(),
+                 timestamp_key=None, priority=50):
+        self.name = name
+        self.table = table
+        self.topic_suffix = topic_suffix
+        self.required = frozenset(required)
+        self.any_of = frozenset(any_of)
+        self.timestamp_key = timestamp_key
+        self.priority = priority
+        self.fields = list(fields)
+        self._compile()
+
+    def _compile(self):
+        if self.table is None:
+            return
+        columns = TABLE_COLUMNS[self.table]
+        self.width = len(columns)
+        self.device_slot = columns.index("device_id")
+        self.timestamp_slot = columns.index("timestamp")
+        self.source_slot = columns.index("data_source_id") if "data_source_id" in columns else None
+        self.hash_slot = columns.index("payload_hash")
+        self.pm_slots = tuple(columns.index(c) for c in PM_SOURCE_COLUMNS[self.table])
+        template = [None] * self.width
+        top, containers = [], {}
+        for field in self.fields:
+            slot = columns.index(field.column)
+            if field.default is not None:
+                template[slot] = field.convert(field.default) if field.convert else field.default
+            if isinstance(field.source, tuple):
+                key, item = field.source
+                containers.setdefault(key, []).append((item, slot, field.convert))
+            else:
+                top.append((field.source, slot, field.convert))
+        self._template = tuple(template)
+        self._top = tuple(top)
+        # (container key, indexed by position?, highest index + 1, items)
+        compiled = []
+        for key, items in containers.items():
+            indexed = isinstance(items[0][0], int)
+            span = max(index for index, _, _ in items) + 1 if indexed else 0
+            compiled.append((key, indexed, span, tuple(items)))
+        self._containers = tuple(compiled)
+
+    def matches(self, keys):
+        return self.required <= keys and (not self.any_of or not self.any_of.isdisjoint(keys))
+
+    def device_timestamp(self, payload):
+        """Raw device timestamp of a message, or None if the format has none"""
+        return payload.get(self.timestamp_key) if self.timestamp_key else None
+
+    def decode(self, payload, received_at):
+        """Fixed-slot record in ``TABLE_COLUMNS[table]`` order; device/data source/hash slots are left to the caller"""
+        values = list(self._template)
+        for key, slot, convert in self._top:
+            value = payload.get(key)
+            if value is not None:
+                values[slot] = convert(value) if convert else value
+        for key, indexed, span, items in self._containers:
+            container = payload.get(key)
+            if not container:
+                continue
+            if indexed:
+                size = len(container)
+                if size < span:
+                    items = [item for item in items if item[0] < size]
+                for index, slot, convert in items:
+                    value = container[index]
+                    if value is not None:
+                        values[slot] = convert(value) if convert else value
+            else:
+                for name, slot, convert in items:
+                    value = container.get(name)
+                    if value is not None:
+                        values[slot] = convert(value) if convert else value
+        values[self.timestamp_slot] = self._timestamp(payload, received_at)
+        return values
+
+    def _timestamp(self, payload, received_at):
+        raw = self.device_timestamp(payload)
+        if not raw:
+            return received_at
+        try:
+            return parse_device_timestamp(raw)
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.warning(f"[DECODE] Invalid {self.name} timestamp {raw!r} - using server timestamp: {e}")
+            return received_at
+
+    def decode_columns(self, payloads, received_at):
+        """Column arrays (one list per table column) for many payloads of this format"""
+        if not payloads:
+            return [[] for _ in range(self.width)]
+        return [list(column) for column in zip(*(self.decode(payload, received_at) for payload in payloads))]
+
+
+class DecoderRegistry:
+    """Payload formats by topic, matched in priority order"""
+
+    def __init__(self, formats=()):
+        self._formats = []
+        for payload_format in formats:
+            self.register(payload_format)
+
+    def register(self, payload_format):
+        self._formats = sorted([f for f in self._formats if f.name != payload_format.name] + [payload_format],
+                               key=lambda f: f.priority)
+
+    @property
+    def formats(self):
+        return list(self._formats)
+
+    def match(self, topic, payload):
+        """The first format for this topic whose identifying keys the payload has, or None"""
+        keys = payload.keys()
+        for payload_format in self._formats:
+            if topic.endswith(payload_format.topic_suffix) and payload_format.matches(keys):
+                return payload_format
+        return None
+
+
+COMPACT = PayloadFormat(
+    "compact", "dust_extended_data",
+    required=("e", "pm", "g"), timestamp_key="t", priority=10,
+    fields=[
+        Field("temperature_c", ("e", 0)),
+        Field("humidity_percent", ("e", 1)),
+        Field("pressure_hpa", ("e", 2)),
+        Field("uv_index", ("e", 3)),
+        Field("lux", ("e", 4)),
+        # Raw VOC ADC counts (e.g. 32044 -> 32.044 ppb) and NO2 in ppm (0.605 -> 605 ppb)
+        Field("voc_ppb", ("e", 5), _nonzero(1 / 1000)),
+        Field("no2_ppb", ("e", 6), _nonzero(1000)),
+        Field("noise_db", ("e", 7)),
+        Field("battery_percent", ("e", 18)),
+        Field("pm1", ("pm", 0)),
+        Field("pm2_5", ("pm", 1)),
+        Field("pm4", ("pm", 2)),
+        Field("pm10", ("pm", 3)),
+        Field("tsp_um", ("pm", 4)),
+        Field("gps_lat", ("g", "lat")),
+        Field("gps_lon", ("g", "lon")),
+    ],
+)
+
+LEGACY_EXTENDED = PayloadFormat(
+    "legacy_extended", "dust_extended_data",
+    required=("PM_data",), any_of=("Temperature_C", "Humidity_%", "GPS"), timestamp_key="timestamp_utc",
+    priority=20,
+    fields=[
+        Field("temperature_c", "Temperature_C"),
+        Field("humidity_percent", "Humidity_%"),
+        Field("pressure_hpa", "Pressure_hPa"),
+        Field("voc_ppb", "VOC_ppb"),
+        Field("no2_ppb", "NO2_ppb"),
+        Field("pm1", ("PM_data", "PM1")),
+        Field("pm2_5", ("PM_data", "PM2_5")),
+        Field("pm4", ("PM_data", "PM4")),
+        Field("pm10", ("PM_data", "PM10")),
+        Field("tsp_um", ("PM_data", "TSP_um")),
+        Field("gps_lat", ("GPS", "Latitude")),
+        Field("gps_lon", ("GPS", "Longitude")),
+        Field("gps_alt_m", ("GPS", "Altitude_m")),
+        Field("gps_speed_kmh", ("GPS", "Speed_kmh")),
+        Field("cloud_cover_percent", "Cloud_cover_%"),
+    ],
+)
+
+# Catch-all for the data topic: PM in mg/m³, missing channels stored as 0
+BASIC = PayloadFormat(
+    "basic", "dust_sensor_data", priority=100,
+    fields=[Field(column, ("PM_data", key), _mg_to_ug, default=0)
+            for column, key in (("pm1", "PM1"), ("pm2_5", "PM2_5"), ("pm4", "PM4"),
+                                ("pm10", "PM10"), ("tsp", "TSP_um"))],
+)
+
+STATUS = PayloadFormat("status", None, topic_suffix="status", priority=100)
+
+
+def default_registry():
+    return DecoderRegistry([COMPACT, LEGACY_EXTENDED, BASIC, STATUS])
@@ -0,0 +1,126 @@
+"""Resolution routing for every history read (/api/data charts and CSV export).
+
+``plan_history`` picks the cheapest source that satisfies a request's range
+and point budget - raw rows for short windows, then the rollup tiers
+maintained by ``rollups`` - and the bucket width to serve at.  Routing by
+window length (``ROUTES``) follows how many rows each source holds for that
+window; the point budget then only ever makes buckets wider, never finer
+than the chosen source.  An explicit ``bucket`` width is served from the
+coarsest tier that divides it exactly.
+
+Every plan is counted per resolution (``tier_hits()``) so the routing can be
+watched under load, and callers return ``plan.resolution`` in their response.
+"""
+import math
+import threading
+from collections import namedtuple
+
+from history_query import (choose_bucket, fetch_pm_history, fetch_extended_history,
+                           RAW_BUCKET_SECONDS)
+from rollups import TIERS, TIER_SECONDS, rollup_table
+from csv_export import export_queries, has_export_data
+
+# Window length (hours, exclusive upper bound) -> source; None means "anything longer"
+ROUTES = ((1, "raw"), (48, "1m"), (None, "1h"))
+RESOLUTIONS = ("raw",) + tuple(name for name, _ in TIERS)
+
+# resolution: "raw" or a rollup tier; bucket_seconds: None for unbucketed raw rows
+Plan = namedtuple("Plan", "resolution bucket_seconds")
+
+_hits_lock = threading.Lock()
+_hits = {resolution: 0 for resolution in RESOLUTIONS}
+
+
+def _record(plan):
+    with _hits_lock:
+        _hits[plan.resolution] += 1
+    return plan
+
+
+def tier_hits():
+    """Number of plans served per resolution since startup"""
+    with _hits_lock:
+        return dict(_hits)
+
+
+def route(hours):
+    for limit, resolution in ROUTES:
+        if limit is None or hours < limit:
+            return resolution
+    return "raw"
+
+
+def _tier_for_bucket(seconds):
+    """Coarsest tier whose width divides ``seconds``, or raw"""
+    for name, width in reversed(TIERS):
+        if width <= seconds and seconds % width == 0:
+            return name
+    return "raw"
+
+
+def plan_history(hours, max_points=None, bucket=None, rollups_ready=True):
+    """Plan for a chart window of ``hours`` with an optional point budget or fixed bucket.
+
+    Until the rollup backfill has caught up (``rollups_ready`` false) every
+    plan reads raw rows, bucketed in SQL as before.
+    """
+    if bucket:
+        seconds = int(bucket)
+        if seconds <= RAW_BUCKET_SECONDS:
+            return _record(Plan("raw", None))
+        return _record(Plan(_tier_for_bucket(seconds) if rollups_ready else "raw", seconds))
+    if max_points is not None and max_points <= 0:
+        return _record(Plan("raw", None))
+
+    needed = choose_bucket(hours, max_points)
+    resolution = route(hours) if rollups_ready else "raw"
+    if resolution == "raw":
+        return _record(Plan("raw", needed))
+    width = TIER_SECONDS[resolution]
+    seconds = width if needed is None else math.ceil(needed / width) * width
+    # Very long windows: read an even coarser tier when the buckets line up with it
+    coarser = _tier_for_bucket(seconds)
+    if coarser != "raw" and TIER_SECONDS[coarser] > width:
+        resolution = coarser
+    return _record(Plan(resolution, seconds))
+
+
+def plan_export(hours, resolution=None, max_points=None, rollups_ready=True):
+    """Exports stay raw unless a resolution or a point budget is asked for"""
+    if resolution in TIER_SECONDS and rollups_ready:
+        return _record(Plan(resolution, TIER_SECONDS[resolution]))
+    if max_points:
+        return plan_history(hours, max_points, rollups_ready=rollups_ready)
+    return _record(Plan("raw", None))
+
+
+def _rollup(plan, source):
+    return None if plan.resolution == "raw" else rollup_table(source, plan.resolution)
+
+
+def fetch_pm(cur, device_id, hours, plan):
+    history = fetch_pm_history(cur, device_id, hours, plan.bucket_seconds,
+                               rollup_table=_rollup(plan, "dust_sensor_data"))
+    history["bucket_seconds"] = plan.bucket_seconds
+    history["resolution"] = plan.resolution
+    return history
+
+
+def fetch_extended(cur, device_id, hours, plan):
+    return fetch_extended_history(cur, device_id, hours, plan.bucket_seconds,
+                                  rollup_table=_rollup(plan, "dust_extended_data"))
+
+
+def _export_tables(plan):
+    if plan.resolution == "raw":
+        return None
+    return _rollup(plan, "dust_sensor_data"), _rollup(plan, "dust_extended_data")
+
+
+def export_has_data(cur, device_id, start, end, plan):
+    return has_export_data(cur, device_id, start, end, rollup_tables=_export_tables(plan))
+
+
+def export_sql(plan):
+    """(sensor SQL, extended SQL) for ``csv_export.stream_csv``"""
+    return export_queries(_export_tables(plan), plan.bucket_seconds)
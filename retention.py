@@ -0,0 +1,285 @@
+"""Retention policy engine for raw readings and rollup tiers.
+
+A policy maps each resolution to a number of days to keep (``None`` keeps
+forever), with optional per-data-source overrides for the raw tables::
+
+    {"raw": 90, "1m": 730, "15m": 730, "1h": null, "1d": null,
+     "data_sources": {"3": {"raw": 30}}}
+
+It is read from the ``RETENTION_POLICY`` environment variable (JSON) and
+falls back to ``DEFAULT_POLICY``.  A background job enforces it:
+
+* raw partitions whose whole range is older than the longest raw retention
+  in force are detached and dropped, which frees space without touching rows;
+* everything else expired (the default partition, per-source overrides,
+  rollup tiers) is deleted in small primary-key batches, one short
+  transaction each, with a pause in between;
+* every table that lost rows is ANALYZEd.
+
+DDL runs with a short ``lock_timeout`` and is retried on the next run rather
+than queued behind ingest, so retention never stalls the batch writer.
+Raw rows are only removed once the rollup backfill has folded them in, and
+never past ``raw_floor()`` when one is given (the cold archive's watermark).
+"""
+import json
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from psycopg2 import sql
+
+from rollups import SOURCES, TIERS, rollup_table
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLICY = {"raw": 90, "1m": 730, "15m": 730, "1h": None, "1d": None}
+
+RAW_TABLES = tuple(SOURCES)
+DELETE_BATCH_ROWS = 5000
+BATCH_PAUSE_SECONDS = 0.2
+
+_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def load_policy(raw=None):
+    """Parse a JSON policy, filling unspecified resolutions from DEFAULT_POLICY"""
+    policy = dict(DEFAULT_POLICY)
+    overrides = {}
+    if raw:
+        parsed = json.loads(raw)
+        overrides = {int(ds): dict(values) for ds, values in parsed.pop("data_sources", {}).items()}
+        policy.update(parsed)
+    unknown = set(policy) - set(DEFAULT_POLICY)
+    if unknown:
+        raise ValueError(f"Unknown retention resolutions: {sorted(unknown)}")
+    policy["data_sources"] = overrides
+    return policy
+
+
+def _cutoff(days, now):
+    return None if days is None else now - timedelta(days=days)
+
+
+def _source_filter(table):
+    """SQL restricting a raw table to rows of the given data sources"""
+    if table == "dust_sensor_data":
+        return "data_source_id = ANY(%(sources)s)"
+    return "device_id IN (SELECT id FROM dust_devices WHERE data_source_id = ANY(%(sources)s))"
+
+
+def _default_filter(table):
+    """SQL for rows not covered by a per-source override"""
+    if table == "dust_sensor_data":
+        return "(data_source_id IS NULL OR NOT data_source_id = ANY(%(sources)s))"
+    return ("(device_id IS NULL OR device_id NOT IN "
+            "(SELECT id FROM dust_devices WHERE data_source_id = ANY(%(sources)s)))")
+
+
+def delete_in_batches(conn, table, key, time_column, cutoff, condition="TRUE", params=None,
+                      batch_rows=DELETE_BATCH_ROWS, stop=None):
+    """Delete rows of ``table`` older than ``cutoff`` (and matching ``condition``) by primary
+    ``key``, ``batch_rows`` at a time, committing after each batch; returns the row count"""
+    query = sql.SQL("""
+        DELETE FROM {table} WHERE ({key}) IN (
+            SELECT {key} FROM {table}
+            WHERE {time_column} < %(cutoff)s AND {condition}
+            LIMIT %(limit)s
+        )
+    """).format(
+        table=sql.Identifier(table),
+        key=sql.SQL(", ").join(sql.Identifier(k) for k in key),
+        time_column=sql.Identifier(time_column),
+        condition=sql.SQL(condition),
+    )
+    params = {**(params or {}), "cutoff": cutoff, "limit": batch_rows}
+    cur = conn.cursor()
+    deleted = 0
+    while stop is None or not stop.is_set():
+        cur.execute(query, params)
+        count = cur.rowcount
+        conn.commit()
+        deleted += count
+        if count < batch_rows:
+            break
+        time.sleep(BATCH_PAUSE_SECONDS)
+    return deleted
+
+
+class RetentionManager:
+    """Background job that drops or batch-deletes data past its retention"""
+
+    def __init__(self, get_conn, put_conn, policy=None, interval_hours=6, ready=None,
+                 raw_floor=None, batch_rows=DELETE_BATCH_ROWS, lock_timeout_ms=2000):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.policy = policy or load_policy()
+        self.interval_hours = interval_hours
+        self.ready = ready
+        self.raw_floor = raw_floor
+        self.batch_rows = batch_rows
+        self.lock_timeout_ms = lock_timeout_ms
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"runs": 0, "partitions_dropped": 0, "rows_deleted": 0,
+                      "lock_timeouts": 0, "last_run": None, "last_run_seconds": 0.0}
+
+    def _raw_days(self, source=None):
+        if source is not None and "raw" in self.policy["data_sources"].get(source, {}):
+            return self.policy["data_sources"][source]["raw"]
+        return self.policy["raw"]
+
+    def _longest_raw_days(self):
+        days = [self._raw_days()] + [self._raw_days(ds) for ds in self.policy["data_sources"]]
+        return None if any(d is None for d in days) else max(days)
+
+    def drop_expired_partitions(self, table, cutoff):
+        """Detach and drop partitions that end at or before ``cutoff``"""
+        conn = None
+        dropped = 0
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = to_regclass(%s)
+            """, (table,))
+            partitions = cur.fetchall()
+            conn.commit()
+            for name, bound in partitions:
+                match = _BOUND_RE.search(bound or "")
+                if not match:
+                    continue  # the default partition
+                upper = datetime.fromisoformat(match.group(2))
+                if upper.tzinfo is None:
+                    upper = upper.replace(tzinfo=timezone.utc)
+                if upper > cutoff:
+                    continue
+                try:
+                    cur.execute("SET LOCAL lock_timeout = %s", (f"{int(self.lock_timeout_ms)}ms",))
+                    cur.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                        sql.Identifier(table), sql.Identifier(name)))
+                    cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+                    conn.commit()
+                    dropped += 1
+                    logger.info(f"[RETENTION] Dropped partition {name} (ended {upper:%Y-%m-%d})")
+                except Exception as e:
+                    conn.rollback()
+                    self.stats["lock_timeouts"] += 1
+                    logger.warning(f"[RETENTION] Could not drop {name}, will retry next run: {e}")
+        finally:
+            if conn:
+                self.put_conn(conn)
+        self.stats["partitions_dropped"] += dropped
+        return dropped
+
+    def delete_batches(self, table, key, time_column, cutoff, condition="TRUE", params=None):
+        """Delete rows older than ``cutoff`` in ``batch_rows`` chunks, each in its own transaction"""
+        conn = None
+        try:
+            conn = self.get_conn()
+            deleted = delete_in_batches(conn, table, key, time_column, cutoff, condition, params,
+                                        self.batch_rows, self._stop)
+        finally:
+            if conn:
+                self.put_conn(conn)
+        self.stats["rows_deleted"] += deleted
+        if deleted:
+            logger.info(f"[RETENTION] Deleted {deleted} rows from {table} older than {cutoff:%Y-%m-%d}")
+        return deleted
+
+    def analyze(self, tables):
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            for table in tables:
+                cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+                conn.commit()
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+    def enforce_raw(self, table, now, floor=None):
+        """Expire raw rows of ``table``; nothing at or after ``floor`` is removed"""
+        def cutoff_for(days):
+            cutoff = _cutoff(days, now)
+            return cutoff if cutoff is None or floor is None else min(cutoff, floor)
+
+        changed = False
+        longest = self._longest_raw_days()
+        if longest is not None:
+            changed |= self.drop_expired_partitions(table, cutoff_for(longest)) > 0
+
+        overrides = list(self.policy["data_sources"])
+        default_cutoff = cutoff_for(self._raw_days())
+        if default_cutoff is not None:
+            changed |= self.delete_batches(table, ("id", "timestamp"), "timestamp", default_cutoff,
+                                           _default_filter(table), {"sources": overrides}) > 0
+        for source in overrides:
+            cutoff = cutoff_for(self._raw_days(source))
+            if cutoff is not None:
+                changed |= self.delete_batches(table, ("id", "timestamp"), "timestamp", cutoff,
+                                               _source_filter(table), {"sources": [source]}) > 0
+        return changed
+
+    def run_once(self):
+        started = time.monotonic()
+        now = datetime.now(timezone.utc)
+        changed = []
+        floor = self.raw_floor() if self.raw_floor else None
+        if self.raw_floor and floor is None:
+            logger.info("[RETENTION] Raw rows not archived yet; raw retention skipped this run")
+        elif self.ready is None or self.ready():
+            for table in RAW_TABLES:
+                try:
+                    if self.enforce_raw(table, now, floor):
+                        changed.append(table)
+                except Exception as e:
+                    logger.error(f"[RETENTION] Raw retention for {table} failed: {e}")
+        else:
+            logger.info("[RETENTION] Rollup backfill still running; raw retention skipped this run")
+
+        for tier, _ in TIERS:
+            cutoff = _cutoff(self.policy.get(tier), now)
+            if cutoff is None:
+                continue
+            for source in SOURCES:
+                table = rollup_table(source, tier)
+                try:
+                    if self.delete_batches(table, ("device_id", "bucket"), "bucket", cutoff) > 0:
+                        changed.append(table)
+                except Exception as e:
+                    logger.error(f"[RETENTION] Retention for {table} failed: {e}")
+
+        if changed:
+            try:
+                self.analyze(changed)
+            except Exception as e:
+                logger.error(f"[RETENTION] ANALYZE failed: {e}")
+        self.stats["runs"] += 1
+        self.stats["last_run"] = now.isoformat()
+        self.stats["last_run_seconds"] = round(time.monotonic() - started, 2)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"[RETENTION] Run failed: {e}")
+            self._stop.wait(self.interval_hours * 3600)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="Retention")
+        self._thread.start()
+        logger.info(f"[RETENTION] Policy: {json.dumps(self.policy)}")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
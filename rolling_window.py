@@ -0,0 +1,276 @@
+"""Incremental rolling averages for relay threshold evaluation.
+
+Each relay device keeps a time-ordered buffer of its PM readings covering the
+configured ``averaging_window`` plus running sums and counts per channel, so
+adding a reading or expiring old ones is O(1) per reading and computing the
+averages needs no SQL.  The semantics match the query ``process_thresholds``
+used to run: readings with ``timestamp >= NOW() - window`` and NULLs ignored
+per channel, like ``AVG()``.
+
+``ThresholdEngine`` is a BatchWriter stage: windows are fed from each flush's
+committed rows in ``after_commit``, after duplicates and rejected rows were
+taken out of the batch, so a redelivered, rejected or not yet written reading
+never reaches the averages that drive the relays.  A device's window is
+loaded from the database outside the engine lock; readings committed while
+it loads are buffered and merged in.
+
+The web process also answers ``/api/data`` averages and thresholds from its
+engine; a web worker whose own writer does not commit the readings feeds its
+windows from the ingest bus instead (see ``app.handle_ingest_updates``).
+"""
+import logging
+import math
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from measurements import PM_VIEW, pm_rows
+
+logger = logging.getLogger(__name__)
+
+PM_CHANNELS = ("pm1", "pm2_5", "pm4", "pm10", "tsp")
+THRESHOLD_KEYS = ("pm1", "pm2.5", "pm4", "pm10", "tsp")
+DEFAULT_WINDOW_MINUTES = 15
+MAX_WINDOW_MINUTES = 60
+
+# Re-sum from scratch after this many expirations to bound float drift
+RESUM_EVERY = 10000
+
+
+def _epoch(ts):
+    return ts.timestamp() if isinstance(ts, datetime) else float(ts)
+
+
+def _reading_key(ts, values):
+    return _epoch(ts), tuple(None if v is None else float(v) for v in values)
+
+
+class RollingWindow:
+    """Time-bounded buffer of readings with running per-channel sums"""
+
+    def __init__(self, window_seconds, channels=len(PM_CHANNELS)):
+        self.window_seconds = window_seconds
+        self._readings = deque()
+        self._sums = [0.0] * channels
+        self._counts = [0] * channels
+        self._expired = 0
+
+    def __len__(self):
+        return len(self._readings)
+
+    def add(self, ts, values):
+        """Add one reading; ``values`` holds one number or None per channel"""
+        ts = _epoch(ts)
+        reading = (ts, tuple(None if v is None else float(v) for v in values))
+        if self._readings and ts < self._readings[-1][0]:
+            # Late reading: keep the buffer ordered so expiry stays a popleft
+            index = len(self._readings)
+            while index and self._readings[index - 1][0] > ts:
+                index -= 1
+            self._readings.insert(index, reading)
+        else:
+            self._readings.append(reading)
+        for i, value in enumerate(reading[1]):
+            if value is not None:
+                self._sums[i] += value
+                self._counts[i] += 1
+
+    def expire(self, now=None):
+        cutoff = (time.time() if now is None else _epoch(now)) - self.window_seconds
+        readings = self._readings
+        while readings and readings[0][0] < cutoff:
+            _, values = readings.popleft()
+            for i, value in enumerate(values):
+                if value is not None:
+                    self._counts[i] -= 1
+                    self._sums[i] = self._sums[i] - value if self._counts[i] else 0.0
+            self._expired += 1
+        if self._expired >= RESUM_EVERY:
+            self._resum()
+
+    def _resum(self):
+        for i in range(len(self._sums)):
+            self._sums[i] = math.fsum(v[i] for _, v in self._readings if v[i] is not None)
+        self._expired = 0
+
+    def averages(self, now=None):
+        """Per-channel averages over the window, None where a channel has no values"""
+        self.expire(now)
+        return tuple(
+            self._sums[i] / self._counts[i] if self._counts[i] else None
+            for i in range(len(self._sums))
+        )
+
+
+class ThresholdEngine:
+    """Per-device rolling windows and cached thresholds for relay control"""
+
+    def __init__(self, get_conn, put_conn):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._thresholds = {}
+        # device_id -> readings committed while its window is being loaded
+        self._loading = {}
+
+    def window_minutes(self, device_id):
+        return self._minutes(self._thresholds.get(device_id))
+
+    @staticmethod
+    def _minutes(thresholds):
+        minutes = thresholds["averaging_window"] if thresholds else DEFAULT_WINDOW_MINUTES
+        return min(int(minutes or DEFAULT_WINDOW_MINUTES), MAX_WINDOW_MINUTES)
+
+    def warm_start(self):
+        """Load latest thresholds for all devices and recent readings for relay devices"""
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT DISTINCT ON (device_id) device_id, pm1, pm2_5, pm4, pm10, tsp, averaging_window
+                FROM dust_thresholds
+                ORDER BY device_id, timestamp DESC
+            """)
+            threshold_rows = cur.fetchall()
+            cur.execute(f"""
+                SELECT s.device_id, s.timestamp, s.pm1, s.pm2_5, s.pm4, s.pm10, s.tsp
+                FROM {PM_VIEW} s
+                JOIN dust_devices d ON d.id = s.device_id
+                WHERE d.has_relay AND s.timestamp >= NOW() - INTERVAL '1 minute' * %s
+                ORDER BY s.device_id, s.timestamp ASC
+            """, (MAX_WINDOW_MINUTES,))
+            reading_rows = cur.fetchall()
+            cur.execute("SELECT id FROM dust_devices WHERE has_relay")
+            relay_devices = [row[0] for row in cur.fetchall()]
+        finally:
+            if conn:
+                self.put_conn(conn)
+
+        with self._lock:
+            for row in threshold_rows:
+                self._thresholds[row[0]] = self._threshold_dict(row[1:])
+            for device_id in relay_devices:
+                self._windows[device_id] = RollingWindow(self.window_minutes(device_id) * 60)
+            for row in reading_rows:
+                window = self._windows.get(row[0])
+                if window:
+                    window.add(row[1], row[2:])
+            for window in self._windows.values():
+                window.expire()
+        logger.info(f"[THRESHOLDS] Warm-started {len(self._windows)} relay devices "
+                    f"from {len(reading_rows)} readings")
+
+    @staticmethod
+    def _threshold_dict(row):
+        thresholds = dict(zip(THRESHOLD_KEYS, row[:5]))
+        thresholds["averaging_window"] = row[5]
+        return thresholds
+
+    def _load_device(self, device_id):
+        """Cold path: one device's thresholds and recent readings from the database (no lock held)"""
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT pm1, pm2_5, pm4, pm10, tsp, averaging_window
+                FROM dust_thresholds
+                WHERE device_id = %s
+                ORDER BY timestamp DESC
+                LIMIT 1
+            """, (device_id,))
+            threshold_row = cur.fetchone()
+            thresholds = self._threshold_dict(threshold_row) if threshold_row else self._thresholds.get(device_id)
+            cur.execute(f"""
+                SELECT timestamp, pm1, pm2_5, pm4, pm10, tsp
+                FROM {PM_VIEW}
+                WHERE device_id = %s AND timestamp >= NOW() - INTERVAL '1 minute' * %s
+                ORDER BY timestamp ASC
+            """, (device_id, self._minutes(thresholds)))
+            rows = cur.fetchall()
+        finally:
+            if conn:
+                self.put_conn(conn)
+        return thresholds, rows
+
+    def add_reading(self, device_id, timestamp, values):
+        """Feed a reading for a relay device; devices not tracked yet are loaded on first evaluate"""
+        with self._lock:
+            window = self._windows.get(device_id)
+            if window is not None:
+                window.add(timestamp, values)
+            elif device_id in self._loading:
+                self._loading[device_id].append((timestamp, values))
+
+    def write(self, cur, batch):
+        pass
+
+    def after_commit(self, batch, state):
+        """BatchWriter stage: feed the PM readings this flush committed"""
+        for device_id, timestamp, pm in pm_rows(batch):
+            self.add_reading(device_id, timestamp, pm)
+
+    def set_thresholds(self, device_id, thresholds):
+        """Update cached thresholds; a longer window is refilled from the database"""
+        with self._lock:
+            old_minutes = self.window_minutes(device_id)
+            self._thresholds[device_id] = {
+                **{key: thresholds.get(key) for key in THRESHOLD_KEYS},
+                "averaging_window": thresholds.get("averaging_window", DEFAULT_WINDOW_MINUTES),
+            }
+            new_minutes = self.window_minutes(device_id)
+            window = self._windows.get(device_id)
+            if window is None or new_minutes == old_minutes:
+                return
+            if new_minutes < old_minutes:
+                window.window_seconds = new_minutes * 60
+                window.expire()
+            else:
+                # Readings older than the old window were dropped; reload on next evaluate
+                del self._windows[device_id]
+
+    def thresholds(self, device_id):
+        """Cached thresholds for a device, or None if none are stored"""
+        return self._thresholds.get(device_id)
+
+    def evaluate(self, device_id):
+        """Return (averages, thresholds) for a device; thresholds is None if none are stored"""
+        with self._lock:
+            window = self._windows.get(device_id)
+            if window is not None:
+                return window.averages(), self._thresholds.get(device_id)
+            self._loading.setdefault(device_id, [])
+        try:
+            thresholds, rows = self._load_device(device_id)
+        except Exception:
+            with self._lock:
+                self._loading.pop(device_id, None)
+            raise
+
+        with self._lock:
+            pending = self._loading.pop(device_id, [])
+            window = self._windows.get(device_id)
+            if window is None:
+                # Another evaluate may have installed the window first
+                if thresholds is not None:
+                    self._thresholds[device_id] = thresholds
+                window = RollingWindow(self._minutes(thresholds) * 60)
+                loaded = set()
+                for row in rows:
+                    window.add(row[0], row[1:])
+                    loaded.add(_reading_key(row[0], row[1:]))
+                # Committed while loading; some may already be in the loaded rows
+                for timestamp, values in pending:
+                    if _reading_key(timestamp, values) not in loaded:
+                        window.add(timestamp, values)
+                self._windows[device_id] = window
+            return window.averages(), self._thresholds.get(device_id)
+
+    def forget(self, device_id):
+        with self._lock:
+            self._windows.pop(device_id, None)
+            self._thresholds.pop(device_id, None)
+            self._loading.pop(device_id, None)
@@ -0,0 +1,359 @@
+"""Incrementally maintained rollup tiers (1 minute, 15 minutes, 1 hour, 1 day).
+
+For every tier and source table there is a ``dust_<source>_rollup_<tier>``
+table keyed by ``(device_id, bucket)`` holding, per channel, the sum, count,
+min and max of the raw values in that bucket (averages are ``sum / count``).
+Because every column merges associatively, a bucket can be updated any
+number of times in any order:
+
+* the ``RollupManager`` is a BatchWriter stage, so each flush folds its rows
+  into all tiers inside the same transaction as the raw INSERT - late and
+  out-of-order rows simply land in their own (older) buckets, and a failed
+  flush rolls back raw rows and rollups together;
+* rows that existed before the rollups were created are folded in by a
+  background backfill that walks the raw tables in id chunks, recording its
+  progress in ``dust_rollup_state`` in the same transaction as each chunk.
+  The PM tiers are backfilled from both halves of the ``dust_pm_readings``
+  view, so extended PM is included and PM rows once mirrored into
+  ``dust_sensor_data`` are counted once.  Tiers built by the earlier
+  ``dust_sensor_data``-only backfill are emptied and rebuilt from the view.
+
+Buckets are aligned to the UTC epoch, like ``history_query``'s buckets.
+"""
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from history_query import PM_SERIES, EXTENDED_SERIES
+from ingest_writer import TABLE_COLUMNS
+from measurements import EXTENDED_PM_COLUMNS, PM_VIEW, extended_pm_rows
+
+logger = logging.getLogger(__name__)
+
+# (name, width in seconds), finest first
+TIERS = (("1m", 60), ("15m", 900), ("1h", 3600), ("1d", 86400))
+TIER_SECONDS = dict(TIERS)
+
+# Raw table -> (rollup name prefix, channels rolled up).  The PM tiers are also fed
+# by the PM columns of extended rows, which are not stored in dust_sensor_data.
+SOURCES = {
+    "dust_sensor_data": ("dust_sensor_rollup", PM_SERIES),
+    "dust_extended_data": ("dust_extended_rollup", EXTENDED_SERIES),
+}
+
+# Backfill state name -> (rollup source, relation read, row filter, table whose ids it walks)
+BACKFILLS = {
+    f"{PM_VIEW}:sensor": ("dust_sensor_data", PM_VIEW, "origin = 'sensor'", "dust_sensor_data"),
+    f"{PM_VIEW}:extended": ("dust_sensor_data", PM_VIEW, "origin = 'extended'", "dust_extended_data"),
+    "dust_extended_data": ("dust_extended_data", "dust_extended_data", None, "dust_extended_data"),
+}
+
+BACKFILL_CHUNK_IDS = 20000
+# How long a "backfill still running" answer from dust_rollup_state is reused
+READY_CHECK_SECONDS = 30
+
+
+def rollup_table(source, tier):
+    return f"{SOURCES[source][0]}_{tier}"
+
+
+def bucket_start(ts, seconds):
+    """UTC start of the ``seconds``-wide epoch-aligned bucket containing ``ts``"""
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    epoch = int(ts.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % seconds, tz=timezone.utc)
+
+
+def _channel_columns(channels):
+    return [f"{c}_{part}" for c in channels for part in ("sum", "count", "min", "max")]
+
+
+def _create_sql(source, tier):
+    channels = SOURCES[source][1]
+    columns = ",\n".join(
+        f"    {c}_sum DOUBLE PRECISION NOT NULL DEFAULT 0,\n"
+        f"    {c}_count INTEGER NOT NULL DEFAULT 0,\n"
+        f"    {c}_min DOUBLE PRECISION,\n"
+        f"    {c}_max DOUBLE PRECISION"
+        for c in channels
+    )
+    return f"""
+CREATE TABLE IF NOT EXISTS {rollup_table(source, tier)} (
+    device_id INTEGER NOT NULL REFERENCES dust_devices(id) ON DELETE CASCADE,
+    bucket TIMESTAMPTZ NOT NULL,
+    row_count INTEGER NOT NULL DEFAULT 0,
+{columns},
+    PRIMARY KEY (device_id, bucket)
+)
+"""
+
+
+def _merge_sql(source, tier):
+    """Additive upsert; ``VALUES %s`` for execute_values, or append a SELECT for backfill"""
+    channels = SOURCES[source][1]
+    updates = ["row_count = r.row_count + EXCLUDED.row_count"]
+    for c in channels:
+        updates += [
+            f"{c}_sum = r.{c}_sum + EXCLUDED.{c}_sum",
+            f"{c}_count = r.{c}_count + EXCLUDED.{c}_count",
+            f"{c}_min = LEAST(r.{c}_min, EXCLUDED.{c}_min)",
+            f"{c}_max = GREATEST(r.{c}_max, EXCLUDED.{c}_max)",
+        ]
+    return (
+        f"INSERT INTO {rollup_table(source, tier)} AS r "
+        f"(device_id, bucket, row_count, {', '.join(_channel_columns(channels))}) "
+        "{rows} "
+        f"ON CONFLICT (device_id, bucket) DO UPDATE SET {', '.join(updates)}"
+    )
+
+
+def _backfill_select(name, seconds):
+    source, relation, row_filter, _ = BACKFILLS[name]
+    channels = SOURCES[source][1]
+    aggregates = ", ".join(
+        f"COALESCE(SUM({c}), 0), COUNT({c}), MIN({c}), MAX({c})" for c in channels
+    )
+    return f"""
+        SELECT device_id, to_timestamp(floor(extract(epoch FROM timestamp) / {int(seconds)}) * {int(seconds)}),
+               COUNT(*), {aggregates}
+        FROM {relation}
+        WHERE id > %(after_id)s AND id <= %(through_id)s AND device_id IS NOT NULL{f" AND {row_filter}" if row_filter else ""}
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """
+
+
+STATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS dust_rollup_state (
+    source TEXT PRIMARY KEY,
+    backfill_through_id BIGINT NOT NULL,
+    backfilled_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+)
+"""
+
+
+def aggregate_rows(rows, columns, channels, seconds):
+    """Fold raw row tuples into {(device_id, bucket): [row_count, sums, counts, mins, maxes]}"""
+    device_index = columns.index("device_id")
+    ts_index = columns.index("timestamp")
+    channel_indexes = [columns.index(c) for c in channels]
+    width = len(channels)
+    buckets = {}
+    for values in rows:
+        device_id = values[device_index]
+        if device_id is None:
+            continue
+        key = (device_id, bucket_start(values[ts_index], seconds))
+        entry = buckets.get(key)
+        if entry is None:
+            entry = buckets[key] = [0, [0.0] * width, [0] * width, [None] * width, [None] * width]
+        entry[0] += 1
+        sums, counts, mins, maxes = entry[1:]
+        for j, i in enumerate(channel_indexes):
+            value = values[i]
+            if value is None:
+                continue
+            value = float(value)
+            sums[j] += value
+            counts[j] += 1
+            if mins[j] is None or value < mins[j]:
+                mins[j] = value
+            if maxes[j] is None or value > maxes[j]:
+                maxes[j] = value
+    return buckets
+
+
+def coarsen(buckets, seconds):
+    """Merge finer-tier (or same-width) buckets, a dict or iterable of its items, into ``seconds``-wide ones"""
+    merged = {}
+    items = buckets.items() if isinstance(buckets, dict) else buckets
+    for (device_id, bucket), (row_count, sums, counts, mins, maxes) in items:
+        key = (device_id, bucket_start(bucket, seconds))
+        entry = merged.get(key)
+        if entry is None:
+            merged[key] = [row_count, list(sums), list(counts), list(mins), list(maxes)]
+            continue
+        entry[0] += row_count
+        for j in range(len(sums)):
+            entry[1][j] += sums[j]
+            entry[2][j] += counts[j]
+            if mins[j] is not None and (entry[3][j] is None or mins[j] < entry[3][j]):
+                entry[3][j] = mins[j]
+            if maxes[j] is not None and (entry[4][j] is None or maxes[j] > entry[4][j]):
+                entry[4][j] = maxes[j]
+    return merged
+
+
+def _value_rows(buckets):
+    # Sorted so concurrent upserts (flush vs. backfill) lock buckets in the same order
+    rows = []
+    for (device_id, bucket), (row_count, sums, counts, mins, maxes) in sorted(buckets.items()):
+        flat = []
+        for j in range(len(sums)):
+            flat += [sums[j], counts[j], mins[j], maxes[j]]
+        rows.append((device_id, bucket, row_count, *flat))
+    return rows
+
+
+class RollupManager:
+    """BatchWriter stage that maintains the rollup tiers, plus the one-off backfill"""
+
+    def __init__(self, get_conn, put_conn, chunk_ids=BACKFILL_CHUNK_IDS, ready=None):
+        self.get_conn = get_conn
+        self.put_conn = put_conn
+        self.chunk_ids = chunk_ids
+        # The backfill waits for this (e.g. a repair of the rows it reads) before it starts
+        self.ready = ready
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"buckets_upserted": 0, "backfilled_ids": 0, "backfill_done": False}
+        self._ready = False
+        self._ready_checked_at = None
+
+    def ensure(self, cur):
+        """Create rollup and state tables; a new backfill is marked to run up to its table's current max id.
+
+        Must run before the batch writer starts so every later row goes through ``write()``.
+        """
+        cur.execute(STATE_TABLE_SQL)
+        for source in SOURCES:
+            for tier, _ in TIERS:
+                cur.execute(_create_sql(source, tier))
+        # PM tiers backfilled from dust_sensor_data alone missed legacy extended PM: rebuild them
+        cur.execute("DELETE FROM dust_rollup_state WHERE source = 'dust_sensor_data'")
+        if cur.rowcount:
+            cur.execute(sql.SQL("TRUNCATE {}").format(sql.SQL(", ").join(
+                sql.Identifier(rollup_table("dust_sensor_data", tier)) for tier, _ in TIERS)))
+            logger.info(f"[ROLLUP] Rebuilding the PM tiers from {PM_VIEW}")
+        for name, (_, _, _, table) in BACKFILLS.items():
+            cur.execute(sql.SQL("""
+                INSERT INTO dust_rollup_state (source, backfill_through_id)
+                SELECT %s, COALESCE(MAX(id), 0) FROM {}
+                ON CONFLICT (source) DO NOTHING
+            """).format(sql.Identifier(table)), (name,))
+            if cur.rowcount:
+                logger.info(f"[ROLLUP] Scheduled rollup backfill of {name}")
+
+    def backfill_done(self):
+        """Whether the backfill has caught up for every source, in any process.
+
+        The backfill only runs on the ingest leader, so other processes (web
+        workers with ``INGEST_IN_WEB=false`` or without the ingest lock) read
+        its progress from ``dust_rollup_state``, at most every
+        ``READY_CHECK_SECONDS``.  Once true it stays true.
+        """
+        if self._ready or self.stats["backfill_done"]:
+            return True
+        now = time.monotonic()
+        if self._ready_checked_at is not None and now - self._ready_checked_at < READY_CHECK_SECONDS:
+            return False
+        self._ready_checked_at = now
+        conn = None
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT COUNT(*), COALESCE(BOOL_AND(backfilled_id >= backfill_through_id), FALSE)
+                FROM dust_rollup_state WHERE source = ANY(%s)
+            """, (list(BACKFILLS),))
+            backfills, caught_up = cur.fetchone()
+            conn.rollback()
+            self._ready = backfills == len(BACKFILLS) and caught_up
+        except Exception as e:
+            logger.error(f"[ROLLUP] Could not read the backfill state: {e}")
+        finally:
+            if conn:
+                self.put_conn(conn)
+        return self._ready
+
+    def _fold(self, cur, source, parts):
+        """Upsert ``parts`` - (rows, column layout, columns to read as ``channels``) - into every tier"""
+        buckets = None
+        for tier, seconds in TIERS:
+            if buckets is None:
+                finest = [aggregate_rows(rows, columns, read, seconds) for rows, columns, read in parts if rows]
+                if not finest:
+                    return
+                # One sorted upsert per tier, even when two tables feed it
+                buckets = finest[0] if len(finest) == 1 else coarsen(
+                    itertools.chain.from_iterable(b.items() for b in finest), seconds)
+            else:
+                buckets = coarsen(buckets, seconds)
+            execute_values(cur, _merge_sql(source, tier).format(rows="VALUES %s"), _value_rows(buckets))
+            self.stats["buckets_upserted"] += len(buckets)
+
+    def write(self, cur, batch):
+        """BatchWriter stage: fold the batch into every tier in the flush transaction"""
+        for source, (_, channels) in SOURCES.items():
+            parts = [(batch.rows[source], TABLE_COLUMNS[source], channels)]
+            if source == "dust_sensor_data":
+                parts.append((extended_pm_rows(batch), TABLE_COLUMNS["dust_extended_data"], EXTENDED_PM_COLUMNS))
+            self._fold(cur, source, parts)
+
+    def after_commit(self, batch, state):
+        pass
+
+    def backfill_step(self):
+        """Fold one id chunk of pre-existing rows per backfill; returns False when nothing is left"""
+        conn = None
+        progressed = False
+        try:
+            conn = self.get_conn()
+            cur = conn.cursor()
+            for name, (source, _, _, _) in BACKFILLS.items():
+                cur.execute("""
+                    SELECT backfilled_id, backfill_through_id FROM dust_rollup_state
+                    WHERE source = %s FOR UPDATE
+                """, (name,))
+                row = cur.fetchone()
+                if not row or row[0] >= row[1]:
+                    conn.rollback()
+                    continue
+                after_id, through_id = row[0], min(row[0] + self.chunk_ids, row[1])
+                params = {"after_id": after_id, "through_id": through_id}
+                for tier, seconds in TIERS:
+                    cur.execute(_merge_sql(source, tier).format(rows=_backfill_select(name, seconds)), params)
+                cur.execute("""
+                    UPDATE dust_rollup_state SET backfilled_id = %s, updated_at = NOW() WHERE source = %s
+                """, (through_id, name))
+                conn.commit()
+                self.stats["backfilled_ids"] += through_id - after_id
+                progressed = True
+        finally:
+            if conn:
+                self.put_conn(conn)
+        return progressed
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.ready and not self.ready():
+                self._stop.wait(60)
+                continue
+            try:
+                if not self.backfill_step():
+                    self.stats["backfill_done"] = True
+                    logger.info("[ROLLUP] Backfill complete")
+                    return
+            except Exception as e:
+                logger.error(f"[ROLLUP] Backfill step failed: {e}")
+                self._stop.wait(30)
+
+    def start(self):
+        """Run the backfill in the background until it has caught up"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="RollupBackfill")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
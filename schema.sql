@@ -37,9 +37,9 @@ CREATE TABLE IF NOT EXISTS dust_devices (
     UNIQUE (deviceid, data_source_id)
 );
 
--- Sensor data table
+-- Sensor data table (range-partitioned by timestamp; partitions are created by PartitionManager)
 CREATE TABLE IF NOT EXISTS dust_sensor_data (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     timestamp TIMESTAMPTZ NOT NULL,
     device_id INTEGER REFERENCES dust_devices(id) ON DELETE CASCADE,
     data_source_id INTEGER REFERENCES dust_data_sources(id) ON DELETE CASCADE,
@@ -47,12 +47,16 @@ CREATE TABLE IF NOT EXISTS dust_sensor_data (
     pm2_5 DOUBLE PRECISION,
     pm4 DOUBLE PRECISION,
     pm10 DOUBLE PRECISION,
-    tsp DOUBLE PRECISION
-);
+    tsp DOUBLE PRECISION,
+    payload_hash BIGINT,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
 
--- Extended sensor data table (for advanced devices)
+CREATE TABLE IF NOT EXISTS dust_sensor_data_default PARTITION OF dust_sensor_data DEFAULT;
+
+-- Extended sensor data table (for advanced devices, partitioned like dust_sensor_data)
 CREATE TABLE IF NOT EXISTS dust_extended_data (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     device_id INTEGER REFERENCES dust_devices(id) ON DELETE CASCADE,
     timestamp TIMESTAMPTZ NOT NULL,
     temperature_c DOUBLE PRECISION,
@@ -70,9 +74,35 @@ CREATE TABLE IF NOT EXISTS dust_extended_data (
     gps_lon DOUBLE PRECISION,
     gps_alt_m DOUBLE PRECISION,
     gps_speed_kmh DOUBLE PRECISION,
-    cloud_cover_percent DOUBLE PRECISION
+    cloud_cover_percent DOUBLE PRECISION,
+    payload_hash BIGINT,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS dust_extended_data_default PARTITION OF dust_extended_data DEFAULT;
+
+-- Latest reading per device (upserted by the ingest writer)
+CREATE TABLE IF NOT EXISTS dust_device_latest (
+    device_id INTEGER PRIMARY KEY REFERENCES dust_devices(id) ON DELETE CASCADE,
+    sensor_timestamp TIMESTAMPTZ,
+    pm1 DOUBLE PRECISION,
+    pm2_5 DOUBLE PRECISION,
+    pm4 DOUBLE PRECISION,
+    pm10 DOUBLE PRECISION,
+    tsp DOUBLE PRECISION,
+    extended_timestamp TIMESTAMPTZ,
+    extended JSONB,
+    gps_timestamp TIMESTAMPTZ,
+    gps_lat DOUBLE PRECISION,
+    gps_lon DOUBLE PRECISION,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Rollup tiers (dust_sensor_rollup_{1m,15m,1h,1d}, dust_extended_rollup_*) and
+-- dust_rollup_state are generated by rollups.RollupManager.ensure() at startup.
+-- Extended devices store their PM only in dust_extended_data; the dust_pm_readings
+-- view over both tables (and dust_migration_state) comes from measurements.MirrorCleanup.ensure().
+
 -- Thresholds table
 CREATE TABLE IF NOT EXISTS dust_thresholds (
     id SERIAL PRIMARY KEY,
@@ -99,7 +129,14 @@ CREATE TABLE IF NOT EXISTS dust_device_alerts (
 
 -- Create indexes for better performance
 CREATE INDEX IF NOT EXISTS idx_sensor_data_device_timestamp ON dust_sensor_data(device_id, timestamp DESC);
-CREATE INDEX IF NOT EXISTS idx_sensor_data_timestamp ON dust_sensor_data(timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_sensor_data_timestamp_brin ON dust_sensor_data USING brin (timestamp);
 CREATE INDEX IF NOT EXISTS idx_extended_data_device_timestamp ON dust_extended_data(device_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_extended_data_timestamp_brin ON dust_extended_data USING brin (timestamp);
+-- Reading keys: the batch writer inserts with ON CONFLICT DO NOTHING, so a redelivered
+-- payload (same device, timestamp and payload_hash) is stored once; rows without a hash never conflict
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sensor_data_reading_hash
+    ON dust_sensor_data(device_id, timestamp, payload_hash) WHERE payload_hash IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_extended_data_reading_hash
+    ON dust_extended_data(device_id, timestamp, payload_hash) WHERE payload_hash IS NOT NULL;
 CREATE INDEX IF NOT EXISTS idx_thresholds_device_timestamp ON dust_thresholds(device_id, timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_alerts_device_created ON dust_device_alerts(device_id, created_at DESC);
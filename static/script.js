@@ -92,11 +92,26 @@ function initializeWebSocket() {
         });
 
         // Handle incoming data - prevent duplicate processing
+        // Sent once after 'join': current readings and the last 15 minutes of history
+        socket.on('snapshot', function(data) {
+            if (String(data.device_id) === String(currentDeviceId)) {
+                console.log('📡 Received WebSocket snapshot');
+                processWebSocketData(data);
+            }
+        });
+
         socket.on('new_data', function(data) {
             if (String(data.device_id) === String(currentDeviceId)) {
                 console.log('📡 Received WebSocket sensor data');
-                // WebSocket data is for real-time updates only - don't replace charts
                 processWebSocketData(data);
+                // Deltas carry only the new points; append them to the PM chart
+                if (data.delta && data.history && data.history.timestamps) {
+                    const times = data.history.timestamps.map(t => new Date(t));
+                    appendChartPoints(charts.timeChart, 'timeChart', times, [
+                        data.history.pm1, data.history.pm2_5, data.history.pm4,
+                        data.history.pm10, data.history.tsp
+                    ]);
+                }
             }
         });
 
@@ -131,6 +146,9 @@ let deviceSelectMap = null;
 let deviceSelectMarkers = [];
 // Polling fallback when websockets are not available or disconnected
 let pollingIntervalId = null;
+// Cursor from the last /api/data response; polls send it back as ?since= to get only new rows
+let pollCursor = null;
+let pollHours = 24;
 // Rigid maxima cache per chart
 const rigidMaxByChart = {};
 
@@ -239,6 +257,7 @@ function handleDeviceSelection() {
 
     currentDeviceId = selectedOption.value;
     currentDeviceType = selectedOption.getAttribute('data-type');
+    pollCursor = null;
     const hasRelay = selectedOption.getAttribute('data-relay') === 'True';
     const deviceName = selectedOption.getAttribute('data-name');
     const deviceId = selectedOption.getAttribute('data-deviceid');
@@ -1312,6 +1331,8 @@ function fetchData(hours = 24) {
             return response.json();
         })
         .then(data => {
+            pollCursor = data.cursor || null;
+            pollHours = hours;
             safeProcessIncomingData(data); // Use safe processing
         })
         .catch(error => {
@@ -1328,10 +1349,88 @@ function fetchData(hours = 24) {
 function startRealtimePolling() {
     if (pollingIntervalId || !currentDeviceId) return;
     pollingIntervalId = setInterval(() => {
-        if (currentDeviceId) fetchData(0.25);
+        if (currentDeviceId) fetchIncrementalData();
     }, 5000);
 }
 
+// Poll only for rows newer than pollCursor and append them to the charts in place
+function fetchIncrementalData() {
+    if (!pollCursor) {
+        fetchData(0.25);
+        return;
+    }
+    const deviceId = currentDeviceId;
+
+    fetch(`/api/data?hours=${encodeURIComponent(pollHours)}&avg_window=${encodeURIComponent(currentAvgWindow)}&deviceid=${encodeURIComponent(deviceId)}&since=${encodeURIComponent(pollCursor)}`, {
+        credentials: 'same-origin'
+    })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            // Ignore answers for a device the user has since switched away from
+            if (deviceId !== currentDeviceId) return;
+            pollCursor = data.cursor || pollCursor;
+            if (data.unchanged) return;
+            appendIncrementalData(data);
+        })
+        .catch(error => {
+            console.error('Error polling for new data:', error);
+        });
+}
+
+function appendChartPoints(chart, key, timestamps, seriesList) {
+    if (!chart || timestamps.length === 0) return;
+
+    const labels = chart.data.labels || [];
+    const lastTime = labels.length ? new Date(labels[labels.length - 1]).getTime() : -Infinity;
+    // The first poll may overlap the full fetch; keep only points past the chart's end
+    const fresh = [];
+    timestamps.forEach((t, i) => {
+        if (t.getTime() > lastTime) fresh.push(i);
+    });
+    if (fresh.length === 0) return;
+
+    // Labels and data arrays may be shared between charts, so build new arrays
+    const newLabels = labels.concat(fresh.map(i => timestamps[i]));
+    const cutoff = Date.now() - pollHours * 3600 * 1000;
+    let drop = 0;
+    while (drop < newLabels.length - 1 && new Date(newLabels[drop]).getTime() < cutoff) drop++;
+
+    chart.data.labels = newLabels.slice(drop);
+    seriesList.forEach((series, index) => {
+        const dataset = chart.data.datasets[index];
+        if (!dataset || !series) return;
+        dataset.data = (dataset.data || []).concat(fresh.map(i => series[i])).slice(drop);
+    });
+    safeChartUpdate(chart, key);
+}
+
+function appendIncrementalData(data) {
+    const history = data.history || {};
+    const pmTimes = (history.timestamps || []).map(t => new Date(t));
+    appendChartPoints(charts.timeChart, 'timeChart', pmTimes,
+        [history.pm1, history.pm2_5, history.pm4, history.pm10, history.tsp]);
+
+    const ext = history.extended;
+    if (ext && ext.timestamps) {
+        const extTimes = ext.timestamps.map(t => new Date(t));
+        appendChartPoints(charts.tempHumidityChart, 'tempHumidityChart', extTimes, [ext.temperature_c, ext.humidity_percent]);
+        appendChartPoints(charts.pressureAirQualityChart, 'pressureAirQualityChart', extTimes, [ext.pressure_hpa, ext.voc_ppb]);
+        appendChartPoints(charts.vocChart, 'vocChart', extTimes, [ext.voc_ppb]);
+        appendChartPoints(charts.no2Chart, 'no2Chart', extTimes, [ext.no2_ppb]);
+        appendChartPoints(charts.noiseChart, 'noiseChart', extTimes, [ext.noise_db]);
+        appendChartPoints(charts.speedChart, 'speedChart', extTimes, [ext.gps_speed_kmh]);
+    }
+
+    // Current readings, averages and thresholds come with every incremental response
+    processWebSocketData(data);
+    if (data.extended) updateExtendedData(data.extended);
+}
+
 function stopRealtimePolling() {
     if (pollingIntervalId) {
         clearInterval(pollingIntervalId);
@@ -1602,7 +1701,7 @@ function startRealtimePolling() {
     pollingIntervalId = setInterval(() => {
         if (currentDeviceId && (!socket || !socket.connected)) {
             console.log('Polling for new data (WebSocket unavailable)...');
-            fetchData(0.25); // Get last 15 minutes of data
+            fetchIncrementalData(); // Only rows added since the last response
         }
     }, 30000); // Poll every 30 seconds (reduced from 5 seconds)
 }
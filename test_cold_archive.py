@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Unit tests for archive reads and merging archived history with database history (no database needed)"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from cold_archive import ColdArchive, archive_columns, merge_history, write_archive
+
+MONTH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def write_month(archive, table, rows):
+    """Archive file for device 7 in January from (seconds, payload_hash, pm1) rows"""
+    columns = archive_columns(table)
+    values = {c: [] for c in columns}
+    for n, (seconds, digest, pm1) in enumerate(rows):
+        row = dict(id=n + 1, timestamp=MONTH + timedelta(seconds=seconds), payload_hash=digest,
+                   pm1=pm1, pm2_5=2.0, pm4=3.0, pm10=4.0, tsp=5.0, tsp_um=5.0)
+        for c in columns:
+            values[c].append(row.get(c))
+    write_archive(archive.path(table, 7, MONTH), {"table": table, "device_id": 7, "month": "2025-01"},
+                  columns, values)
+
+
+def test_merge_history_prepends_archived_points():
+    older = {"timestamps": ["2025-01-01T00:00:00", "2025-01-01T00:01:00"], "pm1": [1, 2]}
+    newer = {"timestamps": ["2025-02-01T00:00:00"], "pm1": [3], "bucket_seconds": 60}
+    assert merge_history(older, newer) == {
+        "timestamps": ["2025-01-01T00:00:00", "2025-01-01T00:01:00", "2025-02-01T00:00:00"],
+        "pm1": [1, 2, 3], "bucket_seconds": 60}
+
+
+def test_merge_history_with_an_empty_side():
+    history = {"timestamps": ["2025-01-01T00:00:00"], "pm1": [1]}
+    empty = {"timestamps": [], "pm1": []}
+    assert merge_history(None, history) is history
+    assert merge_history(empty, history) is history
+    assert merge_history(history, empty) == history
+    assert merge_history(history, None) == history
+
+
+def test_merge_history_reorders_late_rows_and_envelopes():
+    older = {"timestamps": ["2025-01-01T00:00:00", "2025-01-01T00:02:00"], "pm1": [1, 3],
+             "pm1_envelope": {"min": [0, 2], "max": [2, 4]}}
+    newer = {"timestamps": ["2025-01-01T00:01:00"], "pm1": [2],
+             "pm1_envelope": {"min": [1], "max": [3]}}
+    merged = merge_history(older, newer)
+    assert merged["timestamps"] == ["2025-01-01T00:00:00", "2025-01-01T00:01:00", "2025-01-01T00:02:00"]
+    assert merged["pm1"] == [1, 2, 3]
+    assert merged["pm1_envelope"] == {"min": [0, 1, 2], "max": [2, 3, 4]}
+
+
+def test_pm_rows_dedup_on_the_reading_key(tmp_path):
+    archive = ColdArchive(None, None, str(tmp_path))
+    # Two readings in the same second with different payloads, plus a redelivery of the first
+    write_month(archive, "dust_sensor_data", [(0, 11, 1.0), (0, 12, 9.0), (0, 11, 1.0), (60, None, 1.0)])
+    # A pre-hash compact reading mirrored into both tables, and an unhashed reading that differs
+    write_month(archive, "dust_extended_data", [(60, None, 1.0), (60, None, 8.0)])
+    rows = list(archive.pm_rows(7, MONTH, MONTH + timedelta(days=1)))
+    assert [(ts - MONTH).seconds for ts, *_ in rows] == [0, 0, 60, 60]
+    assert sorted(row[1] for row in rows[:2]) == [1.0, 9.0]
+    assert sorted(row[1] for row in rows[2:]) == [1.0, 8.0]
+    assert all(len(row) == 6 for row in rows)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""Unit tests for the incremental /api/data cursors (no database needed)"""
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from history_query import make_cursor, parse_cursor
+
+
+def test_cursor_round_trip():
+    assert parse_cursor(make_cursor(120, 45, 1717243200000)) == {
+        "sensor_id": 120, "extended_id": 45, "latest_ms": 1717243200000}
+    assert parse_cursor(make_cursor(0, 0)) == {"sensor_id": 0, "extended_id": 0, "latest_ms": 0}
+
+
+def test_make_cursor_truncates_to_integers():
+    assert make_cursor(5.0, "7", 1.9) == "5.7.1"
+
+
+def test_parse_cursor_accepts_an_iso_timestamp():
+    assert parse_cursor("2025-06-01T12:00:00Z") == {"since": datetime(2025, 6, 1, 12, tzinfo=timezone.utc)}
+    assert parse_cursor("2025-06-01T12:00:00.250+00:00")["since"].microsecond == 250000
+
+
+@pytest.mark.parametrize("value", ["", "abc", "1.2", "1.2.x", "-1.2.3"])
+def test_parse_cursor_rejects_garbage(value):
+    with pytest.raises(ValueError):
+        parse_cursor(value)
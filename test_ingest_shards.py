@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Unit tests for shard routing and the pipe frame format (no database needed)"""
+from ingest_shards import BATCH_HEADER, FRAME, HashRing, iter_frames, shard_key
+
+
+def encode_frames(messages):
+    """Batch body as ShardedIngest._sender_loop writes it (without the length header)"""
+    body = bytearray()
+    for data_source_id, topic, payload in messages:
+        topic = topic.encode()
+        body += FRAME.pack(data_source_id, len(topic), len(payload)) + topic + payload
+    return bytes(body)
+
+
+def test_iter_frames_round_trip():
+    messages = [
+        (1, "dustrak/DT-1/data", b'{"i":"DT-1","pm":[1,2,3,4,5]}'),
+        (2, "sensor/data", b""),
+        (-1, "control", b'{"op":"reload"}'),
+        (7, "dustrak/é/data", b"\x00\xff"),
+    ]
+    assert list(iter_frames(encode_frames(messages))) == messages
+    assert list(iter_frames(b"")) == []
+
+
+def test_iter_frames_reads_a_body_after_its_length_header():
+    messages = [(3, "a/data", b"x" * 10), (3, "a/data", b"y")]
+    body = encode_frames(messages)
+    stream = BATCH_HEADER.pack(len(body)) + body + b"next batch"
+    (length,) = BATCH_HEADER.unpack_from(stream)
+    assert list(iter_frames(stream[BATCH_HEADER.size:BATCH_HEADER.size + length])) == messages
+
+
+def test_shard_key_reads_the_device_without_decoding():
+    assert shard_key(4, b'{"deviceid": "DT-9", "PM_data": {}}') == b"4:DT-9"
+    assert shard_key(4, b'{"i":"DT-9","e":[]}') == b"4:DT-9"
+    assert shard_key(5, b'{"i":123}') == b"5:123"
+    assert shard_key(6, b'{"x":1}') == b"6:"
+
+
+def test_hash_ring_is_stable_and_covers_every_shard():
+    ring, again = HashRing(4), HashRing(4)
+    keys = [b"1:DT-%d" % i for i in range(2000)]
+    owners = [ring.shard_for(key) for key in keys]
+    assert owners == [again.shard_for(key) for key in keys]
+    assert set(owners) == {0, 1, 2, 3}
+    # Virtual nodes keep the shards roughly balanced
+    assert min(owners.count(shard) for shard in range(4)) > len(keys) / 4 / 2
+
+
+def test_hash_ring_resize_moves_about_one_nth_of_the_keys():
+    keys = [b"1:DT-%d" % i for i in range(5000)]
+    before, after = HashRing(4), HashRing(5)
+    moved = [key for key in keys if before.shard_for(key) != after.shard_for(key)]
+    # Keys only move to the new shard, never between the old ones
+    assert all(after.shard_for(key) == 4 for key in moved)
+    assert 0.1 < len(moved) / len(keys) < 0.3
+
+
+def test_single_shard_ring():
+    ring = HashRing(1)
+    assert {ring.shard_for(b"%d" % i) for i in range(100)} == {0}
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Unit tests for the batched ingest writer against an in-memory fake database"""
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+import ingest_writer
+from dedup import RecentKeys
+from ingest_spool import Spool
+from ingest_writer import QUARANTINED, RETRY, WRITTEN, BatchWriter, IngestBatch, TABLE_COLUMNS
+
+T0 = datetime(2025, 6, 1, 12, 0, tzinfo=timezone.utc)
+COLUMNS = TABLE_COLUMNS["dust_sensor_data"]
+
+
+def sensor_row(n, pm1=1.0, digest="auto", device_id=7):
+    row = dict(timestamp=T0 + timedelta(seconds=n), device_id=device_id, data_source_id=1,
+               pm1=pm1, pm2_5=2.0, pm4=3.0, pm10=4.0, tsp=5.0,
+               payload_hash=n if digest == "auto" else digest)
+    return tuple(row.get(c) for c in COLUMNS)
+
+
+def batch_of(*rows):
+    batch = IngestBatch()
+    batch.rows["dust_sensor_data"].extend(rows)
+    batch.events = {7: {"device_id": 7}}
+    return batch
+
+
+class FakeDatabase:
+    """Committed rows per table; a row whose pm1 is "bad" fails like invalid data, "poison" like a schema error"""
+
+    def __init__(self):
+        self.rows = {table: [] for table in TABLE_COLUMNS}
+        self.down = False
+        self.error = None
+
+    def connect(self):
+        if self.down:
+            raise psycopg2.OperationalError("connection refused")
+        return FakeConnection(self)
+
+    def key(self, table, values):
+        columns = TABLE_COLUMNS[table]
+        return tuple(values[columns.index(c)] for c in ingest_writer.READING_KEY_COLUMNS)
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.pending = {table: [] for table in TABLE_COLUMNS}
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        for table, rows in self.pending.items():
+            self.db.rows[table].extend(rows)
+        self.pending = {table: [] for table in TABLE_COLUMNS}
+
+    def rollback(self):
+        self.pending = {table: [] for table in TABLE_COLUMNS}
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, statement, params=None):
+        if self.conn.db.error is not None:
+            raise self.conn.db.error
+
+
+def fake_execute_values(cur, statement, rows, page_size=None, fetch=False):
+    """INSERT ... ON CONFLICT DO NOTHING RETURNING the reading key, all or nothing per statement"""
+    db, conn = cur.conn.db, cur.conn
+    table = statement.split()[2]
+    pm1 = TABLE_COLUMNS[table].index("pm1")
+    if any(values[pm1] == "bad" for values in rows):
+        raise psycopg2.DataError("invalid input syntax for type double precision")
+    if any(values[pm1] == "poison" for values in rows):
+        raise psycopg2.ProgrammingError('column "payload_hash" does not exist')
+    existing = {db.key(table, values) for values in db.rows[table] + conn.pending[table]
+                if values[TABLE_COLUMNS[table].index("payload_hash")] is not None}
+    inserted = []
+    for values in rows:
+        key = db.key(table, values)
+        if key[-1] is not None and key in existing:
+            continue
+        existing.add(key)
+        conn.pending[table].append(values)
+        inserted.append(key)
+    return inserted
+
+
+class RecordingStage:
+    def __init__(self):
+        self.committed = []
+
+    def write(self, cur, batch):
+        return list(batch.rows["dust_sensor_data"])
+
+    def after_commit(self, batch, rows):
+        self.committed.extend(rows)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(ingest_writer, "execute_values", fake_execute_values)
+    return FakeDatabase()
+
+
+def make_writer(db, spool=None, **kwargs):
+    writer = BatchWriter(db.connect, lambda conn: None, stages=[RecordingStage()], spool=spool, **kwargs)
+    if spool is not None:
+        spool.open()
+        writer.quarantine.open()
+    return writer
+
+
+def test_bad_rows_are_isolated_and_the_rest_written(db):
+    writer = make_writer(db)
+    rows = [sensor_row(0), sensor_row(1, pm1="bad"), sensor_row(2), sensor_row(3, pm1="bad"), sensor_row(4)]
+    batch = batch_of(*rows)
+    assert writer._write(batch) is WRITTEN
+    good = [rows[0], rows[2], rows[4]]
+    assert db.rows["dust_sensor_data"] == good
+    assert batch.rows["dust_sensor_data"] == good
+    assert writer.stages[0].committed == good
+    assert writer.stats["rejected"] == 2 and writer.stats["duplicates"] == 0
+
+
+def test_duplicates_are_dropped_before_the_stages(db):
+    writer = make_writer(db)
+    assert writer._write(batch_of(sensor_row(0), sensor_row(1))) is WRITTEN
+    unhashed = sensor_row(5, digest=None)
+    batch = batch_of(sensor_row(1), sensor_row(2), sensor_row(2), unhashed, unhashed)
+    assert writer._write(batch) is WRITTEN
+    # A redelivered reading is skipped once stored; rows without a hash never conflict
+    assert batch.rows["dust_sensor_data"] == [sensor_row(2), unhashed, unhashed]
+    assert writer.stats["duplicates"] == 2
+    assert writer.stages[0].committed[2:] == [sensor_row(2), unhashed, unhashed]
+
+
+def test_transient_failure_is_spooled_and_replayed(db, tmp_path):
+    writer = make_writer(db, spool=Spool(str(tmp_path), fsync=False))
+    db.down = True
+    writer._write_or_spool(batch_of(sensor_row(0)))
+    # Later batches queue behind the spooled one instead of overtaking it
+    writer._write_or_spool(batch_of(sensor_row(1)))
+    assert writer.spool.depth_records == 2 and db.rows["dust_sensor_data"] == []
+
+    writer._replay()
+    assert writer.spool.depth_records == 2
+
+    db.down = False
+    writer._replay()
+    assert writer.spool.depth_records == 0
+    assert db.rows["dust_sensor_data"] == [sensor_row(0), sensor_row(1)]
+    assert writer.spool.stats["replayed_rows"] == 2
+
+
+def test_non_transient_failure_is_quarantined_not_retried(db, tmp_path):
+    writer = make_writer(db, spool=Spool(str(tmp_path), fsync=False))
+    db.down = True
+    writer._write_or_spool(batch_of(sensor_row(0, pm1="poison")))
+    writer._write_or_spool(batch_of(sensor_row(1)))
+    db.down = False
+
+    # The poison batch at the head of the spool is moved aside; the one behind it still goes in
+    writer._replay()
+    assert writer.spool.depth_records == 0
+    assert db.rows["dust_sensor_data"] == [sensor_row(1)]
+    assert writer.quarantine.depth_records == 1
+    assert writer.stats["quarantined_batches"] == 1 and writer.stats["quarantined_rows"] == 1
+
+
+def test_non_transient_failure_of_a_live_batch_is_not_spooled(db, tmp_path):
+    writer = make_writer(db, spool=Spool(str(tmp_path), fsync=False))
+    assert writer._write(batch_of(sensor_row(0, pm1="poison"))) is QUARANTINED
+    writer._write_or_spool(batch_of(sensor_row(1, pm1="poison")))
+    assert writer.spool.depth_records == 0 and writer.quarantine.depth_records == 2
+
+
+def test_transient_errors_are_retried(db):
+    writer = make_writer(db)
+    db.error = psycopg2.OperationalError("server closed the connection unexpectedly")
+    assert writer._write(batch_of(sensor_row(0))) is RETRY
+    assert writer.stats["quarantined_batches"] == 0
+
+
+def test_overflow_is_spilled_outside_the_queue_lock(db, tmp_path):
+    class CheckingSpool(Spool):
+        def append(self, item):
+            # Another producer must be able to take the queue lock while this append runs
+            def probe():
+                if writer._cond.acquire(timeout=1):
+                    writer._cond.release()
+                    lock_free.append(True)
+                else:
+                    lock_free.append(False)
+
+            thread = threading.Thread(target=probe)
+            thread.start()
+            thread.join()
+            super().append(item)
+
+    lock_free = []
+    writer = make_writer(db, spool=CheckingSpool(str(tmp_path), fsync=False), max_rows=2, max_pending_rows=3)
+    for n in range(3):
+        writer.add_values("dust_sensor_data", sensor_row(n))
+    assert lock_free == [True]
+    assert writer.spool.depth_records == 1 and len(writer._batch) == 0
+
+
+def test_recent_keys_are_remembered_only_after_commit(db):
+    keys = RecentKeys()
+    writer = BatchWriter(db.connect, lambda conn: None, stages=[keys])
+    db.error = psycopg2.OperationalError("server closed the connection unexpectedly")
+    assert writer._write(batch_of(sensor_row(0))) is RETRY
+    # The broker's redelivery of a failed flush must still get through
+    assert not keys.seen(7, T0, 0)
+
+    db.error = None
+    assert writer._write(batch_of(sensor_row(0), sensor_row(1, digest=None))) is WRITTEN
+    assert keys.seen(7, T0, 0)
+    assert keys.metrics()["devices"] == 1 and not keys.seen(7, T0 + timedelta(seconds=1), None)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Unit tests for the compiled payload decoders (no database needed)"""
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from ingest_writer import TABLE_COLUMNS
+from payload_decoders import BASIC, COMPACT, LEGACY_EXTENDED, STATUS, default_registry
+
+RECEIVED_AT = datetime(2025, 6, 1, 12, 0, 30, tzinfo=timezone.utc)
+
+COMPACT_PAYLOAD = {
+    "i": "DT-0001", "t": "2025-06-01T12:00:00Z",
+    "e": [22.67, 33.87, 1012.49, 0.0, 0.44, 32044, 0.605, 66.23],
+    "pm": [1.2, 2.4, 3.1, 4.8, 6.0],
+    "g": {"lat": 51.5072, "lon": -0.1276},
+}
+
+LEGACY_PAYLOAD = {
+    "deviceid": "DT-0002", "timestamp_utc": "2025-06-01T11:59:00Z",
+    "Temperature_C": 21.5, "Humidity_%": 40.0, "Pressure_hPa": 1009.0,
+    "VOC_ppb": 12.0, "NO2_ppb": 3.0, "Cloud_cover_%": 75,
+    "PM_data": {"PM1": 1.0, "PM2_5": 2.0, "PM4": 3.0, "PM10": 4.0, "TSP_um": 5.0},
+    "GPS": {"Latitude": 52.2, "Longitude": 0.12, "Altitude_m": 14.0, "Speed_kmh": 0.5},
+}
+
+
+def as_row(payload_format, values):
+    return dict(zip(TABLE_COLUMNS[payload_format.table], values))
+
+
+def test_compact_slots_match_the_old_handler():
+    row = as_row(COMPACT, COMPACT.decode(COMPACT_PAYLOAD, RECEIVED_AT))
+    assert row["timestamp"] == datetime(2025, 6, 1, 12, 0, tzinfo=timezone.utc)
+    assert (row["temperature_c"], row["humidity_percent"], row["pressure_hpa"]) == (22.67, 33.87, 1012.49)
+    assert (row["uv_index"], row["lux"], row["noise_db"]) == (0.0, 0.44, 66.23)
+    assert row["voc_ppb"] == pytest.approx(32.044)
+    assert row["no2_ppb"] == pytest.approx(605)
+    assert [row[c] for c in ("pm1", "pm2_5", "pm4", "pm10", "tsp_um")] == [1.2, 2.4, 3.1, 4.8, 6.0]
+    assert (row["gps_lat"], row["gps_lon"]) == (51.5072, -0.1276)
+    # Short "e" array: battery (index 18) is absent rather than an IndexError
+    assert row["battery_percent"] is None
+    assert row["gps_alt_m"] is None and row["cloud_cover_percent"] is None
+    # Left to the caller
+    assert row["device_id"] is None and row["payload_hash"] is None
+
+
+def test_compact_zero_gas_readings_are_missing():
+    payload = dict(COMPACT_PAYLOAD, e=[20.0, 30.0, 1000.0, 1.0, 2.0, 0, 0, 50.0])
+    row = as_row(COMPACT, COMPACT.decode(payload, RECEIVED_AT))
+    assert row["voc_ppb"] is None and row["no2_ppb"] is None
+
+
+def test_legacy_extended_columns_are_not_shifted():
+    row = as_row(LEGACY_EXTENDED, LEGACY_EXTENDED.decode(LEGACY_PAYLOAD, RECEIVED_AT))
+    assert row["noise_db"] is None
+    assert [row[c] for c in ("pm1", "pm2_5", "pm4", "pm10", "tsp_um")] == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert (row["gps_lat"], row["gps_lon"], row["gps_alt_m"], row["gps_speed_kmh"]) == (52.2, 0.12, 14.0, 0.5)
+    assert row["cloud_cover_percent"] == 75
+    assert row["timestamp"] == datetime(2025, 6, 1, 11, 59, tzinfo=timezone.utc)
+
+
+def test_basic_converts_mg_to_ug_and_defaults_to_zero():
+    row = as_row(BASIC, BASIC.decode({"deviceid": "DT-0003", "PM_data": {"PM1": 0.012, "PM10": 0.05}},
+                                     RECEIVED_AT))
+    assert row["pm1"] == pytest.approx(12)
+    assert row["pm10"] == pytest.approx(50)
+    assert row["pm2_5"] == 0 and row["pm4"] == 0 and row["tsp"] == 0
+    assert row["timestamp"] == RECEIVED_AT
+
+
+def test_invalid_device_timestamp_falls_back_to_received_time():
+    payload = dict(COMPACT_PAYLOAD, t="not a timestamp")
+    assert as_row(COMPACT, COMPACT.decode(payload, RECEIVED_AT))["timestamp"] == RECEIVED_AT
+
+
+def test_registry_matches_in_priority_order():
+    registry = default_registry()
+    assert registry.match("dustrak/1/data", COMPACT_PAYLOAD) is COMPACT
+    assert registry.match("dustrak/1/data", LEGACY_PAYLOAD) is LEGACY_EXTENDED
+    assert registry.match("sensor/data", {"deviceid": "x", "PM_data": {}}) is BASIC
+    assert registry.match("dustrak/status", {"deviceid": "x", "relay": "on"}) is STATUS
+
+
+def test_decode_columns_transposes_records():
+    columns = COMPACT.decode_columns([COMPACT_PAYLOAD, COMPACT_PAYLOAD], RECEIVED_AT)
+    assert len(columns) == len(TABLE_COLUMNS["dust_extended_data"])
+    pm1 = columns[TABLE_COLUMNS["dust_extended_data"].index("pm1")]
+    assert pm1 == [1.2, 1.2]
+    assert COMPACT.decode_columns([], RECEIVED_AT) == [[] for _ in columns]